@@ -1,68 +1,236 @@
 import argparse
+import atexit
+import collections
+import functools
+import json
 import logging
+import multiprocessing
 import os
 import subprocess
+import sys
+import threading
+import time
 
 import bam_utils
+import blat
+import checkpoints
+import daemon
+import metrics
+import pipeline
+import tool_runner
 #from blast import BlastAnnotator
-from blat import BlatAnnotator
-from repeats import RepeatAnnotator
+from blat import BlatAnnotator, GfServer
+from gtf import GtfAnnotator
+from repeats import RepeatAnnotator, get_repeat_collection, write_repeat_index
+from transvar_cache import TransvarCache
 from transvar_wrapper import TransvarAnnotator
 
 logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.INFO)
 
-parser = argparse.ArgumentParser()
+ANNOTATE_COMMAND = 'annotate'
+BUILD_REPEAT_INDEX_COMMAND = 'build-repeat-index'
+SERVE_COMMAND = 'serve'
 
-parser.add_argument('input_file', type=str,
-        help='input file')
-
-annotation_group = parser.add_argument_group('argument_group') 
-annotation_group.add_argument('--annotate-transvar', action='store_true',
-        help='If present, transvar annotations will be added to input file. \
+def add_annotator_arguments(parser):
+    """Add settings for setting up annotators. Shared by annotating a file and serving"""
+    annotation_group = parser.add_argument_group('argument_group')
+    annotation_group.add_argument('--annotate-transvar', action='store_true',
+            help='If present, transvar annotations will be added to input file. \
 Added fields will be PRIMARY_TRANSCRIPT, GENE, STRAND, REGION, NON_VERBOSE_REGION, and INFO.')
-annotation_group.add_argument('--annotate-repeats', action='store_true',
-        help='If present, annotation for repeats will be done. i.e. for finding ALUs and stuff. \
+    annotation_group.add_argument('--annotate-repeats', action='store_true',
+            help='If present, annotation for repeats will be done. i.e. for finding ALUs and stuff. \
 Added fields will be REPEAT_NAME, REPEAT_CLASS, and REPEAT_FAMILY. \
 Entry will be . if position is not a repeat.')
-annotation_group.add_argument('--annotate-blat', action='store_true',
-        help='If present, annotations for BLAT will be done. \
-Added fields will include BLAT_RNA_EDITING_%_PASSING')
+    annotation_group.add_argument('--annotate-blat', action='store_true',
+            help='If present, annotations for BLAT will be done. \
+Added fields will include BLAT_RNA_EDITING_%%_PASSING')
 
-# transvar specific
-parser.add_argument('--primary-transcripts', type=str,
-        help='A .tsv file with genes in first column and ensembl transcript in second column. \
+    # transvar specific
+    parser.add_argument('--primary-transcripts', type=str,
+            help='A .tsv file with genes in first column and ensembl transcript in second column. \
 Only used if --annotate-transvar flag is present')
-parser.add_argument('--with-base-change', action='store_true',
-        help='Use base ref/alt base change with annotations. The third column in input file must \
+    parser.add_argument('--with-base-change', action='store_true',
+            help='Use base ref/alt base change with annotations. The third column in input file must \
 be the reference base, and the fourth column must be the alternative base')
-
-# repeats specific
-parser.add_argument('--repeats-table', type=str,
-        help='A .tsv file generated with ucsc table browser - repeats. \
-Only used if --annotate-repeats flag is present')
-
-# blat specific
-parser.add_argument('--blat-input-bam', type=str,
-        help='Input bam containing reads to use for blat annotation. \
+    parser.add_argument('--transvar-chunk-size', type=int,
+            default=1000, help='Number of positions to annotate with each transvar run.')
+    parser.add_argument('--transvar-cache', type=str,
+            help='Sqlite file to cache transvar annotations in across runs. Will be created if it \
+does not exist. If not present, no cache is used.')
+    parser.add_argument('--transvar-cache-max-entries', type=int,
+            default=1000000, help='Max number of annotations kept in --transvar-cache. Least \
+recently used annotations are evicted first.')
+
+    parser.add_argument('--gtf', type=str,
+            help='A GENCODE or Ensembl .gtf, optionally gzipped. If present with \
+--annotate-transvar, PRIMARY_TRANSCRIPT, GENE, STRAND, REGION and NON_VERBOSE_REGION are looked \
+up in it in process instead of running transvar, and COORDINATES and INFO are left as .')
+
+    # repeats specific
+    parser.add_argument('--repeats-table', type=str,
+            help='A .tsv file generated with ucsc table browser - repeats, or an index compiled from \
+one with build-repeat-index. Only used if --annotate-repeats flag is present')
+
+    # blat specific
+    parser.add_argument('--blat-input-bam', type=str,
+            help='Input bam containing reads to use for blat annotation. \
 Required if --annotate-blat is used.')
-parser.add_argument('--rna-editing-percent-threshold', type=float,
-        default=.95, help='Percent identity threshold to use when calling a positive blat rna \
+    parser.add_argument('--bam-reader', type=str,
+            default='pysam', choices=['pysam', 'samtools'], help='How reads are pulled from \
+--blat-input-bam. pysam streams them in process from the indexed bam. samtools pipes them \
+from samtools view.')
+    parser.add_argument('--max-depth', type=int,
+            default=200, help='Max number of reads per position to use for blat annotations. At \
+deeper positions a uniform random sample of reads is used.')
+    parser.add_argument('--sampling-seed', type=int,
+            default=0, help='Seed for sampling reads at positions deeper than --max-depth.')
+    parser.add_argument('--rna-editing-percent-threshold', type=float,
+            default=.95, help='Percent identity threshold to use when calling a positive blat rna \
 editing read.')
-
-
-parser.add_argument('--input-header', action='store_true',
-        help='Whether input tsv file has header or not')
-parser.add_argument('--input-type', type=str,
-        help='Type of input file. Options are tsv and json.')
-parser.add_argument('--reference-version', type=str,
-        default='hg38', help='Reference version to use for annotations. \
+    parser.add_argument('--blat-workers', type=int,
+            default=1, help='Number of blat processes to run concurrently. Query reads for each \
+chunk are split evenly between them.')
+    parser.add_argument('--workers', type=int,
+            default=1, help='Number of processes to annotate blat chunks in. Each process has its \
+own blat annotator, and chunks are written out in input order.')
+    parser.add_argument('--blat-fetch-queue-depth', type=int,
+            default=1, help='Number of chunks with reads fetched from --blat-input-bam that can wait \
+for blat while another chunk is aligned.')
+    parser.add_argument('--blat-align-queue-depth', type=int,
+            default=1, help='Number of aligned chunks that can wait to be scored.')
+    parser.add_argument('--blat-approximate', action='store_true',
+            help='If present, rna editing reads are blatted in rounds and a position stops once its \
+passing fraction is known well enough, see --blat-ci-width and --blat-decision-threshold. \
+Adds BLAT_RNA_EDITING_READS_USED, BLAT_RNA_EDITING_CI_LOWER and BLAT_RNA_EDITING_CI_UPPER.')
+    parser.add_argument('--blat-ci-width', type=float,
+            default=.1, help='With --blat-approximate, stop a position once the confidence interval \
+on its passing fraction is at most this wide.')
+    parser.add_argument('--blat-decision-threshold', type=float,
+            help='With --blat-approximate, also stop a position once the confidence interval on its \
+passing fraction is entirely above or below this value.')
+    parser.add_argument('--blat-round-size', type=int,
+            default=20, help='With --blat-approximate, number of reads per position blatted each \
+round.')
+    parser.add_argument('--blat-confidence', type=float,
+            default=.95, help='With --blat-approximate, confidence level of the interval.')
+    parser.add_argument('--blat-backend', type=str,
+            default='blat', choices=['blat', 'gfserver'], help='blat runs standalone blat for each \
+chunk. gfserver starts a local gfServer on --reference-fasta once and sends each chunk to it \
+with gfClient. A .2bit of the reference is created next to it if needed.')
+    parser.add_argument('--gfserver-port', type=int,
+            help='Port for the local gfServer. Defaults to a free port picked for each run. Only \
+used with --blat-backend gfserver')
+    parser.add_argument('--reference-version', type=str,
+            default='hg38', help='Reference version to use for annotations. \
 Important for repeats and transvar')
-parser.add_argument('--reference-fasta', type=str,
-        help='Reference fasta to use for annotations with blat and transvar')
-parser.add_argument('--output', type=str,
-        default='output.tsv', help='output fp')
-
-args = parser.parse_args()
+    parser.add_argument('--reference-fasta', type=str,
+            help='Reference fasta to use for annotations with blat and transvar')
+    parser.add_argument('--tool-limit', type=str, action='append',
+            default=[], help=f'Max processes of an external tool to run at once, as TOOL=N, i.e. \
+blat=4. Can be given more than once. Tools not given are limited to {tool_runner.DEFAULT_LIMIT}, \
+the number of cpus. Limits are per process with --workers.')
+    parser.add_argument('--tool-timeout', type=str, action='append',
+            default=[], help='Seconds an external tool can run before it is killed and the run \
+fails, as TOOL=SECONDS, i.e. transvar=600. Can be given more than once. Tools not given have \
+no timeout.')
+
+    parser.add_argument('--batch-size', type=int,
+            default=1000, help='Number of input rows streamed through the annotators at a time. \
+Also the number of positions in each blat chunk.')
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('input_file', type=str,
+            help='input file')
+
+    add_annotator_arguments(parser)
+
+    parser.add_argument('--checkpoint-dir', type=str,
+            help='Directory to save each annotated batch in as it finishes. Output is written from \
+it once every batch is done. If not present, output is written as batches finish.')
+    parser.add_argument('--resume', action='store_true',
+            help='With --checkpoint-dir, keep batches finished by an earlier run with the same input \
+and settings, and only annotate the rest.')
+    parser.add_argument('--metrics-out', type=str,
+            help='If present, json with wall time and peak rss per stage, time in each external \
+tool, and counts of positions, reads, blat hits, transvar calls and repeat lookups is written \
+here at exit.')
+    parser.add_argument('--profile', type=str,
+            help='If present, a cProfile stats file per stage is written to this directory. Stages \
+are profiled one at a time, so concurrent stages wait on each other while profiling.')
+    parser.add_argument('--input-header', action='store_true',
+            help='Whether input tsv file has header or not')
+    parser.add_argument('--input-type', type=str,
+            help='Type of input file. Options are tsv and json.')
+    parser.add_argument('--output', type=str,
+            default='output.tsv', help='output fp')
+    parser.add_argument('--concurrent-annotators', action='store_true',
+            help='If present, each enabled annotator runs in its own thread on its own read of the \
+input, and their columns are joined row by row. Annotators get at most --annotator-queue-depth \
+batches ahead of the slowest one.')
+    parser.add_argument('--annotator-queue-depth', type=int,
+            default=2, help='Number of annotated batches each annotator can hold while waiting on \
+the others with --concurrent-annotators.')
+    parser.set_defaults(command=ANNOTATE_COMMAND)
+
+    return parser
+
+def get_index_parser():
+    parser = argparse.ArgumentParser(prog=f'annotation_station.py {BUILD_REPEAT_INDEX_COMMAND}',
+            description='Compile a repeats table into a binary index that --repeats-table can \
+memory map for fast startup.')
+    parser.add_argument('--repeats-table', type=str,
+            help='A .tsv file generated with ucsc table browser - repeats. If not present, the built \
+in table for --reference-version is used.')
+    parser.add_argument('--reference-version', type=str,
+            default='hg38', help='Reference version of built in repeats table to compile.')
+    parser.add_argument('--output', type=str,
+            help='output fp. Defaults to repeats table path with a .idx extension, which is picked \
+up automatically for built in tables.')
+    parser.set_defaults(command=BUILD_REPEAT_INDEX_COMMAND)
+
+    return parser
+
+def get_serve_parser():
+    parser = argparse.ArgumentParser(prog=f'annotation_station.py {SERVE_COMMAND}',
+            description='Set up annotators once and keep them warm, annotating batches of rows \
+sent over a unix socket. See daemon.AnnotationClient.')
+    parser.add_argument('--socket', type=str,
+            required=True, help='Path of unix socket to listen on.')
+
+    add_annotator_arguments(parser)
+
+    parser.set_defaults(command=SERVE_COMMAND)
+
+    return parser
+
+def parse_args(argv=None):
+    """Returns parsed arguments for the command in argv. Defaults to sys.argv"""
+    if argv is None:
+        argv = sys.argv[1:]
+
+    if argv and argv[0] == BUILD_REPEAT_INDEX_COMMAND:
+        return get_index_parser().parse_args(argv[1:])
+    if argv and argv[0] == SERVE_COMMAND:
+        return get_serve_parser().parse_args(argv[1:])
+    return get_parser().parse_args(argv)
+
+def get_config(**settings):
+    """Returns annotator settings for get_session and annotate.
+
+    Settings are named like the command line options, i.e.
+    get_config(annotate_repeats=True, reference_version='hg19'), and default the same way"""
+    parser = argparse.ArgumentParser()
+    add_annotator_arguments(parser)
+    config = parser.parse_args([])
+
+    for name, value in settings.items():
+        if not hasattr(config, name):
+            raise ValueError(f'Unknown setting {name}')
+        setattr(config, name, value)
+
+    return config
 
 
 # defaults
@@ -75,17 +243,70 @@ DEFAULT_GENE_TO_PRIMARY_TRANSCRIPT = os.path.join(os.path.dirname(os.path.realpa
 DEFAULT_GENE_TO_PRIMARY_TRANSCRIPT = os.path.join(os.path.dirname(os.path.realpath(__file__)),
         'data/transcripts/gene_to_primary_transcript.tsv')
 
-def check_arguments():
+def check_arguments(args):
     if args.input_type is None:
         raise ValueError('Must specify an input type')
-
-def get_default_repeat_table(reference_version):
-    """Returns default repeat table fp for given reference"""
+    if args.resume and args.checkpoint_dir is None:
+        raise ValueError('--resume requires --checkpoint-dir')
+
+# args that change how a run is done but not its output, so don't prevent resuming
+RUNTIME_ARGS = set(['output', 'checkpoint_dir', 'resume', 'workers', 'blat_workers',
+        'blat_fetch_queue_depth', 'blat_align_queue_depth', 'concurrent_annotators',
+        'annotator_queue_depth', 'tool_limit', 'tool_timeout', 'transvar_cache',
+        'transvar_cache_max_entries', 'transvar_chunk_size', 'gfserver_port', 'metrics_out',
+        'profile'])
+
+def get_checkpoint_manifest(args):
+    """Returns description of this run that checkpoints must match to be resumed"""
+    input_stat = os.stat(args.input_file)
+    return {
+            'input_file': os.path.abspath(args.input_file),
+            'input_size': input_stat.st_size,
+            'input_mtime': input_stat.st_mtime,
+            'settings': {k:v for k, v in vars(args).items() if k not in RUNTIME_ARGS},
+            }
+
+def parse_tool_settings(values, value_type):
+    """Returns {tool: value} from TOOL=VALUE strings"""
+    tool_to_value = {}
+    for value in values:
+        if '=' not in value:
+            raise ValueError(f'Tool setting {value} must look like TOOL=VALUE')
+        tool, tool_value = value.split('=', 1)
+        tool_to_value[tool] = value_type(tool_value)
+    return tool_to_value
+
+def get_default_repeat_table(reference_version, compiled=True):
+    """Returns default repeat table fp for given reference.
+
+    If compiled is True and an index has been built for the table, the index is returned"""
     if reference_version.lower() == 'hg38' or reference_version.lower() == 'grch38':
-        return DEFAULT_GRCH38_REPEATS_TABLE
-    if reference_version.lower() == 'hg19' or reference_version.lower() == 'hg37' or reference_version.lower() == 'grch37':
-        return DEFAULT_GRCH37_REPEATS_TABLE
-    raise ValueError('Incompatible reference version for built in repeats table')
+        table_fp = DEFAULT_GRCH38_REPEATS_TABLE
+    elif reference_version.lower() == 'hg19' or reference_version.lower() == 'hg37' or reference_version.lower() == 'grch37':
+        table_fp = DEFAULT_GRCH37_REPEATS_TABLE
+    else:
+        raise ValueError('Incompatible reference version for built in repeats table')
+
+    if compiled and os.path.isfile(get_repeat_index_fp(table_fp)):
+        return get_repeat_index_fp(table_fp)
+    return table_fp
+
+def get_repeat_index_fp(repeat_table_fp):
+    """Returns path of compiled index for the given repeats table"""
+    return os.path.splitext(repeat_table_fp)[0] + '.idx'
+
+def build_repeat_index(args):
+    """Compile repeats table into an index file"""
+    if args.repeats_table is None:
+        repeat_table_fp = get_default_repeat_table(args.reference_version, compiled=False)
+    else:
+        repeat_table_fp = args.repeats_table
+    output_fp = args.output if args.output is not None else get_repeat_index_fp(repeat_table_fp)
+
+    logging.info(f'reading repeats table {repeat_table_fp}')
+    rc = get_repeat_collection(repeat_table_fp)
+    logging.info(f'writing repeat index for {len(rc.repeat_tups)} repeats to {output_fp}')
+    write_repeat_index(rc, output_fp)
 
 def check_transvar_setup(transvar_annotator, reference_version='hg38', reference_fasta=None):
     """Will set up transvar if needed"""
@@ -100,10 +321,10 @@ def check_transvar_setup(transvar_annotator, reference_version='hg38', reference
             tool_args = ['transvar', 'config', '-k', 'reference',
                     '-v', reference_fasta,
                     '--refversion', reference_version]
-        subprocess.check_output(tool_args)
+        tool_runner.check_output(tool_args)
     
         tool_args = ['transvar', 'config', '--download_anno', '--refversion', reference_version]
-        subprocess.check_output(tool_args)
+        tool_runner.check_output(tool_args)
         logging.info('finished transvar setup')
 
 def get_simplified_region(transvar_region):
@@ -125,163 +346,467 @@ def get_simplified_region(transvar_region):
         return 'INTERGENIC'
     return '.'
 
-def annotate_transvar_tsv(transvar_annotator, fp, input_header=False, reference_version='hg38',
-            with_base_change=False):
-    """Annotate transvar tsv"""
-    out_lines = []
-
-    f = open(fp)
-
-    if input_header:
-        out_lines.append(f.readline()[:-1] + '\tPRIMARY_TRANSCRIPT\tGENE\tSTRAND\tCOORDINATES\tREGION\tNON_VERBOSE_REGION\tINFO')
+TRANSVAR_HEADERS = ['PRIMARY_TRANSCRIPT', 'GENE', 'STRAND', 'COORDINATES', 'REGION',
+        'NON_VERBOSE_REGION', 'INFO']
+REPEAT_HEADERS = ['REPEAT_NAME', 'REPEAT_CLASS', 'REPEAT_FAMILY']
 
-    for line in f:
-        pieces = line.strip().split('\t')
+def get_transvar_columns(transvar_annotator, rows, reference_version='hg38',
+            with_base_change=False, chunk_size=1000):
+    """Returns transvar annotation columns for each row"""
+    sites = []
+    for pieces in rows:
         chrom = pieces[0]
         pos = pieces[1]
 
         if with_base_change:
             ref_base, alt_base = pieces[2], pieces[3]
-            transcript, gene, strand, coordinates, region, info = transvar_annotator.get_transcript_gene_strand_region_info_tup(
-                    chrom, pos, reference_version=reference_version, ref_base=ref_base,
-                    alt_base=alt_base)
+            sites.append((chrom, pos, ref_base, alt_base))
         else:
-            transcript, gene, strand, coordinates, region, info = transvar_annotator.get_transcript_gene_strand_region_info_tup(
-                    chrom, pos, reference_version=reference_version)
-
-        simplified_region = get_simplified_region(region)
-
-        out_lines.append(line[:-1] + f'\t{transcript}\t{gene}\t{strand}\t{coordinates}\t{region}\t{simplified_region}\t{info}')
-    f.close()
-
-    output_str = '\n'.join(out_lines) + '\n'
-    # write over old file
-    f = open(fp, 'w')
-    f.write(output_str)
-    f.close()
+            sites.append((chrom, pos))
 
-def annotate_repeats_tsv(repeat_annotator, fp, input_header=False):
-    """Annotate repeats tsv"""
-    out_lines = []
+    logging.info(f'annotating {len(sites)} positions with transvar in chunks of {chunk_size}')
+    tups = transvar_annotator.get_transcript_gene_strand_region_info_tups(sites,
+            reference_version=reference_version, chunk_size=chunk_size)
 
-    f = open(fp)
+    columns = []
+    for transcript, gene, strand, coordinates, region, info in tups:
+        simplified_region = get_simplified_region(region)
+        columns.append([transcript, gene, strand, coordinates, region, simplified_region, info])
 
-    if input_header:
-        out_lines.append(f.readline()[:-1] + '\tREPEAT_NAME\tREPEAT_CLASS\tREPEAT_FAMILY')
+    return columns
 
-    for line in f:
-        pieces = line.strip().split('\t', 2)
-        chrom = pieces [0]
-        pos = pieces[1]
+def get_repeat_columns(repeat_annotator, rows):
+    """Returns repeat annotation columns for each row"""
+    chroms = [pieces[0] for pieces in rows]
+    positions = [pieces[1] for pieces in rows]
 
-        repeat = repeat_annotator.get_repeat_by_position(chrom, pos)
+    repeats = repeat_annotator.get_repeats_by_positions(chroms, positions)
 
+    columns = []
+    for repeat in repeats:
         if repeat is not None:
             repeat_name, repeat_class, repeat_family = repeat
         else:
             repeat_name, repeat_class, repeat_family = '.', '.', '.'
+        columns.append([repeat_name, repeat_class, repeat_family])
+
+    return columns
 
-        out_lines.append(line[:-1] + f'\t{repeat_name}\t{repeat_class}\t{repeat_family}')
-    f.close()
+def get_blat_columns(blat_annotator, rows, input_bam):
+    """Returns blat annotation columns for each row. Each batch of rows is one blat chunk"""
+    chrom_pos_tups = [(pieces[0], pieces[1]) for pieces in rows]
+    reference_bases = [pieces[2] for pieces in rows]
 
-    output_str = '\n'.join(out_lines) + '\n'
-    # write over old file
-    f = open(fp, 'w')
-    f.write(output_str)
-    f.close()
+    blat_annotations_dict, _ = blat_annotator.get_blat_annotations_for_bam(input_bam,
+            chrom_pos_tups, reference_bases=reference_bases)
 
-def annotate_blat_tsv(blat_annotator, fp, input_bam, input_header=False):
-    out_lines = []
-    f = open(fp)
+    return [blat_annotations_dict[chrom_pos] for chrom_pos in chrom_pos_tups]
+
+def fetch_blat_chunk(blat_annotator, rows, input_bam):
+    """Returns rows and the chunk annotator holding their reads"""
+    chrom_pos_tups = [(pieces[0], pieces[1]) for pieces in rows]
+    reference_bases = [pieces[2] for pieces in rows]
+
+    return rows, blat_annotator.fetch_chunk(input_bam, chrom_pos_tups,
+            reference_bases=reference_bases)
+
+def align_blat_chunk(rows_chunk_tup):
+    rows, chunk = rows_chunk_tup
+    return rows, chunk.align_chunk()
+
+def annotate_blat_stage_pipelined(blat_annotator, batches, input_bam, queue_depths=None):
+    """Blat stage where reads for each batch are fetched, aligned and scored in separate
+    threads. While one batch is aligned, reads for the next are fetched and hits of the
+    previous are scored.
+
+    queue_depths - [fetched batches waiting for alignment, aligned batches waiting for scoring]
+    """
+    steps = [functools.partial(metrics.call_in_stage, 'blat_fetch', fetch_blat_chunk,
+                    blat_annotator, input_bam=input_bam),
+            functools.partial(metrics.call_in_stage, 'blat_align', align_blat_chunk)]
+    for rows, chunk in pipeline.run_pipeline(batches, steps, queue_depths=queue_depths):
+        with metrics.stage('blat_score'):
+            annotations_dict, _ = chunk.score_chunk()
+        for row in rows:
+            row.extend(str(c) for c in annotations_dict[(row[0], row[1])])
+        yield rows
+
+def get_blat_columns_in_worker(rows, input_bam):
+    """get_blat_columns with the annotator owned by the current pool worker.
+
+    Returns columns, and metrics recorded by the worker for this batch"""
+    with metrics.stage('blat'):
+        columns = get_blat_columns(blat.get_worker_annotator(), rows, input_bam)
+    metrics.dump_profiles(suffix=f'.{os.getpid()}')
+
+    return columns, metrics.pop_snapshot()
+
+def read_row_batches(f, batch_size=1000):
+    """Yields batches of up to batch_size rows from f. Rows are lists of tab seperated fields"""
+    rows = []
+    for line in f:
+        rows.append(line.rstrip('\n').split('\t'))
+        if len(rows) >= batch_size:
+            yield rows
+            rows = []
+    if rows:
+        yield rows
+
+def annotate_stage(get_columns, batches):
+    """Pipeline stage. Consumes row batches and yields them with the columns returned by
+    get_columns(rows) appended to each row"""
+    for rows in batches:
+        for row, columns in zip(rows, get_columns(rows)):
+            row.extend(str(c) for c in columns)
+        yield rows
+
+def annotate_stage_in_pool(pool, get_columns, batches, max_pending=2):
+    """Like annotate_stage, but get_columns runs in pool worker processes.
+
+    get_columns must return the columns and a metrics snapshot from the worker, see
+    get_blat_columns_in_worker. Up to max_pending batches are in flight at a time, and batches
+    are yielded in the order they were consumed"""
+    def get_annotated_rows(rows, result):
+        columns_list, snapshot = result.get()
+        metrics.merge(snapshot)
+        for row, columns in zip(rows, columns_list):
+            row.extend(str(c) for c in columns)
+        return rows
+
+    pending = collections.deque()
+    for rows in batches:
+        pending.append((rows, pool.apply_async(get_columns, (rows,))))
+        if len(pending) >= max_pending:
+            yield get_annotated_rows(*pending.popleft())
+
+    while pending:
+        yield get_annotated_rows(*pending.popleft())
+
+def join_stage_batches(batches, stage_batches):
+    """Yields each batch in batches with the columns each stage added to its own copy of the
+    batch appended, in stage order
+
+    stage_batches - [annotated batches, ...] for each stage. Batches must line up with batches"""
+    for rows, *annotated_rows_list in zip(batches, *stage_batches):
+        n_fields = [len(row) for row in rows]
+        for annotated_rows in annotated_rows_list:
+            for row, n, annotated_row in zip(rows, n_fields, annotated_rows):
+                row.extend(annotated_row[n:])
+        yield rows
+
+def open_input(input_fp, input_header=False):
+    """Returns input file, positioned after the header if there is one"""
+    f = open(input_fp)
     if input_header:
         f.readline()
-    chrom_pos_tups = []
-    reference_bases = []
-    for line in f:
-        chrom, pos, base = line.strip().split('\t', 3)[:3]
-        chrom_pos_tups.append((chrom, pos))
-        reference_bases.append(base)
-    f.close()
-
-    # chunk into 5000 position pieces
-    chunk_size = 1000
-    chunked_chrom_pos_tups = []
-    chunked_reference_bases = []
-    prev = 0
-    logging.info(f'starting processing of {len(chrom_pos_tups)} total positions')
-    logging.info(f'using chunk size of {chunk_size}')
-    for i in range(chunk_size, len(chrom_pos_tups) + chunk_size, chunk_size):
-        chunked_chrom_pos_tups.append(chrom_pos_tups[prev:i])
-        chunked_reference_bases.append(reference_bases[prev:i])
-        prev = i
-    
-    blat_annotations_dict = {}
-    headers = []
-    for i, (chrom_pos_chunk, reference_bases_chunk) in enumerate(zip(
-            chunked_chrom_pos_tups, chunked_reference_bases)):
-        if chrom_pos_chunk and reference_bases_chunk:
-            logging.info(f'processing chunk {i + 1} of {len(chunked_chrom_pos_tups)}')
-            d, h = blat_annotator.get_blat_annotations_for_bam(input_bam, chrom_pos_chunk,
-                    reference_bases=reference_bases_chunk)
-            blat_annotations_dict.update(d)
-            headers = h
-
-    f = open(fp)
+    return f
+
+def annotate_tsv(input_fp, output_fp, stages, input_header=False, batch_size=1000,
+        concurrent=False, queue_depth=2, checkpoint_dir=None):
+    """Stream input tsv through annotation stages and into output tsv.
+
+    stages - [(headers, annotate_batches), ...] in output column order. annotate_batches takes
+        an iterable of row batches and yields them with columns added to each row, see
+        annotate_stage
+    checkpoint_dir - checkpoints.CheckpointDir. If present, each annotated batch is saved to it
+        as it finishes and batches it already holds are skipped. Output is written from the
+        saved batches once all are finished
+
+    Input is read once and output is written once, and no more than batch_size rows are held
+    in memory at a time.
+
+    If concurrent, each stage instead reads its own copy of the input and runs in its own
+    thread, holding up to queue_depth annotated batches until the other stages catch up."""
+    def read_input_batches(f):
+        batches = read_row_batches(f, batch_size=batch_size)
+        if checkpoint_dir is not None:
+            batches = checkpoint_dir.skip_finished(batches)
+        return batches
+
+    f = open(input_fp)
+
+    header = None
     if input_header:
-        out_lines.append(f.readline()[:-1] + '\t' + '\t'.join(headers))
-
-    for i, line in enumerate(f):
-        chrom, pos = chrom_pos_tups[i]
-        annotations = blat_annotations_dict[(chrom, pos)]
-        out_lines.append(line[:-1] + '\t' + '\t'.join([str(a) for a in annotations]))
-    f.close()
-
-    output_str = '\n'.join(out_lines) + '\n'
-    # write over old file
-    f = open(fp, 'w')
-    f.write(output_str)
-    f.close()
-
-def main():
-    check_arguments()
-
-    # create our output file
-    f = open(args.input_file)
-    out_f = open(args.output, 'w')
-    out_f.write(f.read())
-    f.close()
-    out_f.close()
-
-    # index reference if it's there
-    if args.reference_fasta is not None:
-        bam_utils.index_reference(args.reference_fasta)
-
-    if args.annotate_transvar:
-        logging.info('Beginning transvar annotations')
-        if args.primary_transcripts is None:
-            ta = TransvarAnnotator(DEFAULT_GENE_TO_PRIMARY_TRANSCRIPT)
-        else:
-            ta = TransvarAnnotator(args.primary_transcripts)
-        check_transvar_setup(ta, reference_version=args.reference_version,
-                reference_fasta=args.reference_fasta)
-        annotate_transvar_tsv(ta, args.output, input_header=args.input_header,
-                reference_version=args.reference_version, with_base_change=args.with_base_change)
-
-    if args.annotate_repeats:
-        logging.info('Begginging repeat annotations')
-        if args.repeats_table is None:
-            ra = RepeatAnnotator(get_default_repeat_table(args.reference_version))
+        header = f.readline().rstrip('\n').split('\t')
+        for headers, _ in stages:
+            header += headers
+
+    batches = read_input_batches(f)
+    stage_fs = []
+    stage_batches = []
+    if concurrent:
+        for _, annotate_batches in stages:
+            stage_fs.append(open_input(input_fp, input_header=input_header))
+            stage_batches.append(pipeline.iter_in_thread(annotate_batches(
+                    read_input_batches(stage_fs[-1])), queue_depth=queue_depth))
+        batches = join_stage_batches(batches, stage_batches)
+    else:
+        for _, annotate_batches in stages:
+            batches = annotate_batches(batches)
+
+    def count_positions(batches):
+        for rows in batches:
+            metrics.increment('positions', len(rows))
+            yield rows
+    batches = count_positions(batches)
+
+    n = 0
+    try:
+        if checkpoint_dir is None:
+            out_f = open(output_fp, 'w')
+            if header is not None:
+                out_f.write('\t'.join(header) + '\n')
+            for rows in batches:
+                out_f.write(''.join('\t'.join(row) + '\n' for row in rows))
+                n += len(rows)
+                logging.info(f'wrote {n} annotated rows')
+            out_f.close()
         else:
-            ra = RepeatAnnotator(args.repeats_table)
-        annotate_repeats_tsv(ra, args.output, input_header=args.input_header)
-
-    if args.annotate_blat:
-        logging.info('Beginning blat annotations')
-        ba = BlatAnnotator(['rna_editing'],
-                database=args.reference_fasta,
-                rna_editing_percent_threshold=args.rna_editing_percent_threshold)
-        annotate_blat_tsv(ba, args.output, args.blat_input_bam,
-                input_header=args.input_header)
+            for index, rows in zip(checkpoint_dir.iter_unfinished_indices(), batches):
+                checkpoint_dir.write_batch(index, rows)
+                n += len(rows)
+                logging.info(f'checkpointed {n} annotated rows')
+            logging.info(f'writing output from checkpoints in {checkpoint_dir.checkpoint_dir}')
+            checkpoint_dir.write_output(output_fp, header=header)
+    finally:
+        # if a stage failed, the others stop instead of waiting on a join that won't come
+        for stage in stage_batches:
+            stage.close()
+        f.close()
+        for stage_f in stage_fs:
+            stage_f.close()
+
+class AnnotationSession(object):
+    def __init__(self, config):
+        """Annotators for the given settings, set up once and reused for every batch annotated
+        with them. Repeat tables stay loaded, transvar stays configured, and the gfServer and
+        blat worker processes stay up until close.
+
+        config - settings from get_config, or parsed command line arguments"""
+        self.config = config
+        tool_runner.configure(limits=parse_tool_settings(config.tool_limit, int),
+                timeouts=parse_tool_settings(config.tool_timeout, float))
+
+        # index reference if it's there
+        if config.reference_fasta is not None:
+            bam_utils.index_reference(config.reference_fasta)
+
+        # annotations are only for one batch at a time
+        self.lock = threading.Lock()
+
+        self.stages = []
+        self.cache = None
+        self.transvar_annotator = None
+        if config.annotate_transvar:
+            primary_transcripts = config.primary_transcripts
+            if primary_transcripts is None:
+                primary_transcripts = DEFAULT_GENE_TO_PRIMARY_TRANSCRIPT
+            if config.gtf is not None:
+                logging.info('Setting up gtf annotations')
+                ta = GtfAnnotator(config.gtf, primary_transcripts)
+                stage_name = 'gtf'
+            else:
+                logging.info('Setting up transvar annotations')
+                if config.transvar_cache is not None:
+                    self.cache = TransvarCache(config.transvar_cache,
+                            max_entries=config.transvar_cache_max_entries)
+                ta = TransvarAnnotator(primary_transcripts, cache=self.cache)
+                check_transvar_setup(ta, reference_version=config.reference_version,
+                        reference_fasta=config.reference_fasta)
+                stage_name = 'transvar'
+            get_columns = functools.partial(get_transvar_columns, ta,
+                    reference_version=config.reference_version,
+                    with_base_change=config.with_base_change,
+                    chunk_size=config.transvar_chunk_size)
+            get_columns = functools.partial(metrics.call_in_stage, stage_name, get_columns)
+            self.stages.append((TRANSVAR_HEADERS, functools.partial(annotate_stage, get_columns)))
+            self.transvar_annotator = ta
+
+        self.repeat_annotator = None
+        if config.annotate_repeats:
+            logging.info('Setting up repeat annotations')
+            if config.repeats_table is None:
+                ra = RepeatAnnotator(get_default_repeat_table(config.reference_version))
+            else:
+                ra = RepeatAnnotator(config.repeats_table)
+            get_columns = functools.partial(metrics.call_in_stage, 'repeats',
+                    get_repeat_columns, ra)
+            self.stages.append((REPEAT_HEADERS, functools.partial(annotate_stage, get_columns)))
+            self.repeat_annotator = ra
+
+        self.gfserver = None
+        self.pool = None
+        self.blat_annotator = None
+        if config.annotate_blat:
+            logging.info('Setting up blat annotations')
+            if config.blat_backend == 'gfserver':
+                self.gfserver = GfServer(config.reference_fasta, port=config.gfserver_port)
+            blat_annotator_kwargs = {
+                    'annotations': ['rna_editing'],
+                    'database': config.reference_fasta,
+                    'rna_editing_percent_threshold': config.rna_editing_percent_threshold,
+                    'blat_workers': config.blat_workers,
+                    'gfclient': self.gfserver.client if self.gfserver is not None else None,
+                    'bam_reader': config.bam_reader,
+                    'max_depth': config.max_depth,
+                    'sampling_seed': config.sampling_seed,
+                    'approximate': config.blat_approximate,
+                    'ci_width': config.blat_ci_width,
+                    'decision_threshold': config.blat_decision_threshold,
+                    'round_size': config.blat_round_size,
+                    'confidence': config.blat_confidence,
+                    }
+            self.blat_annotator = BlatAnnotator(**blat_annotator_kwargs)
+            if config.workers > 1:
+                logging.info(f'annotating blat chunks in {config.workers} worker processes')
+                # the tool runner loop is already running in a thread here, and forking a process
+                # with running threads can deadlock the child, so workers come from a forkserver
+                context = multiprocessing.get_context('forkserver')
+                self.pool = context.Pool(config.workers, initializer=blat.init_worker,
+                        initargs=(blat_annotator_kwargs, dict(tool_runner.tool_limits),
+                            dict(tool_runner.tool_timeouts), metrics.profile_dir))
+
+    def get_headers(self):
+        """Returns headers of the columns added to each row"""
+        headers = [header for headers, _ in self.stages for header in headers]
+        if self.blat_annotator is not None:
+            headers += self.blat_annotator.get_headers()
+        return headers
+
+    def get_stages(self, blat_input_bam=None):
+        """Returns [(headers, annotate_batches), ...] for the enabled annotators, see
+        annotate_tsv.
+
+        blat_input_bam - bam for blat annotations. Defaults to blat_input_bam of config"""
+        stages = list(self.stages)
+        if self.blat_annotator is not None:
+            if blat_input_bam is None:
+                blat_input_bam = self.config.blat_input_bam
+            if blat_input_bam is None:
+                raise ValueError('blat annotations need an input bam')
+
+            if self.pool is not None:
+                get_columns = functools.partial(get_blat_columns_in_worker,
+                        input_bam=blat_input_bam)
+                stages.append((self.blat_annotator.get_headers(), functools.partial(
+                        annotate_stage_in_pool, self.pool, get_columns,
+                        max_pending=2 * self.config.workers)))
+            else:
+                stages.append((self.blat_annotator.get_headers(), functools.partial(
+                        annotate_blat_stage_pipelined, self.blat_annotator,
+                        input_bam=blat_input_bam, queue_depths=[
+                        self.config.blat_fetch_queue_depth, self.config.blat_align_queue_depth])))
+
+        return stages
+
+    def annotate(self, rows, blat_input_bam=None):
+        """Returns copies of rows with annotation columns appended.
+
+        rows - lists of fields, starting with chrom, pos, and the reference base if annotating
+            with blat or with --with-base-change
+        blat_input_bam - bam for blat annotations. Defaults to blat_input_bam of config"""
+        rows = [[str(field) for field in row] for row in rows]
+        batch_size = self.config.batch_size
+        batches = [rows[i:i + batch_size] for i in range(0, len(rows), batch_size)]
+        if not batches:
+            return []
+
+        with self.lock:
+            for _, annotate_batches in self.get_stages(blat_input_bam):
+                batches = annotate_batches(batches)
+
+            return [row for rows in batches for row in rows]
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        if self.gfserver is not None:
+            self.gfserver.stop()
+            self.gfserver = None
+
+# sessions by config, kept for later calls to annotate with the same settings
+sessions = {}
+sessions_lock = threading.Lock()
+
+def get_session(config):
+    """Returns AnnotationSession for config, setting one up on first use"""
+    key = json.dumps(vars(config), sort_keys=True)
+    with sessions_lock:
+        if key not in sessions:
+            sessions[key] = AnnotationSession(config)
+        return sessions[key]
+
+def close_sessions():
+    with sessions_lock:
+        for session in sessions.values():
+            session.close()
+        sessions.clear()
+
+atexit.register(close_sessions)
+
+def annotate(rows, config):
+    """Returns copies of rows with columns from the annotators enabled in config appended.
+
+    rows - lists of fields, starting with chrom, pos, and the reference base if annotating with
+        blat or with --with-base-change
+    config - settings from get_config
+
+    Annotators are set up on the first call with a config and reused by later calls with the
+    same config. Column headers are get_session(config).get_headers()"""
+    return get_session(config).annotate(rows)
+
+def run_annotation(args):
+    """Annotate input file with the enabled annotators"""
+    session = AnnotationSession(args)
+    try:
+        checkpoint_dir = None
+        if args.checkpoint_dir is not None:
+            checkpoint_dir = checkpoints.CheckpointDir(args.checkpoint_dir,
+                    get_checkpoint_manifest(args), resume=args.resume)
+
+        logging.info(f'annotating {args.input_file} in batches of {args.batch_size} rows')
+        annotate_tsv(args.input_file, args.output, session.get_stages(),
+                input_header=args.input_header, batch_size=args.batch_size,
+                concurrent=args.concurrent_annotators, queue_depth=args.annotator_queue_depth,
+                checkpoint_dir=checkpoint_dir)
+    finally:
+        session.close()
+    tool_runner.log_timings()
+
+def serve(args):
+    """Annotate batches sent to a unix socket with warm annotators until stopped"""
+    session = AnnotationSession(args)
+    try:
+        daemon.serve(args.socket, session)
+    finally:
+        session.close()
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == BUILD_REPEAT_INDEX_COMMAND:
+        build_repeat_index(args)
+        return
+    if args.command == SERVE_COMMAND:
+        serve(args)
+        return
+
+    check_arguments(args)
+    if args.profile is not None:
+        metrics.enable_profiling(args.profile)
+
+    start = time.time()
+    try:
+        run_annotation(args)
+    finally:
+        # written for failed runs too, to help find where they went wrong
+        metrics.dump_profiles()
+        if args.metrics_out is not None:
+            metrics.write_metrics(args.metrics_out, time.time() - start)
 
 if __name__ == '__main__':
     main()
@@ -1,7 +1,15 @@
+import functools
 import logging
 import os
+import random
 import re
-import subprocess
+import uuid
+
+import numpy as np
+import pysam
+
+import metrics
+import tool_runner
 
 logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.INFO)
 
@@ -15,13 +23,19 @@ def index_reference(reference_fasta_fp):
     """index the given reference if it doesnt exist"""
     if not os.path.isfile(reference_fasta_fp + '.fai'):
         tool_args = ['samtools', 'faidx', reference_fasta_fp]
-        print(subprocess.check_output(tool_args).decode('utf-8'))
+        print(tool_runner.check_output(tool_args))
+
+def index_bam(bam_fp, reader='pysam'):
+    """index the given bam.
 
-def index_bam(bam_fp):
-    """index the given bam."""
+    reader - pysam or samtools. Index with pysam unless reads will be piped from samtools, so
+        samtools is only needed when it is used"""
     if not os.path.isfile(bam_fp + '.bai'):
-        tool_args = ['samtools', 'index', bam_fp]
-        print(subprocess.check_output(tool_args).decode('utf-8'))
+        if reader == 'samtools':
+            tool_args = ['samtools', 'index', bam_fp]
+            print(tool_runner.check_output(tool_args))
+        else:
+            pysam.index(bam_fp)
 
 def filter_bam_by_positions(bam_fp, positions_fp, output_fp, threads=1):
     """run bam filter step"""
@@ -31,152 +45,268 @@ def filter_bam_by_positions(bam_fp, positions_fp, output_fp, threads=1):
             '-o', output_fp,
             bam_fp]
 
-    print(subprocess.check_output(tool_args).decode('utf-8'))
+    print(tool_runner.check_output(tool_args))
 
-def get_covering_reference_coords(start, cigar, seq):
-    ref_end = int(start)
-    counts = re.split(IDENTIFIER_SPLIT_REGEX, cigar)[:-1]
-    identifiers = re.split(COUNT_SPLIT_REGEX, cigar)[1:]
+CIGAR_OPERATIONS = 'MIDNSHP=X'
+BOTH_COUNT_CODES = [CIGAR_OPERATIONS.index(op) for op in sorted(BOTH_COUNTS)]
+REFERENCE_COUNT_CODES = [CIGAR_OPERATIONS.index(op) for op in sorted(REFERENCE_COUNTS)]
+READ_COUNT_CODES = [CIGAR_OPERATIONS.index(op) for op in sorted(READ_COUNTS)]
 
-    for count, identifier in zip(counts, identifiers):
-        ref_end += int(count)
+class ParsedCigar(object):
+    def __init__(self, operations, lengths):
+        """Cigar parsed into operation and length arrays.
 
-    return int(start), ref_end - 1
+        operations - operation codes, indices into CIGAR_OPERATIONS (same as pysam)
+        lengths - length of each operation
 
-def count_mismatches(cigar, read_seq, reference_seq):
-    read_counter = 0
-    ref_counter = 0
+        Reference and read offsets of each operation are computed once up front. The aligned
+        (M, X, =) blocks are kept seperately so reference offsets can be mapped to read offsets
+        with a binary search."""
+        self.operations = np.asarray(operations, dtype=np.uint8)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
 
-    counts = [int(c) for c in re.split(IDENTIFIER_SPLIT_REGEX, cigar)[:-1]]
-    identifiers = re.split(COUNT_SPLIT_REGEX, cigar)[1:]
+        is_aligned = np.isin(self.operations, BOTH_COUNT_CODES)
+        consumes_reference = is_aligned | np.isin(self.operations, REFERENCE_COUNT_CODES)
+        consumes_read = is_aligned | np.isin(self.operations, READ_COUNT_CODES)
 
-    mismatches = 0
-    for count, identifier in zip(counts, identifiers):
-        if identifier in BOTH_COUNTS:
-            read_nucleotides = read_seq[read_counter:read_counter + count].lower()
-            ref_nucleotides = reference_seq[ref_counter:ref_counter + count].lower()
-            for read_base, ref_base in zip(read_nucleotides, ref_nucleotides):
-                if read_base != ref_base:
-                    mismatches += 1
-
-            read_counter += count
-            ref_counter += count
-
-        elif identifier in REFERENCE_COUNTS:
-            ref_counter += count
-        elif identifier in READ_COUNTS:
-            read_counter += count
+        self.reference_offsets = np.cumsum(self.lengths * consumes_reference) - \
+                self.lengths * consumes_reference
+        self.read_offsets = np.cumsum(self.lengths * consumes_read) - self.lengths * consumes_read
+        self.total_length = int(self.lengths.sum())
 
-    return mismatches
+        self.block_reference_starts = self.reference_offsets[is_aligned]
+        self.block_read_starts = self.read_offsets[is_aligned]
+        self.block_lengths = self.lengths[is_aligned]
 
-def is_valid_rna_editing_site(start, target_pos, cigar, read_seq, reference_seq, strand):
-    read_counter = 0
-    ref_counter = 0
+    def get_read_offset(self, reference_offset):
+        """Returns offset into read sequence aligned to the given offset from alignment start.
+
+        None if the reference offset doesn't fall in an aligned block"""
+        i = np.searchsorted(self.block_reference_starts, reference_offset, side='right') - 1
+        if i >= 0 and reference_offset < self.block_reference_starts[i] + self.block_lengths[i]:
+            return int(self.block_read_starts[i] + reference_offset - self.block_reference_starts[i])
+        return None
 
+@functools.lru_cache(maxsize=100000)
+def parse_cigar(cigar):
+    """Returns ParsedCigar for the given cigar string. Cigars are cached since most reads in a
+    bam share a handful of them"""
     counts = [int(c) for c in re.split(IDENTIFIER_SPLIT_REGEX, cigar)[:-1]]
     identifiers = re.split(COUNT_SPLIT_REGEX, cigar)[1:]
 
-    mismatches = 0
-    for count, identifier in zip(counts, identifiers):
-        if identifier in BOTH_COUNTS:
-            for i in range(count):
-                if start + i + ref_counter == target_pos:
-                    if (read_seq[read_counter + i].lower(),
-                            reference_seq[ref_counter + i].lower()) in VALID_RNA_EDITING_CHANGES[strand]:
-                        return True
-                    else:
-                        return False
-            read_counter += count
-            ref_counter += count
-
-        elif identifier in REFERENCE_COUNTS:
-            ref_counter += count
-
-        elif identifier in READ_COUNTS:
-            read_counter += count
-
-    return None
+    return ParsedCigar([CIGAR_OPERATIONS.index(identifier) for identifier in identifiers], counts)
 
-def is_match(start, target_pos, cigar, read_seq, reference_seq):
-    read_counter = 0
-    ref_counter = 0
+def get_read_offsets_by_position(starts, target_positions, parsed_cigars):
+    """Map target positions into many reads at once.
 
-    counts = [int(c) for c in re.split(IDENTIFIER_SPLIT_REGEX, cigar)[:-1]]
-    identifiers = re.split(COUNT_SPLIT_REGEX, cigar)[1:]
+    starts - alignment start of each read
+    target_positions - reference position to map for each read, or a single position for all
+    parsed_cigars - ParsedCigar for each read
 
-    mismatches = 0
-    for count, identifier in zip(counts, identifiers):
-        if identifier in BOTH_COUNTS:
-            for i in range(count):
-                if start + i + ref_counter == target_pos:
-                    if read_seq[read_counter + i].lower() == reference_seq[ref_counter + i].lower():
-                        return True
-                    else:
-                        return False
-            read_counter += count
-            ref_counter += count
+    Returns array with offset into each read's sequence aligned to its target position, -1 if
+    the target position doesn't fall in an aligned block of the read"""
+    n_reads = len(parsed_cigars)
+    offsets = np.full(n_reads, -1, dtype=np.int64)
+    if n_reads == 0:
+        return offsets
 
-        elif identifier in REFERENCE_COUNTS:
-            ref_counter += count
+    block_counts = [len(pc.block_lengths) for pc in parsed_cigars]
+    read_ids = np.repeat(np.arange(n_reads), block_counts)
+    block_starts = np.concatenate([pc.block_reference_starts for pc in parsed_cigars]) + \
+            np.asarray(starts, dtype=np.int64)[read_ids]
+    block_lengths = np.concatenate([pc.block_lengths for pc in parsed_cigars])
+    block_read_starts = np.concatenate([pc.block_read_starts for pc in parsed_cigars])
+    targets = np.broadcast_to(np.asarray(target_positions, dtype=np.int64), (n_reads,))[read_ids]
 
-        elif identifier in READ_COUNTS:
-            read_counter += count
+    # aligned blocks of a read don't overlap, so at most one block per read is hit
+    is_hit = (block_starts <= targets) & (targets < block_starts + block_lengths)
+    offsets[read_ids[is_hit]] = block_read_starts[is_hit] + targets[is_hit] - block_starts[is_hit]
 
-    return None
+    return offsets
 
-def get_base_by_position(start, target_pos, cigar, read_seq):
-    read_counter = 0
-    ref_counter = 0
+def get_bases_by_position(starts, target_positions, cigars, read_seqs):
+    """Batch version of get_base_by_position. Returns base or None for each read"""
+    offsets = get_read_offsets_by_position(starts, target_positions,
+            [parse_cigar(cigar) for cigar in cigars])
 
-    counts = [int(c) for c in re.split(IDENTIFIER_SPLIT_REGEX, cigar)[:-1]]
-    identifiers = re.split(COUNT_SPLIT_REGEX, cigar)[1:]
+    return [read_seq[offset] if offset >= 0 else None
+            for read_seq, offset in zip(read_seqs, offsets)]
+
+def get_covering_reference_coords(start, cigar, seq):
+    return int(start), int(start) + parse_cigar(cigar).total_length - 1
+
+def count_mismatches(cigar, read_seq, reference_seq):
+    parsed_cigar = parse_cigar(cigar)
+
+    mismatches = 0
+    for ref_counter, read_counter, count in zip(parsed_cigar.block_reference_starts.tolist(),
+            parsed_cigar.block_read_starts.tolist(), parsed_cigar.block_lengths.tolist()):
+        read_nucleotides = read_seq[read_counter:read_counter + count].lower()
+        ref_nucleotides = reference_seq[ref_counter:ref_counter + count].lower()
+        for read_base, ref_base in zip(read_nucleotides, ref_nucleotides):
+            if read_base != ref_base:
+                mismatches += 1
+
+    return mismatches
+
+def is_valid_rna_editing_site(start, target_pos, cigar, read_seq, reference_seq, strand):
+    read_offset = parse_cigar(cigar).get_read_offset(target_pos - start)
+    if read_offset is None:
+        return None
 
-    for count, identifier in zip(counts, identifiers):
-        if identifier in BOTH_COUNTS:
-            for i in range(count):
-                if start + i + ref_counter == target_pos:
-                    return read_seq[read_counter + i]
-            read_counter += count
-            ref_counter += count
+    return (read_seq[read_offset].lower(),
+            reference_seq[target_pos - start].lower()) in VALID_RNA_EDITING_CHANGES[strand]
 
-        elif identifier in REFERENCE_COUNTS:
-            ref_counter += count
+def is_match(start, target_pos, cigar, read_seq, reference_seq):
+    read_offset = parse_cigar(cigar).get_read_offset(target_pos - start)
+    if read_offset is None:
+        return None
 
-        elif identifier in READ_COUNTS:
-            read_counter += count
+    return read_seq[read_offset].lower() == reference_seq[target_pos - start].lower()
 
-    return None
+def get_base_by_position(start, target_pos, cigar, read_seq):
+    read_offset = parse_cigar(cigar).get_read_offset(target_pos - start)
+    if read_offset is None:
+        return None
+
+    return read_seq[read_offset]
 
 class ReadCollection(object):
-    def __init__(self, position_tups):
+    def __init__(self, position_tups, max_depth=None, seed=None, position_to_reference_base=None):
         """
         position tups - [(chrom, pos), ...]
+        max_depth - max reads kept per position. Once a position has seen more reads than this,
+            a uniform random sample of max_depth of them is kept with reservoir sampling
+        seed - seed for reservoir sampling
+        position_to_reference_base - {(chrom, pos): base}. If present, only reads with a base
+            other than the reference base at a position are kept for it
+
+        Positions are kept per chrom in sorted numpy arrays, so the positions covered by a read
+        are found with two binary searches.
         """
-        position_tups = [(c, int(p)) for c, p in position_tups]
-        self.positions = sorted(position_tups, key=lambda x: (x[0], x[1]))
-
-        self.chrom_to_positions = {c:[] for c, _ in position_tups}
+        chrom_to_positions = {}
         for chrom, pos in position_tups:
-            self.chrom_to_positions[chrom].append((chrom, pos))
-        for chrom, ps in self.chrom_to_positions.items():
-            self.chrom_to_positions[chrom] = sorted(ps, key=lambda x: (x[0], x[1]))
+            chrom_to_positions.setdefault(chrom, set()).add(int(pos))
+
+        self.chrom_to_positions = {chrom:np.asarray(sorted(ps), dtype=np.int64)
+                for chrom, ps in chrom_to_positions.items()}
+        self.positions = sorted((chrom, pos) for chrom, ps in chrom_to_positions.items()
+                for pos in ps)
+
+        self.position_to_reads = {p:[] for p in self.positions}
+
+        self.max_depth = max_depth
+        self.random = random.Random(seed)
+        self.position_to_reference_base = position_to_reference_base
+        # number of reads covering each position, and number of those offered to sampling
+        # after reference base filtering
+        self.position_to_coverage = {p:0 for p in self.positions}
+        self.position_to_depth = {p:0 for p in self.positions}
+
+    def get_covered_position_bounds(self, chrom, starts, ends):
+        """Returns lo, hi index arrays into chrom positions for the given read spans.
+
+        Only positions strictly inside a read's span are counted as covered"""
+        positions = self.chrom_to_positions[chrom]
+        return (np.searchsorted(positions, starts, side='right'),
+                np.searchsorted(positions, ends, side='left'))
+
+    def add_read_to_position(self, position, read_tup):
+        """Add read to position, keeping a uniform sample of max_depth reads (algorithm R)"""
+        self.position_to_depth[position] += 1
+        reads = self.position_to_reads[position]
+        if self.max_depth is None or len(reads) < self.max_depth:
+            reads.append(read_tup)
+        else:
+            i = self.random.randrange(self.position_to_depth[position])
+            if i < self.max_depth:
+                reads[i] = read_tup
 
-        self.position_to_reads = {p:[] for p in position_tups}
+    def put_read(self, chrom, start, cigar, sequence, end=None, **kwargs):
+        """
+        end - covering reference end of read, as returned by get_covering_reference_coords. Will
+            be calculated from cigar if not given
+        """
+        if chrom not in self.chrom_to_positions:
+            return
 
-    def put_read(self, chrom, start, cigar, sequence, **kwargs):
-        start, end = get_covering_reference_coords(int(start), cigar, sequence)
+        if end is None:
+            start, end = get_covering_reference_coords(int(start), cigar, sequence)
         start, end = int(start), int(end)
 
-        for chrom, pos in self.chrom_to_positions[chrom]:
-            if pos > start and pos < end:
-                self.position_to_reads[(chrom, pos)].append((chrom, start, cigar, sequence, kwargs))
-
-            if pos > end:
-                break
+        lo, hi = self.get_covered_position_bounds(chrom, start, end)
+        for pos in self.chrom_to_positions[chrom][lo:hi]:
+            pos = int(pos)
+            self.position_to_coverage[(chrom, pos)] += 1
+            if self.position_to_reference_base is not None and not is_alternate_base(start, pos,
+                    cigar, sequence, self.position_to_reference_base.get((chrom, pos))):
+                continue
+            self.add_read_to_position((chrom, pos), (chrom, start, cigar, sequence, kwargs))
+
+    def put_reads(self, read_tups, batch_size=10000):
+        """Put many reads into collection.
+
+        read_tups - iterable of (chrom, start, cigar, sequence, end). end can be None, see put_read
+
+        Reads are consumed batch_size at a time, and the covered positions for each batch are
+        found with one vectorized search per chrom. Reads not kept for any position are
+        dropped as they stream in.
+
+        Returns number of reads consumed"""
+        n_reads = 0
+        batch = []
+        for read_tup in read_tups:
+            batch.append(read_tup)
+            if len(batch) >= batch_size:
+                self.put_read_batch(batch)
+                n_reads += len(batch)
+                batch = []
+        self.put_read_batch(batch)
+        n_reads += len(batch)
+
+        return n_reads
+
+    def put_read_batch(self, read_tups):
+        chrom_to_reads = {}
+        for chrom, start, cigar, sequence, end in read_tups:
+            if chrom not in self.chrom_to_positions:
+                continue
+            if end is None:
+                start, end = get_covering_reference_coords(int(start), cigar, sequence)
+            chrom_to_reads.setdefault(chrom, []).append((int(start), cigar, sequence, int(end)))
+
+        for chrom, reads in chrom_to_reads.items():
+            positions = self.chrom_to_positions[chrom]
+            los, his = self.get_covered_position_bounds(chrom,
+                    [start for start, _, _, _ in reads], [end for _, _, _, end in reads])
+
+            # (read, position) pairs in stream order
+            pair_reads = [read for read, lo, hi in zip(reads, los, his) for _ in range(lo, hi)]
+            pair_positions = np.concatenate([positions[lo:hi] for lo, hi in zip(los, his)]) \
+                    if pair_reads else []
+
+            is_kept = [True] * len(pair_reads)
+            if self.position_to_reference_base is not None and pair_reads:
+                offsets = get_read_offsets_by_position([start for start, _, _, _ in pair_reads],
+                        pair_positions, [parse_cigar(cigar) for _, cigar, _, _ in pair_reads])
+                is_kept = [is_different_base(sequence, offset,
+                        self.position_to_reference_base.get((chrom, int(pos))))
+                        for (_, _, sequence, _), pos, offset
+                        in zip(pair_reads, pair_positions, offsets)]
+
+            for (start, cigar, sequence, _), pos, keep in zip(pair_reads, pair_positions, is_kept):
+                self.position_to_coverage[(chrom, int(pos))] += 1
+                if keep:
+                    self.add_read_to_position((chrom, int(pos)),
+                            (chrom, start, cigar, sequence, {}))
 
     def get_reads(self, chrom, pos):
         return self.position_to_reads.get((chrom, pos), [])
 
+    def get_covered_positions(self):
+        """Returns positions covered by at least one read, whether or not it was kept"""
+        return set(p for p, coverage in self.position_to_coverage.items() if coverage)
+
 
 def get_reads_to_sequences_from_fasta(input_fasta_fp):
     f = open(input_fasta_fp)
@@ -218,75 +348,208 @@ def get_reads_to_sequences_from_fasta_stream(input_fasta_stream):
     return reads_to_sequences
 
 def get_chrom_start_cigar_seq_read_tups(input_bam_fp, positions_fp, max_depth=200):
-    tool_args = ['samtools', 'view',
-            '-L', positions_fp,
-             input_bam_fp]
-    ps_1 = subprocess.Popen(tool_args, stdout=subprocess.PIPE)
-    output = subprocess.check_output(('cut', '-f', '3,4,6,10'), stdin=ps_1.stdout).decode('utf-8')
-    ps_1.wait()
-
-    read_tups = []
-    for line in output.split('\n'):
-        if line:
-            pieces = line.split('\t')
-            chrom, pos, cigar, seq = pieces[0], pieces[1], pieces[2], pieces[3]
-            read_tups.append((chrom, pos, cigar, seq))
-
-    return read_tups
+    """Yields (chrom, start, cigar, seq) for reads in bam overlapping positions in bed.
 
-def write_position_fasta(input_bam_fp, positions_fp, output_fasta_fp, max_depth=200):
-    """Writes a fasta with the given positions and bam.
-
-    Will also return a dict mapping reads to their sequence"""
-    logging.info('writing position fasta')
+    Reads are streamed from samtools view as it produces them"""
     tool_args = ['samtools', 'view',
             '-L', positions_fp,
              input_bam_fp]
-    ps_1 = subprocess.Popen(tool_args, stdout=subprocess.PIPE)
-    output = subprocess.check_output(('cut', '-f', '3,4,6,10'), stdin=ps_1.stdout).decode('utf-8')
-    ps_1.wait()
-    
-    logging.info(f'reading in read tuples')
-    read_tups = []
-    for line in output.split('\n'):
-        if line:
-            pieces = line.split('\t')
-            chrom, pos, cigar, seq = pieces[0], pieces[1], pieces[2], pieces[3]
-            read_tups.append((chrom, pos, cigar, seq))
-
-    # grab positions from file
-    f = open(positions_fp)
-    positions = []
-    for line in f:
-        # line is chrom\tpos....\n
-        pieces = line.strip().split('\t')
-        positions.append((pieces[0], int(pieces[1])))
-    f.close()
-
-    logging.info(f'creating read collection with {len(read_tups)} reads covering {len(positions)} positions')
-    # create read collection
-    rc = ReadCollection(positions)
-    for chrom, start, cigar, seq in read_tups:
-        rc.put_read(chrom, start, cigar, seq)
-
-    logging.info('writing reads data dictionary')
-    f = open(output_fasta_fp, 'w')
+    for line in tool_runner.iter_lines(tool_args):
+        pieces = line.split('\t', 10)
+        chrom, pos, cigar, seq = pieces[2], pieces[3], pieces[5], pieces[9]
+        yield chrom, pos, cigar, seq
+
+def get_position_regions(position_tups, max_gap=100):
+    """Merge positions into sorted, non-overlapping regions for fetching reads.
+
+    Positions on the same chrom within max_gap of each other share a region.
+
+    Returns [(chrom, start, end), ...] with 0-based half open coordinates"""
+    chrom_to_positions = {}
+    for chrom, pos in position_tups:
+        chrom_to_positions.setdefault(chrom, set()).add(int(pos))
+
+    regions = []
+    for chrom, positions in chrom_to_positions.items():
+        positions = sorted(positions)
+        start, end = positions[0] - 1, positions[0]
+        for pos in positions[1:]:
+            if pos - end > max_gap:
+                regions.append((chrom, start, end))
+                start = pos - 1
+            end = pos
+        regions.append((chrom, start, end))
+
+    return regions
+
+def fetch_chrom_start_cigar_seq_end_read_tups(input_bam_fp, position_tups, max_gap=100):
+    """Yields (chrom, start, cigar, seq, end) for each read overlapping the given positions.
+
+    Reads are streamed region by region from the indexed bam with pysam. start is 1-based and
+    end is the covering reference end, as returned by get_covering_reference_coords.
+
+    Each read is yielded once, even if it overlaps more than one region."""
+    bam = pysam.AlignmentFile(input_bam_fp, 'rb')
+    references = set(bam.references)
+
+    prev_chrom, prev_end = None, None
+    for chrom, region_start, region_end in get_position_regions(position_tups, max_gap=max_gap):
+        if chrom not in references:
+            continue
+
+        for read in bam.fetch(chrom, region_start, region_end):
+            # regions are sorted and disjoint, so a read starting before the end of the previous
+            # region on this chrom was already returned for it
+            if chrom == prev_chrom and read.reference_start < prev_end:
+                continue
+            if read.cigartuples is None or read.query_sequence is None:
+                continue
+
+            start = read.reference_start + 1
+            end = start + sum(length for _, length in read.cigartuples) - 1
+            yield chrom, start, read.cigarstring, read.query_sequence, end
+
+        prev_chrom, prev_end = chrom, region_end
+
+    bam.close()
+
+def write_positions_bed(position_tups, output_fp):
+    """Write positions to a bed that will work with samtools -L"""
+    out_f = open(output_fp, 'w')
+    for chrom, pos in position_tups:
+        out_f.write(f'{chrom}\t{pos}\t{pos}\n')
+    out_f.close()
+
+def is_different_base(read_seq, offset, reference_base):
+    """Whether read has a base at offset that is not reference_base"""
+    if reference_base is None or offset is None or offset < 0:
+        return False
+    return read_seq[offset].lower() != reference_base.lower()
+
+def is_alternate_base(start, target_pos, cigar, read_seq, reference_base):
+    """Whether read has an aligned base other than reference_base at target_pos"""
+    return is_different_base(read_seq, parse_cigar(cigar).get_read_offset(target_pos - start),
+            reference_base)
+
+def get_read_collection(input_bam_fp, position_tups, reader='pysam', max_depth=None, seed=None,
+        position_to_reference_base=None):
+    """Returns ReadCollection holding reads in bam covering the given positions.
+
+    position_tups - [(chrom, pos), ...]
+    reader - pysam to fetch reads in process from the indexed bam, or samtools to pipe them from
+        samtools view
+
+    See ReadCollection for max_depth, seed and position_to_reference_base. Reads are streamed
+    into the collection, so only the reads it keeps are held in memory"""
+    positions = [(chrom, int(pos)) for chrom, pos in position_tups]
+    rc = ReadCollection(positions, max_depth=max_depth, seed=seed,
+            position_to_reference_base=position_to_reference_base)
+
+    if reader == 'pysam':
+        n_reads = rc.put_reads(fetch_chrom_start_cigar_seq_end_read_tups(input_bam_fp, positions))
+    else:
+        # create a positions file that will work with samtools
+        u_id = str(uuid.uuid4())
+        temp_positions_fp = f'temp.positions.{u_id}.bed'
+        write_positions_bed(positions, temp_positions_fp)
+        try:
+            n_reads = rc.put_reads((chrom, start, cigar, seq, None) for chrom, start, cigar, seq
+                    in get_chrom_start_cigar_seq_read_tups(input_bam_fp, temp_positions_fp))
+        finally:
+            os.remove(temp_positions_fp)
+
+    logging.info(f'created read collection with {n_reads} reads covering {len(positions)} positions')
+    metrics.increment('reads_fetched', n_reads)
+
+    return rc
+
+def get_reads_to_data(rc, position_tups, max_depth=200):
+    """Returns a dict mapping reads in collection covering the given positions, as chrom:pos|i,
+    to their data.
+
+    Each unique read sequence is assigned a query id, q0, q1, ..., under query, no matter how
+    many positions and reads share it"""
     reads_to_data = {}
-    for chrom, pos in positions:
+    sequence_to_query = {}
+    # duplicate positions would only repeat the same reads
+    for chrom, pos in dict.fromkeys((chrom, int(pos)) for chrom, pos in position_tups):
         reads = rc.get_reads(chrom, pos)
         for i, (read_chrom, read_start, cigar, seq, _) in enumerate(reads):
-            f.write(f'>{chrom}:{pos}|{i}\n')
-            f.write(seq + '\n')
+            if seq not in sequence_to_query:
+                sequence_to_query[seq] = f'q{len(sequence_to_query)}'
 
             reads_to_data[f'{chrom}:{pos}|{i}'] = {
                     'chrom': read_chrom,
                     'start': read_start,
                     'sequence': seq,
-                    'cigar': cigar
+                    'cigar': cigar,
+                    'query': sequence_to_query[seq]
                     }
 
             if i >= max_depth:
                 break
+
+    return reads_to_data
+
+def write_query_fasta(reads_to_data, output_fasta_fp, read_ids=None, skip_queries=None):
+    """Writes the query sequence of each of the given reads to fasta, once per unique query.
+
+    read_ids - reads to write. Defaults to all reads in reads_to_data
+    skip_queries - queries not to write, i.e. ones that have already been aligned
+
+    Returns set of queries written"""
+    if read_ids is None:
+        read_ids = reads_to_data.keys()
+    if skip_queries is None:
+        skip_queries = set()
+
+    f = open(output_fasta_fp, 'w')
+    written_queries = set()
+    n_reads = 0
+    for read_id in read_ids:
+        query = reads_to_data[read_id]['query']
+        if query in skip_queries:
+            continue
+        n_reads += 1
+        if query not in written_queries:
+            written_queries.add(query)
+            f.write(f'>{query}\n')
+            f.write(reads_to_data[read_id]['sequence'] + '\n')
     f.close()
+    # reads whose sequence went to blat, and the unique sequences they were written as
+    metrics.increment('fasta_reads_written', n_reads)
+    metrics.increment('fasta_queries_written', len(written_queries))
+
+    return written_queries
+
+def write_read_collection_fasta(rc, position_tups, output_fasta_fp, max_depth=200):
+    """Writes reads in collection covering the given positions to fasta.
+
+    Each unique read sequence is written once, see get_reads_to_data.
+
+    Returns a dict mapping reads, as chrom:pos|i, to their data. The query the read's sequence
+    was written as is under query"""
+    logging.info('writing reads data dictionary')
+    reads_to_data = get_reads_to_data(rc, position_tups, max_depth=max_depth)
+    written_queries = write_query_fasta(reads_to_data, output_fasta_fp)
+
+    logging.info(f'wrote {len(written_queries)} unique sequences for {len(reads_to_data)} reads')
 
     return reads_to_data
+
+def write_position_fasta(input_bam_fp, position_tups, output_fasta_fp, max_depth=200,
+        reader='pysam', seed=None, position_to_reference_base=None):
+    """Writes a fasta with the given positions and bam.
+
+    position_to_reference_base - {(chrom, pos): base}. If present, only reads with a base other
+        than the reference base at the position are written, since they are the only ones that
+        are informative for rna editing
+
+    See get_read_collection and write_read_collection_fasta for other arguments.
+
+    Will also return a dict mapping reads to their sequence"""
+    logging.info('writing position fasta')
+    rc = get_read_collection(input_bam_fp, position_tups, reader=reader, max_depth=max_depth,
+            seed=seed, position_to_reference_base=position_to_reference_base)
+
+    return write_read_collection_fasta(rc, position_tups, output_fasta_fp, max_depth=max_depth)
@@ -1,9 +1,9 @@
 import os
 import re
-import subprocess
 from collections import defaultdict
 
 import bam_utils
+import tool_runner
 
 ANNOTATION_TO_OUT_FIELDS = {
         'rna_editing': ['qseqid', 'sseqid', 'sstart', 'send', 'qstart', 'qend', 'qlen',
@@ -45,7 +45,7 @@ def execute_blastn(query_fp, database,
             '-max_hsps', str(max_hsps),
             '-outfmt', f'6 {outfmt_str}']
 
-    result = subprocess.check_output(tool_args).decode('utf-8')
+    result = tool_runner.check_output(tool_args)
 
     return result
 
@@ -96,16 +96,7 @@ def prepare_input_files(input_bam_fp, output_fasta_fp, position_tups):
     # index the bam in case it isn't already
     bam_utils.index_bam(input_bam_fp)
 
-    # create a positions file that will work with samtools in case input doesn't
-    temp_positions_fp = 'temp.positions.bed'
-    out_f = open(temp_positions_fp, 'w')
-    for chrom, pos in position_tups:
-        out_f.write(f'{chrom}\t{pos}\t{pos}\n')
-    out_f.close()
-
-    bam_utils.write_position_fasta(input_bam_fp, temp_positions_fp, output_fasta_fp)
-
-    os.remove(temp_positions_fp)
+    bam_utils.write_position_fasta(input_bam_fp, position_tups, output_fasta_fp)
 
 
 class BlastAnnotator(object):
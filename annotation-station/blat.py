@@ -1,11 +1,22 @@
+import atexit
+import copy
 import logging
+import math
 import os
+import random
 import re
+import shutil
+import socket
 import subprocess
+import time
 import uuid
 from collections import defaultdict
 
+import numpy as np
+
 import bam_utils
+import metrics
+import tool_runner
 
 logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.INFO)
 
@@ -40,15 +51,305 @@ def parse_blat_output(output_fp):
 
     return output_dicts
 
-def execute_blat(query_fp, database, out='blast8', output_fp='temp.out'):
-    tool_args = ['blat', database, query_fp,
+# blat hits checked at once by BlatAnnotator.score_hit_groups
+SCORE_BATCH_HITS = 2 ** 16
+
+def normalize_chrom(chrom):
+    return chrom[3:] if chrom.startswith('chr') else chrom
+
+class BlatHits(object):
+    def __init__(self, qseqid):
+        """Hits for one query, held as typed columns rather than a dict per hit"""
+        self.qseqid = qseqid
+        self.chroms = []
+        self.starts = []
+        self.ends = []
+        self.bitscores = []
+
+    def __len__(self):
+        return len(self.bitscores)
+
+    def add(self, sseqid, sstart, send, bitscore):
+        self.chroms.append(normalize_chrom(sseqid))
+        self.starts.append(sstart)
+        self.ends.append(send)
+        self.bitscores.append(bitscore)
+
+def get_positive_rna_counts(hit_query_ids, hit_chrom_ids, hit_starts, hit_ends, hit_bitscores,
+        read_query_ids, read_chrom_ids, read_starts, read_ends, percent_threshold=.95):
+    """is_positive_rna_count for many reads at once.
+
+    hit_* - arrays with a value per blat hit. hits of a query must be in blat output order
+    read_* - arrays with a value per read. read_starts and read_ends are the reference span
+        the read covers
+    Queries and chroms are given as integer ids, with chroms numbered after normalizing away
+    any chr prefix.
+
+    Returns boolean array, True for reads that are positive rna counts. Reads whose query has
+    no hits are False"""
+    n_reads = len(read_query_ids)
+
+    # hits grouped by query, keeping output order within each query
+    order = np.argsort(hit_query_ids, kind='mergesort')
+    hit_query_ids = hit_query_ids[order]
+    first_hits = np.searchsorted(hit_query_ids, read_query_ids, side='left')
+    counts = np.searchsorted(hit_query_ids, read_query_ids, side='right') - first_hits
+    read_offsets = np.cumsum(counts) - counts
+
+    # a pair for each read and each hit of its query
+    pair_reads = np.repeat(np.arange(n_reads), counts)
+    pair_hits = order[np.repeat(first_hits - read_offsets, counts) + np.arange(len(pair_reads))]
+    pair_starts = hit_starts[pair_hits]
+    pair_ends = hit_ends[pair_hits]
+    lower = read_starts[pair_reads] - 1
+    upper = read_ends[pair_reads] + 1
+    in_range = ((hit_chrom_ids[pair_hits] == read_chrom_ids[pair_reads])
+            & (lower <= pair_starts) & (pair_starts <= upper)
+            & (lower <= pair_ends) & (pair_ends <= upper))
+    scores = hit_bitscores[pair_hits]
+
+    # pairs of each read by descending bitscore. lexsort is stable, so ties stay in output order
+    pair_order = np.lexsort((-scores, pair_reads))
+    in_range = in_range[pair_order]
+    scores = scores[pair_order]
+
+    # top hit has to be in range
+    has_hits = counts > 0
+    passing = np.zeros(n_reads, dtype=bool)
+    passing[has_hits] = in_range[read_offsets[has_hits]]
+    top_scores = np.zeros(n_reads)
+    top_scores[has_hits] = scores[read_offsets[has_hits]]
+
+    # first hit outside the read decides. pairs are still ordered by read, so the first out of
+    # range pair seen for a read is its best scoring one
+    out_of_range = np.flatnonzero(~in_range)
+    out_reads, first_out = np.unique(pair_reads[out_of_range], return_index=True)
+    out_of_range = out_of_range[first_out]
+    passing[out_reads] &= scores[out_of_range] <= percent_threshold * top_scores[out_reads]
+
+    return passing
+
+def iter_blat_hits(output_fp):
+    """Yields BlatHits for each query in blast8 output as its hits are read, so hits for the
+    whole output are never held at once. blat writes all hits for a query together"""
+    qseqid_index = ANNOTATION_TO_INDICES['qseqid']
+    sseqid_index = ANNOTATION_TO_INDICES['sseqid']
+    sstart_index = ANNOTATION_TO_INDICES['sstart']
+    send_index = ANNOTATION_TO_INDICES['send']
+    bitscore_index = ANNOTATION_TO_INDICES['bitscore']
+
+    seen = set()
+    hits = None
+    f = open(output_fp)
+    for line in f:
+        pieces = line.strip().split('\t')
+        if len(pieces) <= bitscore_index:
+            continue
+
+        if hits is None or pieces[qseqid_index] != hits.qseqid:
+            if hits is not None:
+                yield hits
+            if pieces[qseqid_index] in seen:
+                raise ValueError(f'hits for {pieces[qseqid_index]} are not together in {output_fp}')
+            seen.add(pieces[qseqid_index])
+            hits = BlatHits(pieces[qseqid_index])
+
+        hits.add(pieces[sseqid_index], int(pieces[sstart_index]), int(pieces[send_index]),
+                float(pieces[bitscore_index]))
+    f.close()
+
+    if hits is not None:
+        yield hits
+
+def get_blat_tool_args(query_fp, database, out='blast8', output_fp='temp.out', gfclient=None):
+    """Returns args for a standalone blat run, or a gfClient run if gfclient is given"""
+    if gfclient is not None:
+        return gfclient.get_tool_args(query_fp, out=out, output_fp=output_fp)
+
+    return ['blat', database, query_fp,
             f'-out={out}',
             output_fp]
 
+def execute_blat(query_fp, database, out='blast8', output_fp='temp.out', gfclient=None):
+    tool_args = get_blat_tool_args(query_fp, database, out=out, output_fp=output_fp,
+            gfclient=gfclient)
+
     logging.info('started executing blat')
-    subprocess.check_output(tool_args).decode('utf-8')
+    tool_runner.check_output(tool_args)
     logging.info('finished executing blat')
 
+def split_fasta(input_fasta, n_shards, shard_prefix):
+    """Split fasta into up to n_shards contiguous pieces along record boundaries.
+
+    Returns filepaths of the written shards"""
+    f = open(input_fasta)
+    n_records = sum(1 for line in f if line[0] == '>')
+    f.close()
+
+    records_per_shard = max(1, -(-n_records // n_shards))
+    shard_fps = []
+    out_f = None
+    record_count = 0
+    f = open(input_fasta)
+    for line in f:
+        if line[0] == '>':
+            if record_count % records_per_shard == 0:
+                if out_f is not None:
+                    out_f.close()
+                shard_fps.append(f'{shard_prefix}.{len(shard_fps)}.fa')
+                out_f = open(shard_fps[-1], 'w')
+            record_count += 1
+        out_f.write(line)
+    f.close()
+    if out_f is not None:
+        out_f.close()
+
+    return shard_fps
+
+def execute_blat_sharded(query_fp, database, n_shards, out='blast8', output_fp='temp.out',
+        gfclient=None):
+    """Split query fasta into shards and run a blat process on each concurrently.
+
+    Shard outputs are concatenated into output_fp in query order"""
+    u_id = str(uuid.uuid4())
+    shard_fps = split_fasta(query_fp, n_shards, f'temp.query.{u_id}')
+    shard_output_fps = [f'temp.{u_id}.{i}.out' for i in range(len(shard_fps))]
+
+    logging.info(f'started executing blat on {len(shard_fps)} shards')
+    try:
+        tool_runner.run_many([get_blat_tool_args(shard_fp, database, out=out,
+                output_fp=shard_output_fp, gfclient=gfclient)
+                for shard_fp, shard_output_fp in zip(shard_fps, shard_output_fps)])
+        logging.info('finished executing blat')
+
+        out_f = open(output_fp, 'w')
+        for shard_output_fp in shard_output_fps:
+            f = open(shard_output_fp)
+            shutil.copyfileobj(f, out_f)
+            f.close()
+        out_f.close()
+    finally:
+        for shard_fp in shard_fps:
+            os.remove(shard_fp)
+        for shard_output_fp in shard_output_fps:
+            if os.path.isfile(shard_output_fp):
+                os.remove(shard_output_fp)
+
+def get_two_bit_fp(reference_fasta_fp):
+    """Returns .2bit for the given reference, converting it with faToTwoBit if it doesnt exist"""
+    if reference_fasta_fp.endswith('.2bit'):
+        return reference_fasta_fp
+
+    two_bit_fp = os.path.splitext(reference_fasta_fp)[0] + '.2bit'
+    if not os.path.isfile(two_bit_fp):
+        logging.info(f'converting {reference_fasta_fp} to {two_bit_fp}')
+        tool_args = ['faToTwoBit', reference_fasta_fp, two_bit_fp]
+        tool_runner.check_output(tool_args)
+
+    return two_bit_fp
+
+class GfClient(object):
+    def __init__(self, host, port, seq_dir):
+        """Sends queries to a running gfServer.
+
+        seq_dir - directory holding the .2bit the server was started on"""
+        self.host = host
+        self.port = port
+        self.seq_dir = seq_dir
+
+    def get_tool_args(self, query_fp, out='blast8', output_fp='temp.out'):
+        return ['gfClient', self.host, str(self.port), self.seq_dir, query_fp,
+                f'-out={out}',
+                output_fp]
+
+def get_free_port(host='localhost'):
+    """Returns a port on host that nothing is listening on, picked by the os"""
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.bind((host, 0))
+        return s.getsockname()[1]
+    finally:
+        s.close()
+
+def is_port_free(host, port):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.bind((host, port))
+    except OSError:
+        return False
+    finally:
+        s.close()
+    return True
+
+class GfServer(object):
+    def __init__(self, database, host='localhost', port=None, startup_timeout=3600):
+        """Starts a gfServer on the given reference so it is only loaded and indexed once.
+
+        port - port to serve on. Defaults to a free port picked for this server, so a gfServer
+            from another run can't answer in its place
+
+        Queries are sent through the GfClient at self.client. The server is stopped by stop,
+        or at interpreter exit."""
+        if port is None:
+            port = get_free_port(host)
+        elif not is_port_free(host, port):
+            raise ValueError(f'Port {port} on {host} is already in use, possibly by another '
+                    'gfServer. Pick a different --gfserver-port or leave it out to use a free one')
+        self.host = host
+        self.port = port
+
+        two_bit_fp = get_two_bit_fp(database)
+        seq_dir = os.path.dirname(os.path.abspath(two_bit_fp))
+
+        logging.info(f'starting gfServer on {host}:{port} for {two_bit_fp}')
+        # started from the .2bit directory so the file name it reports resolves under seq_dir
+        tool_args = ['gfServer', 'start', host, str(port), '-canStop',
+                os.path.basename(two_bit_fp)]
+        # runs for the whole session, so it is kept out of tool_runner's limits and timeouts
+        self.process = subprocess.Popen(tool_args, cwd=seq_dir, stdout=subprocess.DEVNULL)
+        atexit.register(self.stop)
+
+        self.wait_until_ready(startup_timeout)
+        logging.info('gfServer ready')
+
+        self.client = GfClient(host, port, seq_dir)
+
+    def is_ready(self):
+        tool_args = ['gfServer', 'status', self.host, str(self.port)]
+        return tool_runner.call(tool_args) == 0
+
+    def check_running(self):
+        if self.process.poll() is not None:
+            raise subprocess.CalledProcessError(self.process.returncode, self.process.args)
+
+    def wait_until_ready(self, timeout):
+        # our process is checked around each status call, since status is answered by whatever
+        # server holds the port
+        start = time.time()
+        while True:
+            self.check_running()
+            if self.is_ready():
+                break
+            if time.time() - start > timeout:
+                self.stop()
+                raise TimeoutError(f'gfServer did not start within {timeout} seconds')
+            time.sleep(1)
+        self.check_running()
+
+    def stop(self):
+        """Stop the server if it is still running"""
+        if self.process.poll() is not None:
+            return
+
+        tool_args = ['gfServer', 'stop', self.host, str(self.port)]
+        tool_runner.call(tool_args)
+        try:
+            self.process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        logging.info('stopped gfServer')
+
 def is_in_range(chrom, read_start, read_end, d):
     norm_chrom = re.sub(r'^chr(.*)$', r'\1', chrom)
     chrom = re.sub(r'^chr(.*)$', r'\1', d['sseqid'])
@@ -93,114 +394,350 @@ def is_positive_rna_count(chrom, read_start, read_end, blat_result_dicts, percen
 
     return True
 
+def get_read_position(read_id):
+    """Returns (chrom, pos) of a read id, formatted chrom:pos|i"""
+    chrom, pos = read_id.rsplit('|', 1)[0].rsplit(':', 1)
+    return chrom, int(pos)
+
+def get_z_score(confidence):
+    """Returns two sided standard normal critical value for the given confidence level"""
+    lower, upper = 0., 10.
+    for _ in range(100):
+        mid = (lower + upper) / 2
+        if math.erf(mid / math.sqrt(2)) < confidence:
+            lower = mid
+        else:
+            upper = mid
+    return (lower + upper) / 2
+
+def get_wilson_interval(count, total, z_score):
+    """Returns wilson score interval for count successes out of total"""
+    if total == 0:
+        return 0., 1.
+
+    p = count / total
+    denominator = 1 + z_score ** 2 / total
+    center = (p + z_score ** 2 / (2 * total)) / denominator
+    half_width = z_score * math.sqrt(p * (1 - p) / total + z_score ** 2 / (4 * total ** 2)) / \
+            denominator
+
+    return max(0., center - half_width), min(1., center + half_width)
+
 class BlatAnnotator(object):
-    def __init__(self, annotations, database, rna_editing_percent_threshold=.95):
+    def __init__(self, annotations, database, rna_editing_percent_threshold=.95, blat_workers=1,
+            gfclient=None, bam_reader='pysam', max_depth=200, sampling_seed=0, approximate=False,
+            ci_width=.1, decision_threshold=None, round_size=20, confidence=.95):
+        """
+        annotations - annotations to do. Options are rna_editing
+        database - reference fasta to blat against
+        blat_workers - number of blat processes to split each query fasta across
+        gfclient - if present, queries are sent to this GfClient's gfServer instead of running
+            standalone blat against database
+        bam_reader - pysam or samtools. See bam_utils.get_read_collection
+        max_depth - max reads per position to blat
+        sampling_seed - seed for sampling reads at positions with more than max_depth reads
+        approximate - if True, rna editing reads are aligned round_size per position at a time,
+            and a position stops once the confidence interval on its passing fraction is
+            narrower than ci_width, or entirely above or below decision_threshold
+        confidence - confidence level of the interval used in approximate mode
+        """
         self.annotations = annotations
         self.database = database
+        self.blat_workers = blat_workers
+        self.gfclient = gfclient
+        self.bam_reader = bam_reader
+        self.max_depth = max_depth
+        self.sampling_seed = sampling_seed
+
+        self.approximate = approximate
+        self.ci_width = ci_width
+        self.decision_threshold = decision_threshold
+        self.round_size = round_size
+        self.z_score = get_z_score(confidence)
 
         self.rna_editing_percent_threshold = rna_editing_percent_threshold
 
         self.reads_to_data = {}
         self.position_to_reference_base = {}
+        self.covered_positions = set()
 
-    def prepare_input_files(self, input_bam_fp, output_fasta_fp, position_tups):
-        """prepare input files that BlastAnnotator needs if reading from bam and position file
-    
-        position_tups - [(chrom, pos), ...]"""
+        # per chunk state, see fetch_chunk
+        self.position_tups = []
+        self.temp_prefix = None
+        self.read_to_passing = {}
+        self.position_to_annotation = {}
+
+    def get_headers(self):
+        """Returns headers of the annotations added by get_blat_annotations_for_bam"""
+        headers = []
+        if 'rna_editing' in self.annotations:
+            headers += ['BLAT_RNA_EDITING_%_PASSING']
+            if self.approximate:
+                headers += ['BLAT_RNA_EDITING_READS_USED', 'BLAT_RNA_EDITING_CI_LOWER',
+                        'BLAT_RNA_EDITING_CI_UPPER']
+        return headers
+
+    def prepare_reads(self, input_bam_fp, position_tups):
+        """collect data for reads covering the given positions from bam
+
+        position_tups - [(chrom, pos), ...]
+
+        If reference bases have been set for rna editing, only reads carrying a non reference
+        base are kept. At most max_depth reads are kept per position, sampled uniformly as
+        reads stream in"""
 
         # index the bam in case it isn't already
         logging.info('indexing input bam')
-        bam_utils.index_bam(input_bam_fp)
+        bam_utils.index_bam(input_bam_fp, reader=self.bam_reader)
 
-        # create a positions file that will work with samtools in case input doesn't
-        logging.info(f'creating temporary position bed for {len(position_tups)} positions')
-        u_id = str(uuid.uuid4())
-        temp_positions_fp = f'temp.positions.{u_id}.bed'
-        out_f = open(temp_positions_fp, 'w')
-        for chrom, pos in position_tups:
-            out_f.write(f'{chrom}\t{pos}\t{pos}\n')
-        out_f.close()
+        position_to_reference_base = None
+        if 'rna_editing' in self.annotations:
+            position_to_reference_base = {(chrom, int(pos)):base
+                    for (chrom, pos), base in self.position_to_reference_base.items()}
 
-        self.reads_to_data = bam_utils.write_position_fasta(input_bam_fp,
-                temp_positions_fp, output_fasta_fp, max_depth=200)
+        rc = bam_utils.get_read_collection(input_bam_fp, position_tups, reader=self.bam_reader,
+                max_depth=self.max_depth, seed=self.sampling_seed,
+                position_to_reference_base=position_to_reference_base)
+        self.covered_positions = rc.get_covered_positions()
+        self.reads_to_data = bam_utils.get_reads_to_data(rc, position_tups,
+                max_depth=self.max_depth)
 
         logging.info(f'retaining data for {len(self.reads_to_data)} reads')
 
-        os.remove(temp_positions_fp)
-
-    def blat_fasta(self, input_fasta):
-        """Blat the given fasta and collect results for each sequence in input fasta"""
-        u_id = str(uuid.uuid4())
-        temp_output_fp = f'temp.{u_id}.out'
-        execute_blat(input_fasta, self.database, output_fp=temp_output_fp)
-        output_dicts = parse_blat_output(temp_output_fp)
+    def prepare_input_files(self, input_bam_fp, output_fasta_fp, position_tups):
+        """prepare input files that BlastAnnotator needs if reading from bam and position file
+    
+        position_tups - [(chrom, pos), ...]
 
-        # remove temp output
-        os.remove(temp_output_fp)
+        See prepare_reads for which reads are written"""
+        logging.info('writing position fasta')
+        self.prepare_reads(input_bam_fp, position_tups)
+        written_queries = bam_utils.write_query_fasta(self.reads_to_data, output_fasta_fp)
 
-        sequence_to_results = defaultdict(list)
-        for d in output_dicts:
-            if 'qseqid' in d:
-                sequence_to_results[d['qseqid']].append(d)
+        logging.info(f'wrote {len(written_queries)} unique sequences for {len(self.reads_to_data)} reads')
 
-        return sequence_to_results
+    def blat_and_score_fasta(self, input_fasta, read_ids, query_to_hits=None):
+        """Blat the given query fasta, and check each read against the hits for its query as
+        they are read from blat output.
 
-    def get_rna_editing_annotations(self, position_to_read_results):
-        """Returns dict {position: %passing}"""
-        position_to_percent_passing = {}
-        for (chrom, pos), read_to_result_dicts in position_to_read_results.items():
-            count, total = 0, 0
-            for read, result_dicts in read_to_result_dicts.items():
-                read_data = self.reads_to_data[f'{chrom}:{pos}|{read}']
-                
-                reference_base = self.position_to_reference_base[(chrom, str(pos))]
-                read_start, read_end = bam_utils.get_covering_reference_coords(int(read_data['start']),
-                        read_data['cigar'], read_data['sequence'])
-                read_base = bam_utils.get_base_by_position(int(read_data['start']), int(pos),
-                        read_data['cigar'], read_data['sequence'])
-
-                if reference_base is not None and read_base is not None:
-                    if reference_base.lower() != read_base.lower():
-                        total += 1
-                        if is_positive_rna_count(chrom, read_start, read_end, result_dicts,
-                                percent_threshold=self.rna_editing_percent_threshold):
-                            count += 1
-
-            position_to_percent_passing[(chrom, pos)] = count / max(1, total)
-
-        return position_to_percent_passing
-
-    def get_rna_editing_blat_annotations(self, input_fasta,
-            chrom_regex=r'^(.*):.*$', pos_regex=r'^.*:(.*)\|.*$', read_regex=r'^.*\|(.*)$'):
-        """Collect by value in input fasta sequence identifier. Identifier is seperated by |
-
-        i.e. if a sequence id is chr1:12345|read1, then the returned dictionary will
-        look something like - {'chr1:12345': {read1: [{blastn parsed result}, ...], ...}, ...}
-        """
-        sequence_to_results = self.blat_fasta(input_fasta)
+        read_ids - reads to check. Their queries must be in input_fasta
+        query_to_hits - if present, BlatHits for each query are also stored here
 
-        position_to_read_results = {}
-        for sequence_id, result_dict in sequence_to_results.items():
-            chrom = re.sub(chrom_regex, r'\1', sequence_id)
-            pos = int(re.sub(pos_regex, r'\1', sequence_id))
-            read = re.sub(read_regex, r'\1', sequence_id)
-            
-            pos_tup = (chrom, pos)
+        Returns dict {read id: True if read is a positive rna count}. Reads whose query had no
+        hits are left out"""
+        query_to_read_ids = defaultdict(list)
+        for read_id in read_ids:
+            query_to_read_ids[self.reads_to_data[read_id]['query']].append(read_id)
 
-            if pos_tup not in position_to_read_results:
-                position_to_read_results[pos_tup] = {}
-            position_to_read_results[pos_tup][read] = result_dict
+        u_id = str(uuid.uuid4())
+        temp_output_fp = f'temp.{u_id}.out'
+        if self.blat_workers > 1:
+            execute_blat_sharded(input_fasta, self.database, self.blat_workers,
+                    output_fp=temp_output_fp, gfclient=self.gfclient)
+        else:
+            execute_blat(input_fasta, self.database, output_fp=temp_output_fp,
+                    gfclient=self.gfclient)
+
+        read_to_passing = {}
+        n_hits = 0
+        pending = []
+        n_pending_hits = 0
+        try:
+            for hits in iter_blat_hits(temp_output_fp):
+                n_hits += len(hits)
+                if query_to_hits is not None:
+                    query_to_hits[hits.qseqid] = hits
+                if hits.qseqid not in query_to_read_ids:
+                    continue
+
+                # score groups in batches, so hits are held for a batch at a time
+                pending.append(hits)
+                n_pending_hits += len(hits)
+                if n_pending_hits >= SCORE_BATCH_HITS:
+                    read_to_passing.update(self.score_hit_groups(pending,
+                            [query_to_read_ids[hits.qseqid] for hits in pending]))
+                    pending = []
+                    n_pending_hits = 0
+            read_to_passing.update(self.score_hit_groups(pending,
+                    [query_to_read_ids[hits.qseqid] for hits in pending]))
+        finally:
+            # remove temp output
+            os.remove(temp_output_fp)
+
+        logging.info(f'{n_hits} total blat hits returned for session')
+        metrics.increment('blat_hits', n_hits)
+
+        return read_to_passing
+
+    def get_read_span(self, read_id):
+        """Returns (start, end) of reference covered by read"""
+        read_data = self.reads_to_data[read_id]
+        return bam_utils.get_covering_reference_coords(int(read_data['start']),
+                read_data['cigar'], read_data['sequence'])
+
+    def score_hit_groups(self, hit_groups, read_ids_by_group):
+        """Check reads against the hits for their query, for many queries at once.
+
+        hit_groups - BlatHits for each query
+        read_ids_by_group - list of reads to check against each of hit_groups
+
+        Returns dict {read id: True if read is a positive rna count}"""
+        chrom_to_id = {}
+        hit_query_ids, hit_chrom_ids, hit_starts, hit_ends, hit_bitscores = [], [], [], [], []
+        read_ids, read_query_ids, read_chrom_ids, read_starts, read_ends = [], [], [], [], []
+        for i, (hits, group_read_ids) in enumerate(zip(hit_groups, read_ids_by_group)):
+            hit_query_ids += [i] * len(hits)
+            hit_chrom_ids += [chrom_to_id.setdefault(chrom, len(chrom_to_id))
+                    for chrom in hits.chroms]
+            hit_starts += hits.starts
+            hit_ends += hits.ends
+            hit_bitscores += hits.bitscores
+
+            for read_id in group_read_ids:
+                chrom, _ = get_read_position(read_id)
+                read_start, read_end = self.get_read_span(read_id)
+                read_ids.append(read_id)
+                read_query_ids.append(i)
+                read_chrom_ids.append(chrom_to_id.setdefault(normalize_chrom(chrom),
+                        len(chrom_to_id)))
+                read_starts.append(read_start)
+                read_ends.append(read_end)
+
+        passing = get_positive_rna_counts(
+                np.asarray(hit_query_ids, dtype=np.int64), np.asarray(hit_chrom_ids, dtype=np.int64),
+                np.asarray(hit_starts, dtype=np.int64), np.asarray(hit_ends, dtype=np.int64),
+                np.asarray(hit_bitscores, dtype=np.float64),
+                np.asarray(read_query_ids, dtype=np.int64), np.asarray(read_chrom_ids, dtype=np.int64),
+                np.asarray(read_starts, dtype=np.int64), np.asarray(read_ends, dtype=np.int64),
+                percent_threshold=self.rna_editing_percent_threshold)
+
+        return dict(zip(read_ids, passing.tolist()))
+
+    def get_informative_read_ids(self, read_ids):
+        """Returns reads carrying a non reference base at their position. Only these count
+        towards rna editing annotations"""
+        position_to_read_ids = defaultdict(list)
+        for read_id in read_ids:
+            position_to_read_ids[get_read_position(read_id)].append(read_id)
+
+        informative_read_ids = []
+        for (chrom, pos), position_read_ids in position_to_read_ids.items():
+            reference_base = self.position_to_reference_base[(chrom, str(pos))]
+            if reference_base is None:
+                continue
+
+            read_datas = [self.reads_to_data[read_id] for read_id in position_read_ids]
+            read_bases = bam_utils.get_bases_by_position(
+                    [int(read_data['start']) for read_data in read_datas], pos,
+                    [read_data['cigar'] for read_data in read_datas],
+                    [read_data['sequence'] for read_data in read_datas])
+
+            for read_id, read_base in zip(position_read_ids, read_bases):
+                if read_base is not None and reference_base.lower() != read_base.lower():
+                    informative_read_ids.append(read_id)
+
+        return informative_read_ids
+
+    def get_rna_editing_counts(self, read_to_passing):
+        """Returns dict {position: (passing reads, total reads)} for positions of the given
+        reads"""
+        position_to_counts = {}
+        for read_id, passing in read_to_passing.items():
+            position = get_read_position(read_id)
+            count, total = position_to_counts.get(position, (0, 0))
+            position_to_counts[position] = (count + passing, total + 1)
+
+        return position_to_counts
+
+    def get_rna_editing_annotations(self, read_to_passing):
+        """Returns dict {position: %passing}"""
+        return {position:count / max(1, total) for position, (count, total)
+                in self.get_rna_editing_counts(read_to_passing).items()}
 
-        position_to_percent_passing = self.get_rna_editing_annotations(position_to_read_results)
+    def is_resolved(self, lower, upper):
+        """Whether an interval on the passing fraction is precise enough to stop at"""
+        if upper - lower <= self.ci_width:
+            return True
+        if self.decision_threshold is not None:
+            return lower > self.decision_threshold or upper < self.decision_threshold
+        return False
 
-        return position_to_percent_passing
+    def get_adaptive_rna_editing_blat_annotations(self, temp_prefix):
+        """Align reads for each position in rounds of round_size, until the wilson interval on
+        the passing fraction is resolved or reads run out. Queries already aligned in an
+        earlier round are not aligned again.
+
+        temp_prefix - prefix for round query fastas
+
+        Returns dict {position: (%passing, reads used, interval lower, interval upper)}"""
+        position_to_read_ids = defaultdict(list)
+        for read_id in self.reads_to_data:
+            position_to_read_ids[get_read_position(read_id)].append(read_id)
+
+        # reads are kept in position order, so shuffle to make each round a random sample
+        rng = random.Random(self.sampling_seed)
+        for read_ids in position_to_read_ids.values():
+            rng.shuffle(read_ids)
+
+        # hits are kept between rounds since reads at different positions can share a query
+        query_to_hits = {}
+        read_to_passing = {}
+        aligned_queries = set()
+        position_to_n_used = {position:0 for position in position_to_read_ids}
+        position_to_annotation = {}
+        n_round = 0
+        while position_to_n_used:
+            n_round += 1
+            round_read_ids = []
+            for position, n_used in position_to_n_used.items():
+                round_read_ids += position_to_read_ids[position][n_used:n_used + self.round_size]
+            round_read_ids = self.get_informative_read_ids(round_read_ids)
+
+            temp_fasta_fp = f'{temp_prefix}.round{n_round}.fa'
+            queries = bam_utils.write_query_fasta(self.reads_to_data, temp_fasta_fp,
+                    read_ids=round_read_ids, skip_queries=aligned_queries)
+            logging.info(f'round {n_round}: aligning {len(queries)} queries for '
+                    f'{len(position_to_n_used)} unresolved positions')
+            if queries:
+                read_to_passing.update(self.blat_and_score_fasta(temp_fasta_fp,
+                        [read_id for read_id in round_read_ids
+                        if self.reads_to_data[read_id]['query'] in queries],
+                        query_to_hits=query_to_hits))
+            os.remove(temp_fasta_fp)
+
+            # reads whose query was aligned in an earlier round
+            query_to_earlier_read_ids = defaultdict(list)
+            for read_id in round_read_ids:
+                query = self.reads_to_data[read_id]['query']
+                if query in aligned_queries and query in query_to_hits:
+                    query_to_earlier_read_ids[query].append(read_id)
+            read_to_passing.update(self.score_hit_groups(
+                    [query_to_hits[query] for query in query_to_earlier_read_ids],
+                    list(query_to_earlier_read_ids.values())))
+            aligned_queries.update(queries)
+
+            unresolved = {}
+            for position, n_used in position_to_n_used.items():
+                n_used = min(n_used + self.round_size, len(position_to_read_ids[position]))
+                count, total = self.get_rna_editing_counts({read_id:read_to_passing[read_id]
+                        for read_id in position_to_read_ids[position][:n_used]
+                        if read_id in read_to_passing}).get(position, (0, 0))
+
+                lower, upper = get_wilson_interval(count, total, self.z_score)
+                if n_used < len(position_to_read_ids[position]) and not self.is_resolved(lower, upper):
+                    unresolved[position] = n_used
+                elif total:
+                    position_to_annotation[position] = (count / total, total, lower, upper)
+            position_to_n_used = unresolved
+
+        return position_to_annotation
 
     def get_blat_annotations_for_bam(self, input_bam_fp, position_tups, reference_bases=None):
         """Get annotations for the given positions based on reads in the given bam.
 
         input_bam_fp - filepath to bam with reads covering positions in the positions file
         position_tups - positions to recieve annotations. format - [(chrom, pos), ...]
-        reference_bases - 
+        reference_bases - reference base for each position. Required for rna editing annotations
 
         if position is not present in bam, then it will not be returned in annotations
 
@@ -208,29 +745,105 @@ class BlatAnnotator(object):
             {(chrom, pos): [annotation1, annotation2, annotation3, ...]}, [header1, 
                     header2, header3, ...]
         """
-        u_id = str(uuid.uuid4())
-        temp_fasta_fp = f'temp.query.{u_id}.fa'
-        self.prepare_input_files(input_bam_fp, temp_fasta_fp, position_tups) 
+        return self.fetch_chunk(input_bam_fp, position_tups,
+                reference_bases=reference_bases).align_chunk().score_chunk()
+
+    def fetch_chunk(self, input_bam_fp, position_tups, reference_bases=None):
+        """First step of get_blat_annotations_for_bam. Pulls reads covering the given positions
+        from bam, and writes them to a query fasta unless approximate.
+
+        Returns an annotator with the same settings that owns the read state for this chunk,
+        so different chunks can be fetched, aligned and scored at the same time"""
+        chunk = copy.copy(self)
+        chunk.position_tups = position_tups
+        chunk.position_to_reference_base = {}
+        chunk.read_to_passing = {}
+        chunk.position_to_annotation = {}
 
-        annotations_dict = defaultdict(list)
-        headers = []
         if 'rna_editing' in self.annotations:
             if reference_bases is None:
                 raise ValueError('reference bases must be present if doing rna editing annotations')
 
-            self.position_to_reference_base = {(chrom, pos):base
+            chunk.position_to_reference_base = {(chrom, pos):base
                     for (chrom, pos), base in zip(position_tups, reference_bases)}
 
-            position_to_percent_passing = self.get_rna_editing_blat_annotations(temp_fasta_fp)
-            # add positions that were missing for whatever reason
-            for (chrom, pos) in position_tups:
-                if (chrom, int(pos)) not in position_to_percent_passing:
-                    position_to_percent_passing[(chrom, int(pos))] = '.'
+        chunk.temp_prefix = f'temp.query.{uuid.uuid4()}'
+        if self.approximate:
+            chunk.prepare_reads(input_bam_fp, position_tups)
+        else:
+            chunk.prepare_input_files(input_bam_fp, f'{chunk.temp_prefix}.fa', position_tups)
 
-            headers += ['BLAT_RNA_EDITING_%_PASSING']
-            for (chrom, pos), value in position_to_percent_passing.items():
-                annotations_dict[(chrom, str(pos))].append(value)
+        return chunk
 
-        os.remove(temp_fasta_fp)
+    def align_chunk(self):
+        """Second step of get_blat_annotations_for_bam. Blats reads of a fetched chunk, checking
+        each read against the hits for its query as blat output is read. Returns self"""
+        if 'rna_editing' in self.annotations:
+            if self.approximate:
+                self.position_to_annotation = self.get_adaptive_rna_editing_blat_annotations(
+                        self.temp_prefix)
+            else:
+                self.read_to_passing = self.blat_and_score_fasta(f'{self.temp_prefix}.fa',
+                        self.get_informative_read_ids(self.reads_to_data))
+
+        if not self.approximate:
+            os.remove(f'{self.temp_prefix}.fa')
+
+        return self
+
+    def score_chunk(self):
+        """Last step of get_blat_annotations_for_bam. Totals passing reads of an aligned chunk.
+
+        Returns: position_to_annotations, headers. See get_blat_annotations_for_bam"""
+        annotations_dict = defaultdict(list)
+        headers = []
+        if 'rna_editing' in self.annotations:
+            if self.approximate:
+                position_to_annotation = dict(self.position_to_annotation)
+            else:
+                position_to_annotation = {position:(percent_passing,) for position, percent_passing
+                        in self.get_rna_editing_annotations(self.read_to_passing).items()}
+            n_fields = len(self.get_headers())
+
+            # add positions that were missing for whatever reason. positions with reads that
+            # were all filtered out for carrying the reference base have no passing reads.
+            # positions whose reads got no blat hits stay missing
+            informative_positions = set(get_read_position(read_id)
+                    for read_id in self.reads_to_data)
+            for (chrom, pos) in self.position_tups:
+                position = (chrom, int(pos))
+                if position not in position_to_annotation:
+                    if position in self.covered_positions and \
+                            position not in informative_positions:
+                        # no reads to build an interval from
+                        position_to_annotation[position] = \
+                                ((0.0, 0, '.', '.') if self.approximate else (0.0,))
+                    else:
+                        position_to_annotation[position] = ('.',) * n_fields
+
+            headers += self.get_headers()
+            for (chrom, pos), values in position_to_annotation.items():
+                annotations_dict[(chrom, str(pos))] += list(values)
 
         return annotations_dict, headers
+
+# annotator owned by the current pool worker process, see init_worker
+worker_annotator = None
+
+def init_worker(annotator_kwargs, tool_limits=None, tool_timeouts=None, profile_dir=None):
+    """Pool initializer. Gives each worker process its own BlatAnnotator, so read data and
+    temp files are never shared between chunks running at the same time. Workers aren't forked
+    from the parent, so the parent's tool runner and profiling settings are passed in
+
+    annotator_kwargs - kwargs for BlatAnnotator
+    tool_limits - {tool name: max processes at once} for each worker
+    tool_timeouts - {tool name: seconds}
+    profile_dir - directory to write worker profiles to, if profiling"""
+    global worker_annotator
+    tool_runner.configure(limits=tool_limits, timeouts=tool_timeouts)
+    if profile_dir is not None:
+        metrics.enable_profiling(profile_dir)
+    worker_annotator = BlatAnnotator(**annotator_kwargs)
+
+def get_worker_annotator():
+    return worker_annotator
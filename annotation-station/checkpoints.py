@@ -0,0 +1,93 @@
+import json
+import logging
+import os
+import re
+import shutil
+
+logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.INFO)
+
+MANIFEST_FILENAME = 'manifest.json'
+BATCH_FILENAME_REGEX = re.compile(r'^batch\.([0-9]+)\.tsv$')
+
+class CheckpointDir(object):
+    def __init__(self, checkpoint_dir, manifest, resume=False):
+        """Annotated batches of a run, saved as each one finishes so an interrupted run can
+        pick up where it stopped.
+
+        checkpoint_dir - directory to save batches in. Will be created if it doesn't exist
+        manifest - json serializable dict describing the run. Checkpoints are only resumed
+            from a run with the same manifest
+        resume - if True, batches finished by an earlier run are kept. Otherwise any existing
+            checkpoints are cleared"""
+        self.checkpoint_dir = checkpoint_dir
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+        manifest = json.loads(json.dumps(manifest))
+        manifest_fp = os.path.join(checkpoint_dir, MANIFEST_FILENAME)
+        if resume and os.path.isfile(manifest_fp):
+            f = open(manifest_fp)
+            saved_manifest = json.load(f)
+            f.close()
+            if saved_manifest != manifest:
+                raise ValueError(f'checkpoints in {checkpoint_dir} are from a run with different '
+                        'input or settings. Rerun without --resume to start over')
+        else:
+            for filename in os.listdir(checkpoint_dir):
+                if BATCH_FILENAME_REGEX.match(filename):
+                    os.remove(os.path.join(checkpoint_dir, filename))
+            write_atomic(manifest_fp, json.dumps(manifest, indent=2, sort_keys=True))
+
+        self.finished = set()
+        for filename in os.listdir(checkpoint_dir):
+            m = BATCH_FILENAME_REGEX.match(filename)
+            if m:
+                self.finished.add(int(m.group(1)))
+
+        if resume:
+            logging.info(f'resuming with {len(self.finished)} finished batches in {checkpoint_dir}')
+
+    def get_batch_fp(self, index):
+        return os.path.join(self.checkpoint_dir, f'batch.{index:08d}.tsv')
+
+    def is_finished(self, index):
+        return index in self.finished
+
+    def write_batch(self, index, rows):
+        """Save annotated rows of the batch at the given index"""
+        write_atomic(self.get_batch_fp(index), ''.join('\t'.join(row) + '\n' for row in rows))
+        self.finished.add(index)
+
+    def skip_finished(self, batches):
+        """Yields batches that aren't finished yet"""
+        for index, rows in enumerate(batches):
+            if not self.is_finished(index):
+                yield rows
+
+    def iter_unfinished_indices(self):
+        """Yields indices of batches that aren't finished yet, in order. Never ends"""
+        index = 0
+        while True:
+            if not self.is_finished(index):
+                yield index
+            index += 1
+
+    def write_output(self, output_fp, header=None):
+        """Concatenate saved batches, in order, into output_fp"""
+        temp_output_fp = output_fp + '.tmp'
+        out_f = open(temp_output_fp, 'w')
+        if header is not None:
+            out_f.write('\t'.join(header) + '\n')
+        for index in range(len(self.finished)):
+            f = open(self.get_batch_fp(index))
+            shutil.copyfileobj(f, out_f)
+            f.close()
+        out_f.close()
+        os.replace(temp_output_fp, output_fp)
+
+def write_atomic(fp, text):
+    """Write text to fp so a reader never sees a partially written file"""
+    temp_fp = fp + '.tmp'
+    f = open(temp_fp, 'w')
+    f.write(text)
+    f.close()
+    os.replace(temp_fp, fp)
@@ -0,0 +1,128 @@
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import sys
+
+logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.INFO)
+
+class AnnotationRequestHandler(socketserver.StreamRequestHandler):
+    """Answers newline delimited json requests on a connection until the client closes it.
+
+    Requests look like {"rows": [[chrom, pos, ...], ...], "blat_input_bam": optional bam}. The
+    response is {"headers": [...], "rows": [...]} with annotation columns appended to each row,
+    or {"error": message} if annotation failed"""
+    def handle(self):
+        session = self.server.session
+        for line in self.rfile:
+            if not line.strip():
+                continue
+
+            try:
+                request = json.loads(line.decode('utf-8'))
+                rows = session.annotate(request['rows'],
+                        blat_input_bam=request.get('blat_input_bam'))
+                response = {'headers': session.get_headers(), 'rows': rows}
+                logging.info(f'annotated {len(rows)} rows')
+            except Exception as e:
+                logging.exception('annotation request failed')
+                response = {'error': f'{type(e).__name__}: {e}'}
+
+            self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+
+class AnnotationServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, session):
+        """Unix socket server annotating requests with a shared session. Each connection gets
+        its own thread, and the session annotates one batch at a time"""
+        self.session = session
+        super().__init__(socket_path, AnnotationRequestHandler)
+
+def is_listening(socket_path):
+    """Whether something is accepting connections on the unix socket"""
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(socket_path)
+    except OSError:
+        return False
+    finally:
+        s.close()
+    return True
+
+def serve(socket_path, session):
+    """Annotate requests on a unix socket with session until interrupted or terminated.
+
+    socket_path - path to listen on. A socket left behind by a daemon that was killed is
+        replaced
+    session - annotation_station.AnnotationSession"""
+    if os.path.exists(socket_path):
+        if is_listening(socket_path):
+            raise ValueError(f'An annotation daemon is already listening on {socket_path}')
+        os.remove(socket_path)
+
+    # stop cleanly on terminate, so tools the session started are stopped too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    server = AnnotationServer(socket_path, session)
+    logging.info(f'listening on {socket_path}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+        logging.info('stopped annotation daemon')
+
+class AnnotationClient(object):
+    def __init__(self, socket_path, timeout=None):
+        """Sends rows to an annotation daemon started with annotation_station.py serve, and gets
+        them back annotated. Only needs the standard library, so job runners can use it without
+        the annotators' dependencies.
+
+        socket_path - unix socket the daemon listens on
+        timeout - seconds to wait on the daemon before giving up. Waits forever if None"""
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(socket_path)
+        self.f = self.sock.makefile('rb')
+
+    def request(self, request):
+        """Returns the daemon's response to request"""
+        self.sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        line = self.f.readline()
+        if not line:
+            raise ConnectionError('annotation daemon closed the connection')
+
+        response = json.loads(line.decode('utf-8'))
+        if 'error' in response:
+            raise RuntimeError(f'annotation daemon failed: {response["error"]}')
+        return response
+
+    def annotate(self, rows, blat_input_bam=None):
+        """Returns copies of rows with annotation columns appended.
+
+        rows - lists of fields, starting with chrom, pos, and the reference base if the daemon
+            annotates with blat or with --with-base-change
+        blat_input_bam - bam for blat annotations. Defaults to the daemon's --blat-input-bam"""
+        request = {'rows': rows}
+        if blat_input_bam is not None:
+            request['blat_input_bam'] = os.path.abspath(blat_input_bam)
+        return self.request(request)['rows']
+
+    def get_headers(self):
+        """Returns headers of the columns the daemon appends"""
+        return self.request({'rows': []})['headers']
+
+    def close(self):
+        self.f.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
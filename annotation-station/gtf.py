@@ -0,0 +1,313 @@
+import gzip
+import logging
+import re
+from collections import defaultdict
+
+import numpy as np
+
+import metrics
+from intervals import get_first_overlapping_indices, get_max_ends
+
+logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.INFO)
+
+CHROM_COLUMN = 0
+FEATURE_COLUMN = 2
+START_COLUMN = 3
+END_COLUMN = 4
+STRAND_COLUMN = 6
+ATTRIBUTES_COLUMN = 8
+
+# features that make up the coding region. stop codons are split out of CDS in gencode gtfs
+CDS_FEATURES = set(['CDS', 'stop_codon'])
+FEATURES = set(['transcript', 'exon']) | CDS_FEATURES
+
+ATTRIBUTE_REGEX = re.compile(r'(\S+) "([^"]*)"')
+
+# exons are searched by transcript index and start packed into one key. positions are below 2^32
+EXON_KEY_SCALE = 2 ** 32
+
+def normalize_chrom(chrom):
+    return re.sub(r'^chr', '', chrom)
+
+def strip_version(transcript_id):
+    return transcript_id.split('.')[0].lower()
+
+def get_gtf_attributes(attributes_field):
+    """Returns dict of gtf attributes, i.e. gene_id "ENSG00000012048.22"; -> {gene_id: ...}"""
+    return dict(ATTRIBUTE_REGEX.findall(attributes_field))
+
+def open_gtf(gtf_fp):
+    if gtf_fp.endswith('.gz'):
+        return gzip.open(gtf_fp, 'rt')
+    return open(gtf_fp)
+
+class GtfCollection(object):
+    def __init__(self, gene_to_primary_transcript=None):
+        """Collection of transcripts and their exons indexed by position.
+
+        gene_to_primary_transcript - dict of gene name to preferred transcript id
+
+        Transcripts are kept in numpy arrays sorted by chromosome then start, along with the
+        running max of transcript ends within each chromosome, like repeats.RepeatCollection.
+        Exons of every transcript are kept in one array sorted by transcript then start."""
+        self.gene_to_primary_transcript = gene_to_primary_transcript or {}
+
+        # transcript id -> [chrom, start, end, strand, gene, exons, cds start, cds end]
+        self.transcript_to_record = {}
+
+        # built lazily by build_index
+        self.chrom_to_index = None
+        self.transcript_ids = []
+        self.genes = []
+        self.strands = []
+        self.starts = None
+        self.ends = None
+        self.max_ends = None
+        self.minus_strands = None
+        self.is_primary = None
+        self.cds_starts = None
+        self.cds_ends = None
+        self.exon_offsets = None
+        self.exon_counts = None
+        self.exon_keys = None
+        self.exon_ends = None
+
+    def put_feature(self, chrom, feature, start, end, strand, attributes):
+        """put transcript, exon or CDS feature into collection
+
+        attributes - dict of gtf attributes. Must have transcript_id"""
+        transcript_id = attributes['transcript_id']
+        if 'transcript_version' in attributes and '.' not in transcript_id:
+            transcript_id = f'{transcript_id}.{attributes["transcript_version"]}'
+
+        record = self.transcript_to_record.get(transcript_id)
+        if record is None:
+            gene = attributes.get('gene_name', attributes.get('gene_id', '.'))
+            record = [chrom, start, end, strand, gene, [], None, None]
+            self.transcript_to_record[transcript_id] = record
+
+        if feature == 'transcript':
+            record[1], record[2] = start, end
+        else:
+            record[1], record[2] = min(record[1], start), max(record[2], end)
+            if feature == 'exon':
+                record[5].append((start, end))
+            else:
+                record[6] = start if record[6] is None else min(record[6], start)
+                record[7] = end if record[7] is None else max(record[7], end)
+        self.chrom_to_index = None
+
+    def build_index(self):
+        """Build sorted array index from features put into collection"""
+        chrom_to_transcript_ids = defaultdict(list)
+        for transcript_id, record in self.transcript_to_record.items():
+            chrom_to_transcript_ids[normalize_chrom(record[0])].append(transcript_id)
+
+        self.chrom_to_index = {}
+        self.transcript_ids, self.genes, self.strands = [], [], []
+        starts, ends, max_ends, cds_starts, cds_ends = [], [], [], [], []
+        exon_counts, exon_starts, exon_ends = [], [], []
+        for chrom, transcript_ids in chrom_to_transcript_ids.items():
+            offset = len(self.transcript_ids)
+            chrom_starts = np.asarray([self.transcript_to_record[t][1] for t in transcript_ids],
+                    dtype=np.int64)
+            # stable so transcripts with the same start keep gtf order
+            order = np.argsort(chrom_starts, kind='stable')
+            chrom_ends = []
+            for i in order:
+                transcript_id = transcript_ids[i]
+                _, start, end, strand, gene, exons, cds_start, cds_end = \
+                        self.transcript_to_record[transcript_id]
+                self.transcript_ids.append(transcript_id)
+                self.genes.append(gene)
+                self.strands.append(strand)
+                chrom_ends.append(end)
+                cds_starts.append(cds_start if cds_start is not None else -1)
+                cds_ends.append(cds_end if cds_end is not None else -1)
+
+                # a transcript without exon lines is one exon
+                exons = sorted(exons) if exons else [(start, end)]
+                exon_counts.append(len(exons))
+                exon_starts += [exon_start for exon_start, _ in exons]
+                exon_ends += [exon_end for _, exon_end in exons]
+
+            starts.append(chrom_starts[order])
+            ends.append(np.asarray(chrom_ends, dtype=np.int64))
+            max_ends.append(get_max_ends(ends[-1]))
+            self.chrom_to_index[chrom] = (offset, len(transcript_ids))
+
+        self.starts = np.concatenate(starts) if starts else np.zeros(0, dtype=np.int64)
+        self.ends = np.concatenate(ends) if ends else np.zeros(0, dtype=np.int64)
+        self.max_ends = np.concatenate(max_ends) if max_ends else np.zeros(0, dtype=np.int64)
+        self.minus_strands = np.asarray([strand == '-' for strand in self.strands], dtype=bool)
+        self.is_primary = np.asarray([strip_version(transcript_id)
+                == strip_version(self.gene_to_primary_transcript.get(gene, ''))
+                for transcript_id, gene in zip(self.transcript_ids, self.genes)], dtype=bool)
+        self.cds_starts = np.asarray(cds_starts, dtype=np.int64)
+        self.cds_ends = np.asarray(cds_ends, dtype=np.int64)
+
+        self.exon_counts = np.asarray(exon_counts, dtype=np.int64)
+        self.exon_offsets = np.cumsum(self.exon_counts) - self.exon_counts
+        exon_transcripts = np.repeat(np.arange(len(self.transcript_ids)), self.exon_counts)
+        self.exon_keys = exon_transcripts * EXON_KEY_SCALE + np.asarray(exon_starts, dtype=np.int64)
+        self.exon_ends = np.asarray(exon_ends, dtype=np.int64)
+
+    def get_transcripts_for_chrom(self, chrom, positions):
+        """Returns index of the transcript chosen for each of the given positions on chrom, or
+        -1 if no transcript contains it.
+
+        Primary transcripts are chosen first, then the first transcript by start"""
+        if self.chrom_to_index is None:
+            self.build_index()
+
+        positions = np.asarray(positions, dtype=np.int64)
+        transcripts = np.full(len(positions), -1, dtype=np.int64)
+        if normalize_chrom(chrom) not in self.chrom_to_index:
+            return transcripts
+
+        offset, count = self.chrom_to_index[normalize_chrom(chrom)]
+        starts = self.starts[offset:offset + count]
+        ends = self.ends[offset:offset + count]
+        first = get_first_overlapping_indices(starts, ends,
+                self.max_ends[offset:offset + count], positions)
+        last = np.searchsorted(starts, positions, side='right')
+
+        # a pair for each position and each transcript that could contain it
+        counts = np.where(first >= 0, last - first, 0)
+        pair_sites = np.repeat(np.arange(len(positions)), counts)
+        pair_transcripts = (np.repeat(first - (np.cumsum(counts) - counts), counts)
+                + np.arange(len(pair_sites)))
+        contains = ends[pair_transcripts] >= positions[pair_sites]
+        pair_sites = pair_sites[contains]
+        pair_transcripts = pair_transcripts[contains] + offset
+
+        # by position, primary transcripts first, then by start
+        order = np.lexsort((~self.is_primary[pair_transcripts], pair_sites))
+        sites, first_pairs = np.unique(pair_sites[order], return_index=True)
+        transcripts[sites] = pair_transcripts[order][first_pairs]
+
+        return transcripts
+
+    def get_regions(self, transcripts, positions):
+        """Returns transvar style region of each position in its transcript, i.e.
+        inside_[cds_in_exon_2] or inside_[intron_between_exon_3_and_4]. Exons are numbered
+        along the transcript. None for positions without a transcript
+
+        transcripts - transcript indices from get_transcripts_for_chrom"""
+        transcripts = np.asarray(transcripts, dtype=np.int64)
+        positions = np.asarray(positions, dtype=np.int64)
+        has_transcript = transcripts >= 0
+        t = transcripts[has_transcript]
+        p = positions[has_transcript]
+
+        # last exon of the transcript starting at or before the position, in genomic order
+        k = np.searchsorted(self.exon_keys, t * EXON_KEY_SCALE + p, side='right') - 1
+        left = k - self.exon_offsets[t]
+        in_exon = (left >= 0) & (self.exon_ends[np.maximum(k, 0)] >= p)
+
+        minus = self.minus_strands[t]
+        counts = self.exon_counts[t]
+        exon_numbers = np.where(minus, counts - left, left + 1)
+        # lower numbered exon of the two around an intron
+        intron_numbers = np.where(minus, counts - left - 1, left + 1)
+
+        cds_starts = self.cds_starts[t]
+        cds_ends = self.cds_ends[t]
+        has_cds = cds_starts >= 0
+        in_cds = has_cds & (cds_starts <= p) & (p <= cds_ends)
+        five_prime = np.where(minus, p > cds_ends, p < cds_starts)
+
+        regions = []
+        for is_in_exon, exon_number, intron_number, is_coding, is_in_cds, is_five_prime in zip(
+                in_exon.tolist(), exon_numbers.tolist(), intron_numbers.tolist(),
+                has_cds.tolist(), in_cds.tolist(), five_prime.tolist()):
+            if not is_in_exon:
+                regions.append(f'inside_[intron_between_exon_{intron_number}_and_'
+                        f'{intron_number + 1}]')
+            elif not is_coding:
+                regions.append(f'inside_[noncoding_exon_{exon_number}]')
+            elif is_in_cds:
+                regions.append(f'inside_[cds_in_exon_{exon_number}]')
+            else:
+                utr = '5-UTR' if is_five_prime else '3-UTR'
+                regions.append(f'inside_[{utr};noncoding_exon_{exon_number}]')
+
+        all_regions = [None] * len(transcripts)
+        for i, region in zip(np.flatnonzero(has_transcript).tolist(), regions):
+            all_regions[i] = region
+
+        return all_regions
+
+def get_gtf_collection(gtf_fp, gene_to_primary_transcript=None):
+    """Get gtf collection of transcripts, exons and coding regions from file. Can be gzipped"""
+    gc = GtfCollection(gene_to_primary_transcript=gene_to_primary_transcript)
+
+    f = open_gtf(gtf_fp)
+    for line in f:
+        if line.startswith('#'):
+            continue
+        pieces = line.rstrip('\n').split('\t')
+        if len(pieces) <= ATTRIBUTES_COLUMN or pieces[FEATURE_COLUMN] not in FEATURES:
+            continue
+
+        attributes = get_gtf_attributes(pieces[ATTRIBUTES_COLUMN])
+        if 'transcript_id' not in attributes:
+            continue
+
+        gc.put_feature(pieces[CHROM_COLUMN], pieces[FEATURE_COLUMN], int(pieces[START_COLUMN]),
+                int(pieces[END_COLUMN]), pieces[STRAND_COLUMN], attributes)
+    f.close()
+
+    return gc
+
+class GtfAnnotator(object):
+    def __init__(self, gtf_fp, gene_to_primary_transcript_fp):
+        """Gene, strand and region annotations from a GENCODE or Ensembl gtf, looked up in
+        process. A fast stand in for TransvarAnnotator when hgvs coordinates aren't needed.
+
+        gtf_fp - gtf with transcript, exon and CDS features. Can be gzipped
+        gene_to_primary_transcript_fp - tsv with genes in first column and transcripts in second
+        """
+        gene_to_primary_transcript = {l.strip().split('\t')[0]:l.strip().split('\t')[1]
+                for l in open(gene_to_primary_transcript_fp)}
+
+        logging.info(f'reading gtf {gtf_fp}')
+        self.collection = get_gtf_collection(gtf_fp,
+                gene_to_primary_transcript=gene_to_primary_transcript)
+        self.collection.build_index()
+        logging.info(f'indexed {len(self.collection.transcript_ids)} transcripts')
+
+    def get_transcript_gene_strand_region_info_tups(self, sites, reference_version=None,
+            chunk_size=None):
+        """Returns transcript, gene, strand, coordinates, region and info for each site, like
+        TransvarAnnotator.get_transcript_gene_strand_region_info_tups.
+
+        Coordinates and info are . since they need transvar. Positions outside any transcript
+        are intergenic, and positions on chromosomes missing from the gtf are all .
+
+        sites - [(chrom, pos), ...]. Any bases after pos are ignored
+        reference_version, chunk_size - unused. The gtf decides the reference"""
+        metrics.increment('gtf_sites', len(sites))
+
+        chrom_to_indices = defaultdict(list)
+        for i, site in enumerate(sites):
+            chrom_to_indices[site[0]].append(i)
+
+        tups = [None] * len(sites)
+        for chrom, indices in chrom_to_indices.items():
+            positions = [int(sites[i][1]) for i in indices]
+            transcripts = self.collection.get_transcripts_for_chrom(chrom, positions)
+            regions = self.collection.get_regions(transcripts, positions)
+
+            is_known_chrom = normalize_chrom(chrom) in self.collection.chrom_to_index
+            for i, transcript, region in zip(indices, transcripts.tolist(), regions):
+                if transcript >= 0:
+                    tups[i] = (self.collection.transcript_ids[transcript],
+                            self.collection.genes[transcript], self.collection.strands[transcript],
+                            '.', region, '.')
+                elif is_known_chrom:
+                    tups[i] = ('.', '.', '.', '.', 'intergenic', '.')
+                else:
+                    tups[i] = ('.', '.', '.', '.', '.', '.')
+
+        return tups
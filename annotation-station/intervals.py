@@ -0,0 +1,53 @@
+import numpy as np
+
+def get_max_ends(ends):
+    """Returns running max of interval ends. ends must be ordered by interval start"""
+    return np.maximum.accumulate(ends) if len(ends) else ends
+
+def get_first_overlapping_indices(starts, ends, max_ends, positions):
+    """Returns index of the first interval containing each position, or -1 if none do.
+
+    starts, ends - closed intervals sorted by start
+    max_ends - running max of ends, see get_max_ends
+    positions - array of positions to query
+
+    Since max_ends is non-decreasing, the first interval whose running max end reaches a
+    position must itself end at or after that position, so it contains the position if it
+    also starts at or before it."""
+    positions = np.asarray(positions, dtype=np.int64)
+    first_reaching = np.searchsorted(max_ends, positions, side='left')
+    last_starting = np.searchsorted(starts, positions, side='right') - 1
+
+    return np.where(first_reaching <= last_starting, first_reaching, -1)
+
+def get_lowest_ranked_overlapping_indices(starts, ends, max_ends, ranks, positions):
+    """Returns index of the lowest ranked interval containing each position, or -1 if none do.
+
+    starts, ends, max_ends - as for get_first_overlapping_indices
+    ranks - rank of each interval, i.e. its row in the table it was read from
+    positions - array of positions to query
+
+    Intervals containing a position all lie between the first one found by
+    get_first_overlapping_indices and the last one starting at or before the position, so
+    only positions with more than one candidate are checked further."""
+    positions = np.asarray(positions, dtype=np.int64)
+    first_reaching = np.searchsorted(max_ends, positions, side='left')
+    last_starting = np.searchsorted(starts, positions, side='right') - 1
+    indices = np.where(first_reaching <= last_starting, first_reaching, -1)
+
+    for i in np.nonzero(first_reaching < last_starting)[0]:
+        first, last = first_reaching[i], last_starting[i] + 1
+        candidates = np.nonzero(ends[first:last] >= positions[i])[0] + first
+        indices[i] = candidates[np.argmin(ranks[candidates])]
+
+    return indices
+
+def get_overlapping_indices(starts, ends, max_ends, pos):
+    """Returns indices of all intervals containing pos, in order of interval start"""
+    first = get_first_overlapping_indices(starts, ends, max_ends, [pos])[0]
+    if first < 0:
+        return []
+    last_starting = np.searchsorted(starts, pos, side='right')
+    candidates = np.arange(first, last_starting)
+
+    return candidates[ends[first:last_starting] >= pos].tolist()
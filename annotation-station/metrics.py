@@ -0,0 +1,151 @@
+import contextlib
+import cProfile
+import json
+import logging
+import os
+import resource
+import threading
+import time
+from collections import defaultdict
+
+logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.INFO)
+
+class Metrics(object):
+    def __init__(self):
+        """Counters and timings for a run. Safe to update from any thread"""
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = defaultdict(int)
+            self.stages = {}
+            self.tools = {}
+
+    def increment(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def record_stage(self, stage, seconds, rss_growth_mb, peak_rss_mb):
+        with self.lock:
+            timings = self.stages.setdefault(stage, {'calls': 0, 'seconds': 0.,
+                    'rss_growth_mb': 0., 'peak_rss_mb': 0.})
+            timings['calls'] += 1
+            timings['seconds'] += seconds
+            timings['rss_growth_mb'] += rss_growth_mb
+            timings['peak_rss_mb'] = max(timings['peak_rss_mb'], peak_rss_mb)
+
+    def record_tool(self, tool, seconds):
+        with self.lock:
+            timings = self.tools.setdefault(tool,
+                    {'calls': 0, 'seconds': 0., 'max_seconds': 0.})
+            timings['calls'] += 1
+            timings['seconds'] += seconds
+            timings['max_seconds'] = max(timings['max_seconds'], seconds)
+
+    def get_snapshot(self):
+        """Returns json serializable copy of counters and timings"""
+        with self.lock:
+            return {
+                    'counters': dict(self.counters),
+                    'stages': {stage:dict(t) for stage, t in self.stages.items()},
+                    'tools': {tool:dict(t) for tool, t in self.tools.items()},
+                    }
+
+    def merge(self, snapshot):
+        """Add counters and timings from a snapshot taken in another process"""
+        with self.lock:
+            for name, n in snapshot['counters'].items():
+                self.counters[name] += n
+            for key, other in (('stages', self.stages), ('tools', self.tools)):
+                for name, timings in snapshot[key].items():
+                    if name not in other:
+                        other[name] = dict(timings)
+                        continue
+                    for field, value in timings.items():
+                        if field.startswith('max_') or field.startswith('peak_'):
+                            other[name][field] = max(other[name][field], value)
+                        else:
+                            other[name][field] += value
+
+metrics = Metrics()
+
+# directory to dump a cProfile stats file per stage to. profiling is off if None
+profile_dir = None
+stage_to_profile = {}
+# only one profiler can be active at a time, so stages are profiled one at a time
+profile_lock = threading.Lock()
+
+def get_max_rss_mb(who=resource.RUSAGE_SELF):
+    """Returns peak resident set size so far in mb. ru_maxrss is in kb on linux"""
+    return resource.getrusage(who).ru_maxrss / 1024
+
+def enable_profiling(output_dir):
+    global profile_dir
+    os.makedirs(output_dir, exist_ok=True)
+    profile_dir = output_dir
+
+def increment(name, n=1):
+    metrics.increment(name, n)
+
+def record_tool(tool, seconds):
+    metrics.record_tool(tool, seconds)
+
+@contextlib.contextmanager
+def stage(name):
+    """Records wall time and peak rss of the enclosed code under the given stage, and profiles
+    it if profiling is on.
+
+    Peak rss is a high water mark for the whole process, so a stage's rss growth is how much
+    the mark rose while the stage was running"""
+    profile = None
+    if profile_dir is not None:
+        profile_lock.acquire()
+        profile = stage_to_profile.setdefault(name, cProfile.Profile())
+        profile.enable()
+
+    rss_before = get_max_rss_mb()
+    start = time.time()
+    try:
+        yield
+    finally:
+        seconds = time.time() - start
+        if profile is not None:
+            profile.disable()
+            profile_lock.release()
+        rss_after = get_max_rss_mb()
+        metrics.record_stage(name, seconds, rss_after - rss_before, rss_after)
+
+def call_in_stage(name, f, *args, **kwargs):
+    """Returns f(*args, **kwargs), recorded under the given stage"""
+    with stage(name):
+        return f(*args, **kwargs)
+
+def pop_snapshot():
+    """Returns snapshot of metrics and resets them. For sending metrics from worker processes"""
+    snapshot = metrics.get_snapshot()
+    metrics.reset()
+    return snapshot
+
+def merge(snapshot):
+    metrics.merge(snapshot)
+
+def dump_profiles(suffix=''):
+    """Write a pstats file per stage profiled so far to profile_dir"""
+    if profile_dir is None:
+        return
+    with profile_lock:
+        for name, profile in stage_to_profile.items():
+            profile.dump_stats(os.path.join(profile_dir, f'{name}{suffix}.pstats'))
+
+def write_metrics(output_fp, wall_seconds):
+    """Write metrics for the run as json"""
+    snapshot = metrics.get_snapshot()
+    snapshot['wall_seconds'] = wall_seconds
+    snapshot['peak_rss_mb'] = get_max_rss_mb()
+    snapshot['peak_child_rss_mb'] = get_max_rss_mb(resource.RUSAGE_CHILDREN)
+
+    f = open(output_fp, 'w')
+    json.dump(snapshot, f, indent=2, sort_keys=True)
+    f.close()
+    logging.info(f'wrote metrics to {output_fp}')
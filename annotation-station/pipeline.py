@@ -0,0 +1,90 @@
+import queue
+import threading
+
+# marks the end of items on a queue
+END = object()
+
+class Failure(object):
+    def __init__(self, error):
+        """Passed down the pipeline in place of an item when a step raises"""
+        self.error = error
+
+def put_until_stopped(out_queue, item, stop):
+    """Put item on out_queue, giving up if stop is set while the queue is full.
+
+    Returns whether item was put"""
+    while not stop.is_set():
+        try:
+            out_queue.put(item, timeout=.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def run_step(step, items, out_queue, stop):
+    """Apply step to each item, putting results on out_queue until stop is set"""
+    try:
+        for item in items:
+            if isinstance(item, Failure):
+                put_until_stopped(out_queue, item, stop)
+                return
+            if not put_until_stopped(out_queue, step(item), stop):
+                return
+    except Exception as e:
+        put_until_stopped(out_queue, Failure(e), stop)
+        return
+    put_until_stopped(out_queue, END, stop)
+
+def iter_queue(q, stop):
+    """Yields items from q until END, or until stop is set"""
+    while not stop.is_set():
+        try:
+            item = q.get(timeout=.1)
+        except queue.Empty:
+            continue
+        if item is END:
+            return
+        yield item
+
+def run_pipeline(items, steps, queue_depths=None):
+    """Yields steps[-1](...steps[0](item)) for each item, in order.
+
+    Each step runs in its own thread and hands its results to the next step through a queue,
+    so while one item is in a step the item after it can be in the step before. Steps that
+    spend their time in subprocesses or io overlap with each other.
+
+    items - iterable of items, consumed by the thread of the first step
+    steps - functions taking one item and returning the input of the next step
+    queue_depths - max results waiting after each step. Defaults to 1 each. Bounds the
+        number of items held at once to len(steps) + sum(queue_depths)
+
+    An exception raised in a step is reraised here. Once it is, or the caller stops iterating
+    early, every step thread stops at its next item instead of blocking on a full queue"""
+    if queue_depths is None:
+        queue_depths = [1] * len(steps)
+    if len(queue_depths) != len(steps):
+        raise ValueError('must have one queue depth per step')
+
+    stop = threading.Event()
+    for step, queue_depth in zip(steps, queue_depths):
+        out_queue = queue.Queue(maxsize=queue_depth)
+        # daemon threads so a step stuck inside a call doesn't hold up exit after an error
+        thread = threading.Thread(target=run_step, args=(step, items, out_queue, stop),
+                daemon=True)
+        thread.start()
+        items = iter_queue(out_queue, stop)
+
+    try:
+        for item in items:
+            if isinstance(item, Failure):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+
+def identity(item):
+    return item
+
+def iter_in_thread(items, queue_depth=1):
+    """Yields items, iterating them in a background thread up to queue_depth items ahead"""
+    return run_pipeline(items, [identity], queue_depths=[queue_depth])
@@ -1,7 +1,14 @@
+import json
 import os
 import re
+import struct
 from collections import defaultdict
 
+import numpy as np
+
+import metrics
+from intervals import get_lowest_ranked_overlapping_indices, get_max_ends
+
 
 CHROM_COLUMN = 5
 START_COLUMN = 6
@@ -10,50 +17,157 @@ NAME_COLUMN = 10
 CLASS_COLUMN = 11
 FAMILY_COLUMN = 12
 
+REPEAT_INDEX_MAGIC = b'ASREPIDX'
+REPEAT_INDEX_VERSION = 2
+
 def normalize_chrom(chrom):
     return re.sub(r'^chr', '', chrom)
 
-def get_position_index(chrom, pos, bin_size=1000000):
-    """Return index for the given genomic position"""
-    # get rid of chr if present
-    chrom = normalize_chrom(chrom)
-    
-    pos_tup = (chrom, int(int(pos) / bin_size))
-    
-    return pos_tup
+class StringTable(object):
+    def __init__(self, string_offsets, string_bytes):
+        """Interned strings stored as concatenated utf-8 bytes. Strings are decoded on first
+        access"""
+        self.string_offsets = string_offsets
+        self.string_bytes = string_bytes
+        self.cache = {}
+
+    def __len__(self):
+        return len(self.string_offsets) - 1
+
+    def __getitem__(self, i):
+        i = int(i)
+        if i not in self.cache:
+            start, end = self.string_offsets[i], self.string_offsets[i + 1]
+            self.cache[i] = bytes(self.string_bytes[start:end]).decode('utf-8')
+        return self.cache[i]
 
 class RepeatCollection(object):
-    def __init__(self, bin_size=1000000):
-        self.allias_to_tups = defaultdict(list)
-        self.bin_size = bin_size
+    def __init__(self):
+        """Collection of repeats indexed by position.
+
+        Repeats are kept in numpy arrays sorted by chromosome then start, along with the running
+        max of repeat ends within each chromosome, so a lookup is a pair of binary searches.
+        Each repeat's row in the table is kept too, so that where repeats overlap the one
+        reported is the first in the table."""
+        self.repeat_tups = []
+
+        # built lazily from repeat_tups by build_index, or read from a compiled index
+        self.chrom_to_index = None
+        self.chroms = []
+        self.strings = []
+        self.starts = None
+        self.ends = None
+        self.max_ends = None
+        self.rows = None
+        self.name_ids = None
+        self.class_ids = None
+        self.family_ids = None
 
     def put_repeat(self, repeat_tup):
         """put repeat into collection
 
         repeat_tup - (chrom, start, stop, name, class, family)"""
-        start_index = get_position_index(repeat_tup[0], repeat_tup[1],
-                bin_size=self.bin_size)
-        stop_index = get_position_index(repeat_tup[0], repeat_tup[2],
-                bin_size=self.bin_size)
+        self.repeat_tups.append(repeat_tup)
+        self.chrom_to_index = None
 
-        self.allias_to_tups[start_index].append(repeat_tup)
-        if start_index != stop_index:
-            self.allias_to_tups[stop_index].append(repeat_tup)
+    def build_index(self):
+        """Build sorted array index from repeats put into collection"""
+        chrom_to_tups = defaultdict(list)
+        chrom_to_rows = defaultdict(list)
+        for row, repeat_tup in enumerate(self.repeat_tups):
+            chrom_to_tups[normalize_chrom(repeat_tup[0])].append(repeat_tup)
+            chrom_to_rows[normalize_chrom(repeat_tup[0])].append(row)
 
-    def get_repeat(self, chrom, pos):
-        """Get repeat from collection"""
-        position_index = get_position_index(chrom, pos,
-                bin_size=self.bin_size)
-        
-        potentials = self.allias_to_tups[position_index]
+        string_to_id = {}
+        def get_string_id(s):
+            if s not in string_to_id:
+                string_to_id[s] = len(string_to_id)
+            return string_to_id[s]
 
-        for repeat in potentials:
-            is_in_range = int(pos) >= int(repeat[1]) and int(pos) <= int(repeat[2])
-            is_same_chrom = normalize_chrom(repeat[0]) == normalize_chrom(chrom)
-            if is_in_range and is_same_chrom:
-                return repeat
+        self.chroms = []
+        starts, ends, max_ends, rows = [], [], [], []
+        name_ids, class_ids, family_ids = [], [], []
+        offset = 0
+        for chrom, tups in chrom_to_tups.items():
+            chrom_starts = np.asarray([int(t[1]) for t in tups], dtype=np.int64)
+            chrom_ends = np.asarray([int(t[2]) for t in tups], dtype=np.int64)
+            order = np.argsort(chrom_starts, kind='stable')
+            starts.append(chrom_starts[order])
+            ends.append(chrom_ends[order])
+            max_ends.append(get_max_ends(ends[-1]))
+            rows.append(np.asarray(chrom_to_rows[chrom], dtype=np.int32)[order])
 
-        return None
+            for i in order:
+                name_ids.append(get_string_id(tups[i][3]))
+                class_ids.append(get_string_id(tups[i][4]))
+                family_ids.append(get_string_id(tups[i][5]))
+
+            self.chroms.append((chrom, tups[0][0], offset, len(tups)))
+            offset += len(tups)
+
+        self.strings = list(string_to_id.keys())
+        self.starts = np.concatenate(starts) if starts else np.zeros(0, dtype=np.int64)
+        self.ends = np.concatenate(ends) if ends else np.zeros(0, dtype=np.int64)
+        self.max_ends = np.concatenate(max_ends) if max_ends else np.zeros(0, dtype=np.int64)
+        self.rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int32)
+        self.name_ids = np.asarray(name_ids, dtype=np.int32)
+        self.class_ids = np.asarray(class_ids, dtype=np.int32)
+        self.family_ids = np.asarray(family_ids, dtype=np.int32)
+
+        self.set_chrom_index()
+
+    def set_chrom_index(self):
+        """Map each normalized chrom to views of its slice of the index arrays"""
+        self.chrom_to_index = {}
+        for chrom, chrom_name, offset, count in self.chroms:
+            self.chrom_to_index[chrom] = (chrom_name,
+                    self.starts[offset:offset + count],
+                    self.ends[offset:offset + count],
+                    self.max_ends[offset:offset + count],
+                    self.rows[offset:offset + count],
+                    offset)
+
+    def get_repeat_tup(self, chrom_name, starts, ends, offset, i):
+        i = int(i)
+        return (chrom_name, str(starts[i]), str(ends[i]),
+                self.strings[self.name_ids[offset + i]],
+                self.strings[self.class_ids[offset + i]],
+                self.strings[self.family_ids[offset + i]])
+
+    def get_repeats_for_chrom(self, chrom, positions):
+        """Get repeat containing each of the given positions on chrom, or None. Where repeats
+        overlap the one earliest in the table is returned"""
+        if self.chrom_to_index is None:
+            self.build_index()
+
+        index = self.chrom_to_index.get(normalize_chrom(chrom))
+        if index is None:
+            return [None] * len(positions)
+
+        chrom_name, starts, ends, max_ends, rows, offset = index
+        indices = get_lowest_ranked_overlapping_indices(starts, ends, max_ends, rows,
+                [int(pos) for pos in positions])
+
+        return [self.get_repeat_tup(chrom_name, starts, ends, offset, i) if i >= 0 else None
+                for i in indices]
+
+    def get_repeats_for_positions(self, chroms, positions):
+        """Get repeat from collection for each (chrom, pos). None if position is not a repeat"""
+        chrom_to_indices = defaultdict(list)
+        for i, chrom in enumerate(chroms):
+            chrom_to_indices[chrom].append(i)
+
+        repeats = [None] * len(positions)
+        for chrom, indices in chrom_to_indices.items():
+            chrom_repeats = self.get_repeats_for_chrom(chrom, [positions[i] for i in indices])
+            for i, repeat in zip(indices, chrom_repeats):
+                repeats[i] = repeat
+
+        return repeats
+
+    def get_repeat(self, chrom, pos):
+        """Get repeat from collection"""
+        return self.get_repeats_for_chrom(chrom, [pos])[0]
 
 def get_repeat_collection(repeat_table_fp):
     """Get repeat collection from file"""
@@ -77,9 +191,106 @@ def get_repeat_collection(repeat_table_fp):
 
     return rc
 
+def write_repeat_index(repeat_collection, output_fp):
+    """Compile repeat collection into a binary index file that can be memory mapped.
+
+    Layout is magic, header length, json header, then 8 byte aligned columnar arrays. The
+    header records the chromosome slices and the offset, dtype and length of each array."""
+    if repeat_collection.chrom_to_index is None:
+        repeat_collection.build_index()
+
+    string_bytes = [s.encode('utf-8') for s in repeat_collection.strings]
+    string_offsets = np.zeros(len(string_bytes) + 1, dtype=np.int64)
+    string_offsets[1:] = np.cumsum([len(b) for b in string_bytes])
+
+    arrays = [
+            ('starts', repeat_collection.starts.astype(np.int64)),
+            ('ends', repeat_collection.ends.astype(np.int64)),
+            ('max_ends', repeat_collection.max_ends.astype(np.int64)),
+            ('rows', repeat_collection.rows.astype(np.int32)),
+            ('name_ids', repeat_collection.name_ids.astype(np.int32)),
+            ('class_ids', repeat_collection.class_ids.astype(np.int32)),
+            ('family_ids', repeat_collection.family_ids.astype(np.int32)),
+            ('string_offsets', string_offsets),
+            ('string_bytes', np.frombuffer(b''.join(string_bytes), dtype=np.uint8)),
+            ]
+
+    # offsets are relative to the end of the header
+    array_specs = {}
+    offset = 0
+    for name, array in arrays:
+        array_specs[name] = [offset, array.dtype.str, len(array)]
+        offset += get_aligned_length(array.nbytes)
+
+    header = json.dumps({
+            'version': REPEAT_INDEX_VERSION,
+            'chroms': [list(c) for c in repeat_collection.chroms],
+            'arrays': array_specs
+            }).encode('utf-8')
+    header += b' ' * (get_aligned_length(len(header)) - len(header))
+
+    f = open(output_fp, 'wb')
+    f.write(REPEAT_INDEX_MAGIC)
+    f.write(struct.pack('<Q', len(header)))
+    f.write(header)
+    for name, array in arrays:
+        f.write(array.tobytes())
+        f.write(b'\0' * (get_aligned_length(array.nbytes) - array.nbytes))
+    f.close()
+
+def get_aligned_length(n, alignment=8):
+    return (n + alignment - 1) // alignment * alignment
+
+def is_repeat_index(fp):
+    """Whether the given file is a compiled repeat index"""
+    f = open(fp, 'rb')
+    magic = f.read(len(REPEAT_INDEX_MAGIC))
+    f.close()
+    return magic == REPEAT_INDEX_MAGIC
+
+def read_repeat_index(index_fp):
+    """Get repeat collection backed by a memory map of the given compiled index file.
+
+    Nothing is read up front, pages are loaded by the os as lookups touch them and are shared
+    between processes using the same index."""
+    buffer = np.memmap(index_fp, dtype=np.uint8, mode='r')
+
+    magic_length = len(REPEAT_INDEX_MAGIC)
+    header_length = struct.unpack('<Q', bytes(buffer[magic_length:magic_length + 8]))[0]
+    header_start = magic_length + 8
+    header = json.loads(bytes(buffer[header_start:header_start + header_length]).decode('utf-8'))
+    if header['version'] != REPEAT_INDEX_VERSION:
+        raise ValueError(f'Unsupported repeat index version {header["version"]} in {index_fp}')
+
+    data_start = header_start + header_length
+    arrays = {}
+    for name, (offset, dtype, length) in header['arrays'].items():
+        dtype = np.dtype(dtype)
+        start = data_start + offset
+        arrays[name] = buffer[start:start + length * dtype.itemsize].view(dtype)
+
+    rc = RepeatCollection()
+    rc.chroms = [tuple(c) for c in header['chroms']]
+    rc.strings = StringTable(arrays['string_offsets'], arrays['string_bytes'])
+    rc.starts = arrays['starts']
+    rc.ends = arrays['ends']
+    rc.max_ends = arrays['max_ends']
+    rc.rows = arrays['rows']
+    rc.name_ids = arrays['name_ids']
+    rc.class_ids = arrays['class_ids']
+    rc.family_ids = arrays['family_ids']
+    rc.set_chrom_index()
+
+    return rc
+
 class RepeatAnnotator(object):
     def __init__(self, repeat_table_fp):
-        self.repeat_collection = get_repeat_collection(repeat_table_fp)
+        """repeat_table_fp - ucsc repeats table, or index compiled from one with
+        write_repeat_index"""
+        if is_repeat_index(repeat_table_fp):
+            self.repeat_collection = read_repeat_index(repeat_table_fp)
+        else:
+            self.repeat_collection = get_repeat_collection(repeat_table_fp)
 
 
 # repeats table from ucsc table viewer
@@ -97,3 +308,9 @@ class RepeatAnnotator(object):
         if repeat is not None:
             return repeat[3], repeat[4], repeat[5]
         return None
+
+    def get_repeats_by_positions(self, chroms, positions):
+        """Returns (repeat_name, repeat_class, repeat_family) or None for each position"""
+        repeats = self.repeat_collection.get_repeats_for_positions(chroms, positions)
+        metrics.increment('repeat_lookups', len(positions))
+        return [(r[3], r[4], r[5]) if r is not None else None for r in repeats]
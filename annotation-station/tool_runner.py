@@ -0,0 +1,247 @@
+import asyncio
+import logging
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+
+import metrics
+from pipeline import END, Failure, put_until_stopped
+
+logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.INFO)
+
+# max processes of a tool running at once in this process, by tool name. tools not listed are
+# limited to DEFAULT_LIMIT
+tool_limits = {}
+# seconds a tool can run before it is killed, by tool name. tools not listed have no timeout
+tool_timeouts = {}
+
+DEFAULT_LIMIT = os.cpu_count() or 1
+STREAM_CHUNK_SIZE = 2 ** 16
+
+def get_tool_name(tool_args):
+    return os.path.basename(tool_args[0])
+
+def configure(limits=None, timeouts=None):
+    """Set per tool concurrency limits and timeouts. Must be called before the tools are run
+
+    limits - {tool name: max processes at once}
+    timeouts - {tool name: seconds}"""
+    tool_limits.update(limits or {})
+    tool_timeouts.update(timeouts or {})
+
+# AbstractChildWatcher is gone in later pythons, which wait on children in threads already
+if sys.version_info < (3, 8):
+    class ThreadedChildWatcher(asyncio.AbstractChildWatcher):
+        """Waits on each child process in its own thread, so processes can be started from an
+        event loop that isn't running in the main thread. Default from python 3.8 on"""
+        def add_child_handler(self, pid, callback, *args):
+            thread = threading.Thread(target=self.wait, args=(pid, callback, args), daemon=True)
+            thread.start()
+
+        def wait(self, pid, callback, args):
+            try:
+                _, status = os.waitpid(pid, 0)
+            except ChildProcessError:
+                returncode = 255
+            else:
+                if os.WIFSIGNALED(status):
+                    returncode = -os.WTERMSIG(status)
+                else:
+                    returncode = os.WEXITSTATUS(status)
+            callback(pid, returncode, *args)
+
+        def remove_child_handler(self, pid):
+            return False
+
+        def attach_loop(self, loop):
+            pass
+
+        def is_active(self):
+            return True
+
+        def close(self):
+            pass
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            pass
+
+class ToolRunner(object):
+    def __init__(self):
+        """Runs external tools on an event loop in a background thread.
+
+        Calls from any thread share the loop, so they share per tool concurrency limits. Output
+        is read from tools as they produce it, and time spent in each tool is recorded in
+        metrics."""
+        if sys.version_info < (3, 8):
+            asyncio.set_child_watcher(ThreadedChildWatcher())
+
+        self.pid = os.getpid()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+        # tool name to asyncio.Semaphore, created on the loop as tools are first run
+        self.semaphores = {}
+
+    async def communicate(self, process, on_data):
+        if on_data is not None:
+            while True:
+                data = await process.stdout.read(STREAM_CHUNK_SIZE)
+                if not data:
+                    break
+                await on_data(data)
+        await process.wait()
+
+    async def run(self, tool_args, on_data=None, cwd=None, quiet=False):
+        """Run tool, waiting for a slot if the tool is at its limit.
+
+        on_data - coroutine function called with each chunk of stdout. If None, stdout is
+            discarded
+        quiet - if True, stderr is discarded
+
+        Raises subprocess.CalledProcessError on non zero exit, and subprocess.TimeoutExpired
+        if the tool runs past its timeout"""
+        tool = get_tool_name(tool_args)
+        if tool not in self.semaphores:
+            self.semaphores[tool] = asyncio.Semaphore(tool_limits.get(tool, DEFAULT_LIMIT))
+        timeout = tool_timeouts.get(tool)
+
+        async with self.semaphores[tool]:
+            start = time.time()
+            process = await asyncio.create_subprocess_exec(*tool_args, cwd=cwd,
+                    stdout=subprocess.PIPE if on_data is not None else subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL if quiet else None)
+            try:
+                await asyncio.wait_for(self.communicate(process, on_data), timeout)
+            except asyncio.TimeoutError:
+                raise subprocess.TimeoutExpired(tool_args, timeout) from None
+            finally:
+                # timed out, or the caller went away
+                if process.returncode is None:
+                    process.kill()
+                    if on_data is not None:
+                        # output left unread keeps stdout open, and wait would never return
+                        await process.stdout.read()
+                    await process.wait()
+                metrics.record_tool(tool, time.time() - start)
+
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, tool_args)
+
+    def submit(self, coroutine):
+        """Schedule coroutine on the loop. Returns concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def check_output(self, tool_args, cwd=None):
+        """Returns stdout of tool as a string. All of stdout is held in memory until the tool
+        exits, use iter_lines to stream it"""
+        chunks = []
+        async def on_data(data):
+            chunks.append(data)
+
+        self.submit(self.run(tool_args, on_data=on_data, cwd=cwd)).result()
+        return b''.join(chunks).decode('utf-8')
+
+    def call(self, tool_args, cwd=None):
+        """Returns exit code of tool. Output is discarded"""
+        try:
+            self.submit(self.run(tool_args, cwd=cwd, quiet=True)).result()
+        except subprocess.CalledProcessError as e:
+            return e.returncode
+        return 0
+
+    def run_many(self, tool_args_list, cwd=None):
+        """Run tools concurrently, within their limits, with stdout discarded.
+
+        Waits for all of them before raising the first failure"""
+        async def run_all():
+            return await asyncio.gather(*[self.run(tool_args, cwd=cwd)
+                    for tool_args in tool_args_list], return_exceptions=True)
+
+        for result in self.submit(run_all()).result():
+            if isinstance(result, Exception):
+                raise result
+
+    def iter_lines(self, tool_args, cwd=None, max_pending=16):
+        """Yields lines of tool stdout, without newlines, as the tool produces them.
+
+        max_pending - max chunks of lines read ahead of the consumer"""
+        lines_queue = queue.Queue(maxsize=max_pending)
+        stop = threading.Event()
+        remainder = [b'']
+
+        async def put(item):
+            # blocks an executor thread rather than the loop when the consumer falls behind
+            await self.loop.run_in_executor(None, put_until_stopped, lines_queue, item, stop)
+
+        async def on_data(data):
+            lines = (remainder[0] + data).split(b'\n')
+            remainder[0] = lines.pop()
+            await put(lines)
+
+        async def run():
+            try:
+                await self.run(tool_args, on_data=on_data, cwd=cwd)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                await put(Failure(e))
+                return
+            if remainder[0]:
+                await put([remainder[0]])
+            await put(END)
+
+        future = self.submit(run())
+        try:
+            while True:
+                lines = lines_queue.get()
+                if lines is END:
+                    return
+                if isinstance(lines, Failure):
+                    raise lines.error
+                for line in lines:
+                    yield line.decode('utf-8')
+        finally:
+            if not future.done():
+                # consumer stopped early. unblock a pending put and kill the tool
+                stop.set()
+                future.cancel()
+
+runner = None
+runner_lock = threading.Lock()
+
+def get_runner():
+    """Returns the ToolRunner for this process"""
+    global runner
+    with runner_lock:
+        # the loop thread doesn't survive fork, so forked processes get their own runner
+        if runner is None or runner.pid != os.getpid():
+            runner = ToolRunner()
+    return runner
+
+def check_output(tool_args, cwd=None):
+    return get_runner().check_output(tool_args, cwd=cwd)
+
+def call(tool_args, cwd=None):
+    return get_runner().call(tool_args, cwd=cwd)
+
+def run_many(tool_args_list, cwd=None):
+    return get_runner().run_many(tool_args_list, cwd=cwd)
+
+def iter_lines(tool_args, cwd=None, max_pending=16):
+    return get_runner().iter_lines(tool_args, cwd=cwd, max_pending=max_pending)
+
+def get_timings():
+    """Returns {tool name: {'calls': n, 'seconds': total, 'max_seconds': longest call}}"""
+    return metrics.metrics.get_snapshot()['tools']
+
+def log_timings():
+    for tool, timings in sorted(get_timings().items()):
+        logging.info(f'{tool}: {timings["calls"]} calls, {timings["seconds"]:.2f}s total, '
+                f'{timings["max_seconds"]:.2f}s longest')
@@ -0,0 +1,91 @@
+import logging
+import sqlite3
+
+logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.INFO)
+
+KEY_FIELDS = ['reference_version', 'chrom', 'pos', 'ref', 'alt', 'transcript_table_hash']
+VALUE_FIELDS = ['transcript', 'gene', 'strand', 'coordinates', 'region', 'info']
+
+def get_cache_key(reference_version, chrom, pos, ref_base=None, alt_base=None,
+        transcript_table_hash=''):
+    """Returns the cache key for the given site.
+
+    Bases are upper cased to match what is sent to transvar, and missing bases are stored as
+    empty strings so they still take part in the primary key"""
+    ref_base = ref_base.upper() if ref_base is not None else ''
+    alt_base = alt_base.upper() if alt_base is not None else ''
+    return (reference_version, chrom, str(pos), ref_base, alt_base, transcript_table_hash)
+
+class TransvarCache(object):
+    def __init__(self, cache_fp, max_entries=1000000):
+        """On disk cache of parsed transvar annotations.
+
+        cache_fp - sqlite database to use. Will be created if it doesn't exist
+        max_entries - once the cache holds more entries than this, the least recently used
+            entries are evicted"""
+        self.cache_fp = cache_fp
+        self.max_entries = max_entries
+
+        self.hits = 0
+        self.misses = 0
+
+        # only ever used from one thread at a time, but that may not be the thread creating it
+        self.connection = sqlite3.connect(cache_fp, check_same_thread=False)
+        columns = ', '.join(f'{field} TEXT NOT NULL' for field in KEY_FIELDS + VALUE_FIELDS)
+        self.connection.execute(f'CREATE TABLE IF NOT EXISTS annotations ({columns}, '
+                f'last_used INTEGER NOT NULL, PRIMARY KEY ({", ".join(KEY_FIELDS)}))')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS annotations_last_used '
+                'ON annotations (last_used)')
+        self.connection.commit()
+
+        # monotonically increasing use counter, used for lru eviction
+        self.tick = self.connection.execute(
+                'SELECT COALESCE(MAX(last_used), 0) FROM annotations').fetchone()[0]
+
+    def get_many(self, keys):
+        """Returns dict mapping each key found in cache to its
+        (transcript, gene, strand, coordinates, region, info) tuple"""
+        where = ' AND '.join(f'{field} = ?' for field in KEY_FIELDS)
+        select = f'SELECT {", ".join(VALUE_FIELDS)} FROM annotations WHERE {where}'
+        update = f'UPDATE annotations SET last_used = ? WHERE {where}'
+
+        key_to_tup = {}
+        with self.connection:
+            for key in keys:
+                row = self.connection.execute(select, key).fetchone()
+                if row is None:
+                    self.misses += 1
+                    continue
+                self.hits += 1
+                self.tick += 1
+                self.connection.execute(update, (self.tick,) + tuple(key))
+                key_to_tup[key] = tuple(row)
+
+        return key_to_tup
+
+    def put_many(self, key_to_tup):
+        """Store the given {key: (transcript, gene, strand, coordinates, region, info)} in cache"""
+        fields = KEY_FIELDS + VALUE_FIELDS + ['last_used']
+        insert = (f'INSERT OR REPLACE INTO annotations ({", ".join(fields)}) '
+                f'VALUES ({", ".join("?" for _ in fields)})')
+
+        with self.connection:
+            for key, tup in key_to_tup.items():
+                self.tick += 1
+                self.connection.execute(insert, tuple(key) + tuple(tup) + (self.tick,))
+            self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until cache is within max_entries"""
+        count = self.connection.execute('SELECT COUNT(*) FROM annotations').fetchone()[0]
+        if count > self.max_entries:
+            self.connection.execute('DELETE FROM annotations WHERE rowid IN '
+                    '(SELECT rowid FROM annotations ORDER BY last_used LIMIT ?)',
+                    (count - self.max_entries,))
+            logging.info(f'evicted {count - self.max_entries} entries from transvar cache')
+
+    def log_counts(self):
+        logging.info(f'transvar cache: {self.hits} hits, {self.misses} misses')
+
+    def close(self):
+        self.connection.close()
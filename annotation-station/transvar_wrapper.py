@@ -1,11 +1,40 @@
+import collections
+import hashlib
+import logging
 import os
-import subprocess
+import uuid
+
+import metrics
+import tool_runner
+from transvar_cache import get_cache_key
+
+def get_transvar_identifier(chrom, position, ref_base=None, alt_base=None):
+    """Returns the transvar gDNA identifier for the given position"""
+    if ref_base is not None and alt_base is not None:
+        return f'{chrom}:g.{position}{ref_base.upper()}>{alt_base.upper()}'
+    return f'{chrom}:g.{position}'
 
 class TransvarAnnotator(object):
-    def __init__(self, gene_to_primary_transcript_fp):
+    def __init__(self, gene_to_primary_transcript_fp, cache=None, max_memory_entries=100000):
+        """
+        gene_to_primary_transcript_fp - tsv with genes in first column and transcripts in second
+        cache - optional TransvarCache to read and store parsed annotations in
+        max_memory_entries - max parsed annotations kept in memory for the rest of the run, so
+            sites repeated in later batches aren't looked up again. Least recently used are
+            dropped first
+        """
         self.gene_to_primary_transcript = {l.strip().split('\t')[0]:l.strip().split('\t')[1]
                 for l in open(gene_to_primary_transcript_fp)}
 
+        # primary transcript choice changes parsed annotations, so it is part of the cache key
+        f = open(gene_to_primary_transcript_fp, 'rb')
+        self.transcript_table_hash = hashlib.sha1(f.read()).hexdigest()
+        f.close()
+
+        self.cache = cache
+        self.max_memory_entries = max_memory_entries
+        self.key_to_tup = collections.OrderedDict()
+
     def get_gene_from_transvar_lines(self, transvar_lines):
         for line in transvar_lines:
             pieces = line.strip().split('\t')
@@ -72,17 +101,89 @@ class TransvarAnnotator(object):
     def get_transcript_gene_strand_region_info_tup(self, chrom, position, ensembl_transcript=None,
             use_primary=True, reference_version='hg38', ref_base=None, alt_base=None):
         """Returns transcript, gene, strand, region, and info for the given position"""
-        if ref_base is not None and alt_base is not None:
-            tool_args = ['transvar', 'ganno', '--ensembl', '--gencode', '--ucsc', '--refseq',
-                    '-i', f'{chrom}:g.{position}{ref_base.upper()}>{alt_base.upper()}',
-                    '--refversion', reference_version]
-        else:
-            tool_args = ['transvar', 'ganno', '--ensembl', '--gencode', '--ucsc', '--refseq',
-                    '-i', f'{chrom}:g.{position}',
-                    '--refversion', reference_version]
-        result = subprocess.check_output(tool_args).decode('utf-8')
+        tool_args = ['transvar', 'ganno', '--ensembl', '--gencode', '--ucsc', '--refseq',
+                '-i', get_transvar_identifier(chrom, position, ref_base=ref_base, alt_base=alt_base),
+                '--refversion', reference_version]
+        result = tool_runner.check_output(tool_args)
+        metrics.increment('transvar_calls')
 
         if ensembl_transcript is None:
             return self.parse_for_ensembl_transcript(result, use_primary=use_primary)
 
         return self.parse_for_ensembl_transcript(result, ensembl_transcript=ensembl_transcript, use_primary=False)
+
+    def run_transvar_list(self, identifiers, reference_version='hg38'):
+        """Runs a single transvar ganno process over all the given identifiers.
+
+        Returns dict mapping each identifier to the transvar output lines for it"""
+        u_id = str(uuid.uuid4())
+        temp_input_fp = f'temp.transvar.{u_id}.txt'
+        out_f = open(temp_input_fp, 'w')
+        for identifier in identifiers:
+            out_f.write(identifier + '\n')
+        out_f.close()
+
+        tool_args = ['transvar', 'ganno', '--ensembl', '--gencode', '--ucsc', '--refseq',
+                '-l', temp_input_fp,
+                '--refversion', reference_version]
+        # first column of each output record is the input identifier
+        identifier_to_lines = {identifier:[] for identifier in identifiers}
+        try:
+            for line in tool_runner.iter_lines(tool_args):
+                identifier = line.split('\t', 1)[0]
+                if identifier in identifier_to_lines:
+                    identifier_to_lines[identifier].append(line)
+        finally:
+            os.remove(temp_input_fp)
+        metrics.increment('transvar_calls')
+        metrics.increment('transvar_sites', len(identifiers))
+
+        return {identifier:'\n'.join(lines) for identifier, lines in identifier_to_lines.items()}
+
+    def get_transcript_gene_strand_region_info_tups(self, sites, reference_version='hg38',
+            chunk_size=1000):
+        """Returns transcript, gene, strand, region, and info for each of the given sites.
+
+        sites - [(chrom, pos), ...] or [(chrom, pos, ref_base, alt_base), ...]
+
+        Duplicate sites, sites annotated earlier in the run and sites already in the cache are
+        only sent to transvar once. The remaining sites are annotated chunk_size at a time, with
+        one transvar run per chunk."""
+        keys = [get_cache_key(reference_version, *site,
+                transcript_table_hash=self.transcript_table_hash) for site in sites]
+        key_to_site = dict(zip(keys, sites))
+
+        key_to_tup = {key:self.key_to_tup[key] for key in key_to_site if key in self.key_to_tup}
+        if self.cache is not None:
+            key_to_tup.update(self.cache.get_many([key for key in key_to_site
+                    if key not in key_to_tup]))
+
+        missing_keys = [key for key in key_to_site if key not in key_to_tup]
+        logging.info(f'{len(key_to_site)} unique of {len(sites)} total sites, '
+                f'{len(missing_keys)} sent to transvar')
+        for i in range(0, len(missing_keys), chunk_size):
+            chunk_keys = missing_keys[i:i + chunk_size]
+            identifiers = [get_transvar_identifier(*key_to_site[key]) for key in chunk_keys]
+            identifier_to_output = self.run_transvar_list(identifiers,
+                    reference_version=reference_version)
+            chunk_key_to_tup = {key:self.parse_for_ensembl_transcript(identifier_to_output[identifier])
+                    for key, identifier in zip(chunk_keys, identifiers)}
+
+            if self.cache is not None:
+                self.cache.put_many(chunk_key_to_tup)
+            key_to_tup.update(chunk_key_to_tup)
+
+        if self.cache is not None:
+            self.cache.log_counts()
+        self.remember(key_to_tup)
+
+        return [key_to_tup[key] for key in keys]
+
+    def remember(self, key_to_tup):
+        """Keep parsed annotations in memory for the run, dropping the least recently used past
+        max_memory_entries"""
+        for key, tup in key_to_tup.items():
+            self.key_to_tup[key] = tup
+            self.key_to_tup.move_to_end(key)
+        while len(self.key_to_tup) > self.max_memory_entries:
+            self.key_to_tup.popitem(last=False)
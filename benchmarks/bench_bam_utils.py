@@ -0,0 +1,52 @@
+import pytest
+
+import bam_utils
+import generators
+
+@pytest.fixture(scope='module')
+def positions(scale):
+    # ~10 reads per position
+    return generators.get_positions(max(1, scale // 10), seed=2)
+
+@pytest.fixture(scope='module')
+def reads(scale, positions):
+    return generators.get_reads(scale, positions, seed=2)
+
+def put_reads_one_at_a_time(positions, reads):
+    rc = bam_utils.ReadCollection([(chrom, pos) for chrom, pos, _, _ in positions],
+            max_depth=200, seed=0)
+    for chrom, start, cigar, seq in reads:
+        rc.put_read(chrom, start, cigar, seq)
+    return rc
+
+def put_reads(positions, reads):
+    rc = bam_utils.ReadCollection([(chrom, pos) for chrom, pos, _, _ in positions],
+            max_depth=200, seed=0)
+    rc.put_reads((chrom, start, cigar, seq, None) for chrom, start, cigar, seq in reads)
+    return rc
+
+def parse_cigars(cigars):
+    # cached, so start cold each round
+    bam_utils.parse_cigar.cache_clear()
+    return [bam_utils.parse_cigar(cigar) for cigar in cigars]
+
+def get_covering_reference_coords(reads):
+    return [bam_utils.get_covering_reference_coords(start, cigar, seq)
+            for _, start, cigar, seq in reads]
+
+def test_put_read(measure, scale, positions, reads):
+    measure(scale, put_reads_one_at_a_time, positions, reads)
+
+def test_put_reads(measure, scale, positions, reads):
+    measure(scale, put_reads, positions, reads)
+
+def test_parse_cigar(measure, scale, reads):
+    measure(scale, parse_cigars, [cigar for _, _, cigar, _ in reads])
+
+def test_get_covering_reference_coords(measure, scale, reads):
+    measure(scale, get_covering_reference_coords, reads)
+
+def test_get_bases_by_position(measure, scale, reads):
+    targets = [start + 50 for _, start, _, _ in reads]
+    measure(scale, bam_utils.get_bases_by_position, [start for _, start, _, _ in reads],
+            targets, [cigar for _, _, cigar, _ in reads], [seq for _, _, _, seq in reads])
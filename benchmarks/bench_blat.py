@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+import generators
+from blat import get_positive_rna_counts, iter_blat_hits, parse_blat_output
+
+HITS_PER_QUERY = 5
+
+@pytest.fixture(scope='module')
+def blast8_fp(scale, tmpdir_factory):
+    output_fp = str(tmpdir_factory.mktemp('blat').join('hits.blast8'))
+    generators.write_blast8(max(1, scale // HITS_PER_QUERY), output_fp,
+            hits_per_query=HITS_PER_QUERY)
+    return output_fp
+
+def test_parse_blat_output(measure, scale, blast8_fp):
+    measure(scale, parse_blat_output, blast8_fp)
+
+def score_blat_hits(blast8_fp):
+    """Stream hits a query at a time, then check a read spanning each query's first hit
+    against all hits at once"""
+    groups = list(iter_blat_hits(blast8_fp))
+    chrom_to_id = {}
+    columns = [[], [], [], [], []]
+    for i, hits in enumerate(groups):
+        columns[0] += [i] * len(hits)
+        columns[1] += [chrom_to_id.setdefault(chrom, len(chrom_to_id)) for chrom in hits.chroms]
+        columns[2] += hits.starts
+        columns[3] += hits.ends
+        columns[4] += hits.bitscores
+    hit_query_ids, hit_chrom_ids, hit_starts, hit_ends = [np.asarray(c, dtype=np.int64)
+            for c in columns[:4]]
+    first_hits = np.searchsorted(hit_query_ids, np.arange(len(groups)))
+
+    return get_positive_rna_counts(hit_query_ids, hit_chrom_ids, hit_starts, hit_ends,
+            np.asarray(columns[4]), np.arange(len(groups)), hit_chrom_ids[first_hits],
+            hit_starts[first_hits], hit_ends[first_hits]).sum()
+
+def test_score_blat_hits(measure, scale, blast8_fp):
+    measure(scale, score_blat_hits, blast8_fp)
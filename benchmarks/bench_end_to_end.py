@@ -0,0 +1,67 @@
+"""End to end runs of annotation_station.py with stub transvar and blat.
+
+Runs are timed as subprocesses so peak rss, from the run's --metrics-out json, is that of a
+single run rather than of the benchmark process and everything it has already loaded"""
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import generators
+from conftest import ANNOTATION_STATION_DIR
+
+ANNOTATION_STATION = os.path.join(ANNOTATION_STATION_DIR, 'annotation_station.py')
+GENE_TO_PRIMARY_TRANSCRIPT_FP = os.path.join(os.path.dirname(ANNOTATION_STATION_DIR), 'tests',
+        'data', 'test.gene_to_primary_transcript.tsv')
+READS_PER_POSITION = 10
+
+@pytest.fixture(scope='module')
+def run_dir(scale, tmpdir_factory):
+    """Directory with positions, repeats table, bam and an empty reference for scale positions"""
+    run_dir = str(tmpdir_factory.mktemp('e2e'))
+    positions = generators.get_positions(scale, seed=4)
+    generators.write_positions_tsv(positions, os.path.join(run_dir, 'positions.tsv'))
+    generators.write_repeats_table(scale, os.path.join(run_dir, 'repeats_table.tsv'), seed=4)
+    generators.write_bam(generators.get_reads(scale * READS_PER_POSITION, positions, seed=4),
+            os.path.join(run_dir, 'reads.bam'))
+
+    # blat stub never reads the reference. the .fai keeps it from being indexed
+    for filename in ['ref.fa', 'ref.fa.fai']:
+        open(os.path.join(run_dir, filename), 'w').close()
+
+    return run_dir
+
+def run_annotation_station(run_dir, extra_args):
+    tool_args = [sys.executable, ANNOTATION_STATION,
+            '--input-header',
+            '--input-type', 'tsv',
+            '--with-base-change',
+            '--annotate-transvar',
+            '--primary-transcripts', GENE_TO_PRIMARY_TRANSCRIPT_FP,
+            '--annotate-repeats',
+            '--repeats-table', 'repeats_table.tsv',
+            '--annotate-blat',
+            '--blat-input-bam', 'reads.bam',
+            '--reference-fasta', 'ref.fa',
+            '--metrics-out', 'metrics.json',
+            '--output', 'output.tsv'] + extra_args + ['positions.tsv']
+    subprocess.check_output(tool_args, cwd=run_dir, stderr=subprocess.DEVNULL)
+
+@pytest.mark.parametrize('extra_args', [[], ['--concurrent-annotators'], ['--workers', '2']],
+        ids=['serial', 'concurrent', 'workers'])
+def test_e2e_main(benchmark, stub_tools, scale, run_dir, extra_args):
+    benchmark.pedantic(run_annotation_station, args=(run_dir, extra_args), rounds=3,
+            iterations=1)
+
+    f = open(os.path.join(run_dir, 'metrics.json'))
+    run_metrics = json.load(f)
+    f.close()
+
+    benchmark.extra_info['items'] = scale
+    if benchmark.stats is not None:
+        benchmark.extra_info['items_per_second'] = scale / benchmark.stats.stats.mean
+    benchmark.extra_info['peak_rss_mb'] = run_metrics['peak_rss_mb']
+    benchmark.extra_info['peak_child_rss_mb'] = run_metrics['peak_child_rss_mb']
+    benchmark.extra_info['counters'] = run_metrics['counters']
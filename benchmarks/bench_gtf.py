@@ -0,0 +1,35 @@
+import pytest
+
+import generators
+from gtf import get_gtf_collection
+
+@pytest.fixture(scope='module')
+def gtf_fp(scale, tmpdir_factory):
+    output_fp = str(tmpdir_factory.mktemp('gtf').join('annotation.gtf'))
+    generators.write_gtf(max(1, scale // 10), output_fp)
+    return output_fp
+
+@pytest.fixture(scope='module')
+def gtf_collection(gtf_fp):
+    gc = get_gtf_collection(gtf_fp)
+    gc.build_index()
+    return gc
+
+@pytest.fixture(scope='module')
+def positions(scale):
+    return generators.get_positions(scale, seed=1)
+
+def get_regions(gtf_collection, positions):
+    """Transcript and region for each position, a chrom at a time"""
+    regions = []
+    for chrom in generators.CHROMS:
+        chrom_positions = [pos for c, pos, _, _ in positions if c == chrom]
+        transcripts = gtf_collection.get_transcripts_for_chrom(chrom, chrom_positions)
+        regions += gtf_collection.get_regions(transcripts, chrom_positions)
+    return regions
+
+def test_get_regions(measure, scale, gtf_collection, positions):
+    measure(scale, get_regions, gtf_collection, positions)
+
+def test_get_gtf_collection(measure, scale, gtf_fp):
+    measure(scale, get_gtf_collection, gtf_fp)
@@ -0,0 +1,31 @@
+import pytest
+
+import generators
+from repeats import get_repeat_collection
+
+@pytest.fixture(scope='module')
+def repeats_table_fp(scale, tmpdir_factory):
+    output_fp = str(tmpdir_factory.mktemp('repeats').join('repeats_table.tsv'))
+    generators.write_repeats_table(scale, output_fp)
+    return output_fp
+
+@pytest.fixture(scope='module')
+def repeat_collection(repeats_table_fp):
+    return get_repeat_collection(repeats_table_fp)
+
+@pytest.fixture(scope='module')
+def positions(scale):
+    return generators.get_positions(scale, seed=1)
+
+def get_repeats(repeat_collection, positions):
+    return [repeat_collection.get_repeat(chrom, pos) for chrom, pos, _, _ in positions]
+
+def test_get_repeat(measure, scale, repeat_collection, positions):
+    measure(scale, get_repeats, repeat_collection, positions)
+
+def test_get_repeats_for_positions(measure, scale, repeat_collection, positions):
+    measure(scale, repeat_collection.get_repeats_for_positions,
+            [chrom for chrom, _, _, _ in positions], [pos for _, pos, _, _ in positions])
+
+def test_get_repeat_collection(measure, scale, repeats_table_fp):
+    measure(scale, get_repeat_collection, repeats_table_fp)
@@ -0,0 +1,21 @@
+import os
+
+import pytest
+
+import generators
+from transvar_wrapper import TransvarAnnotator
+
+GENE_TO_PRIMARY_TRANSCRIPT_FP = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..',
+        'tests', 'data', 'test.gene_to_primary_transcript.tsv')
+
+@pytest.fixture(scope='module')
+def transvar_outputs(scale):
+    return [generators.get_transvar_output(f'{chrom}:g.{pos}{ref}>{alt}')
+            for chrom, pos, ref, alt in generators.get_positions(scale, seed=3)]
+
+def parse_outputs(annotator, transvar_outputs):
+    return [annotator.parse_for_ensembl_transcript(output) for output in transvar_outputs]
+
+def test_parse_for_ensembl_transcript(measure, scale, transvar_outputs):
+    annotator = TransvarAnnotator(GENE_TO_PRIMARY_TRANSCRIPT_FP)
+    measure(scale, parse_outputs, annotator, transvar_outputs)
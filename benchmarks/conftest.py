@@ -0,0 +1,52 @@
+import os
+import sys
+import tracemalloc
+
+import pytest
+
+BENCHMARKS_DIR = os.path.dirname(os.path.realpath(__file__))
+STUBS_DIR = os.path.join(BENCHMARKS_DIR, 'stubs')
+ANNOTATION_STATION_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), 'annotation-station')
+
+sys.path.insert(0, ANNOTATION_STATION_DIR)
+sys.path.insert(0, BENCHMARKS_DIR)
+
+def pytest_addoption(parser):
+    parser.addoption('--bench-scales', default='1000,10000',
+            help='Comma seperated number of items to run each benchmark at, up to 10000000')
+    parser.addoption('--bench-e2e-scales', default='1000',
+            help='Comma seperated number of positions to run end to end benchmarks at')
+
+def pytest_generate_tests(metafunc):
+    if 'scale' in metafunc.fixturenames:
+        option = '--bench-e2e-scales' if 'e2e' in metafunc.function.__name__ else '--bench-scales'
+        scales = [int(s) for s in metafunc.config.getoption(option).split(',')]
+        metafunc.parametrize('scale', scales, scope='module')
+
+@pytest.fixture
+def stub_tools(monkeypatch):
+    """Put stub transvar and blat executables first on PATH"""
+    monkeypatch.setenv('PATH', STUBS_DIR + os.pathsep + os.environ['PATH'])
+
+@pytest.fixture
+def measure(benchmark):
+    """Returns measure(n_items, f, *args, **kwargs), which benchmarks f(*args, **kwargs) and
+    then runs it once more under tracemalloc to get its peak python memory. Throughput, when
+    timings were taken, and peak memory are added to the benchmark's extra info"""
+    def measure(n_items, f, *args, **kwargs):
+        result = benchmark(f, *args, **kwargs)
+
+        tracemalloc.start()
+        f(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        benchmark.extra_info['items'] = n_items
+        # no stats when run with --benchmark-disable
+        if benchmark.stats is not None:
+            benchmark.extra_info['items_per_second'] = n_items / benchmark.stats.stats.mean
+        benchmark.extra_info['peak_traced_mb'] = peak / 2 ** 20
+
+        return result
+
+    return measure
@@ -0,0 +1,164 @@
+"""Synthetic inputs for benchmarks. Everything is seeded, so a scale always gives the same data"""
+import random
+
+import numpy as np
+
+BASES = 'ACGT'
+CHROMS = ['chr1', 'chr2', 'chr17', 'chrX']
+CHROM_LENGTH = 50000000
+
+def get_positions(n, seed=0, chroms=CHROMS, chrom_length=CHROM_LENGTH):
+    """Returns n random (chrom, pos, ref_base, alt_base), sorted by chrom and pos"""
+    rng = np.random.RandomState(seed)
+    chrom_ids = rng.randint(0, len(chroms), n)
+    positions = rng.randint(1, chrom_length, n)
+    ref_ids = rng.randint(0, 4, n)
+    alt_ids = (ref_ids + rng.randint(1, 4, n)) % 4
+
+    order = np.lexsort((positions, chrom_ids))
+    return [(chroms[chrom_ids[i]], int(positions[i]), BASES[ref_ids[i]], BASES[alt_ids[i]])
+            for i in order]
+
+def write_positions_tsv(positions, output_fp):
+    """Write positions as annotation_station input with a CHROM POS REF ALT header"""
+    f = open(output_fp, 'w')
+    f.write('CHROM\tPOS\tREF\tALT\n')
+    for chrom, pos, ref_base, alt_base in positions:
+        f.write(f'{chrom}\t{pos}\t{ref_base}\t{alt_base}\n')
+    f.close()
+
+def write_repeats_table(n, output_fp, seed=0, chroms=CHROMS, chrom_length=CHROM_LENGTH):
+    """Write a ucsc table browser style repeats table with n repeats, sorted by chrom and start"""
+    rng = np.random.RandomState(seed)
+    chrom_ids = rng.randint(0, len(chroms), n)
+    starts = rng.randint(0, chrom_length, n)
+    lengths = rng.randint(10, 6000, n)
+    order = np.lexsort((starts, chrom_ids))
+
+    names = [('AluSc', 'SINE', 'Alu'), ('L1PA2', 'LINE', 'L1'), ('MER5A', 'DNA', 'hAT-Charlie'),
+            ('(CA)n', 'Simple_repeat', 'Simple_repeat')]
+
+    f = open(output_fp, 'w')
+    f.write('#bin\tswScore\tmilliDiv\tmilliDel\tmilliIns\tgenoName\tgenoStart\tgenoEnd\tgenoLeft\t'
+            'strand\trepName\trepClass\trepFamily\trepStart\trepEnd\trepLeft\tid\n')
+    for i, j in enumerate(order):
+        name, repeat_class, family = names[j % len(names)]
+        start, end = int(starts[j]), int(starts[j] + lengths[j])
+        f.write(f'585\t1000\t100\t0\t0\t{chroms[chrom_ids[j]]}\t{start}\t{end}\t-1\t+\t'
+                f'{name}\t{repeat_class}\t{family}\t1\t{end - start}\t0\t{i}\n')
+    f.close()
+
+def write_gtf(n_transcripts, output_fp, seed=0, chroms=CHROMS, chrom_length=CHROM_LENGTH):
+    """Write a gencode style gtf with n_transcripts transcripts of 1 to 10 exons, with a coding
+    region in half of them. Transcripts are sorted by chrom and start"""
+    rng = np.random.RandomState(seed)
+    chrom_ids = rng.randint(0, len(chroms), n_transcripts)
+    starts = rng.randint(1, chrom_length - 200000, n_transcripts)
+    order = np.lexsort((starts, chrom_ids))
+
+    f = open(output_fp, 'w')
+    for i, j in enumerate(order):
+        chrom = chroms[chrom_ids[j]]
+        strand = '+' if i % 2 else '-'
+        attributes = (f'gene_id "ENSG{i:011d}.1"; transcript_id "ENST{i:011d}.1"; '
+                f'gene_name "GENE{i}";')
+
+        exons = []
+        exon_start = int(starts[j])
+        for _ in range(rng.randint(1, 11)):
+            exon_end = exon_start + int(rng.randint(50, 500))
+            exons.append((exon_start, exon_end))
+            exon_start = exon_end + int(rng.randint(100, 20000))
+
+        f.write(f'{chrom}\tHAVANA\ttranscript\t{exons[0][0]}\t{exons[-1][1]}\t.\t{strand}\t.\t'
+                f'{attributes}\n')
+        for exon_start, exon_end in exons:
+            f.write(f'{chrom}\tHAVANA\texon\t{exon_start}\t{exon_end}\t.\t{strand}\t.\t'
+                    f'{attributes}\n')
+            if i % 4 < 2:
+                f.write(f'{chrom}\tHAVANA\tCDS\t{exon_start + 10}\t{exon_end - 10}\t.\t'
+                        f'{strand}\t0\t{attributes}\n')
+    f.close()
+
+def get_cigar(rng, read_length):
+    """Returns a cigar covering read_length read bases, mostly matches with the odd clip,
+    indel or splice"""
+    kind = rng.random()
+    if kind < .6:
+        return f'{read_length}M'
+    if kind < .75:
+        clip = rng.randint(1, 20)
+        return f'{clip}S{read_length - clip}M'
+    if kind < .85:
+        first = rng.randint(10, read_length - 10)
+        return f'{first}M{rng.randint(1, 5)}D{read_length - first}M'
+    if kind < .95:
+        first = rng.randint(10, read_length - 10)
+        return f'{first}M{rng.randint(100, 5000)}N{read_length - first}M'
+    first = rng.randint(10, read_length - 12)
+    return f'{first}M2I{read_length - first - 2}M'
+
+def get_reads(n, positions, read_length=100, seed=0):
+    """Returns n reads, as (chrom, start, cigar, seq), covering the given (chrom, pos, ...)
+    positions round robin. Sorted by chrom and start"""
+    rng = random.Random(seed)
+    seqs = np.random.RandomState(seed).choice(np.frombuffer(BASES.encode(), dtype=np.uint8),
+            (n, read_length)).tobytes().decode()
+
+    reads = []
+    for i in range(n):
+        chrom, pos = positions[i % len(positions)][:2]
+        start = max(1, pos - rng.randint(1, read_length - 1))
+        seq = seqs[i * read_length:(i + 1) * read_length]
+        reads.append((chrom, start, get_cigar(rng, read_length), seq))
+    reads.sort(key=lambda read: (read[0], read[1]))
+
+    return reads
+
+def write_bam(reads, output_fp, chroms=CHROMS, chrom_length=CHROM_LENGTH):
+    """Write reads from get_reads to an indexed bam"""
+    import pysam
+
+    header = {'HD': {'VN': '1.0', 'SO': 'coordinate'},
+            'SQ': [{'SN': chrom, 'LN': chrom_length} for chrom in chroms]}
+    chrom_to_id = {chrom:i for i, chrom in enumerate(chroms)}
+    chrom_order = sorted(reads, key=lambda read: (chrom_to_id[read[0]], read[1]))
+
+    f = pysam.AlignmentFile(output_fp, 'wb', header=header)
+    for i, (chrom, start, cigar, seq) in enumerate(chrom_order):
+        segment = pysam.AlignedSegment()
+        segment.query_name = f'read{i}'
+        segment.reference_id = chrom_to_id[chrom]
+        segment.reference_start = start - 1
+        segment.cigarstring = cigar
+        segment.query_sequence = seq
+        segment.mapping_quality = 60
+        segment.query_qualities = pysam.qualitystring_to_array('I' * len(seq))
+        f.write(segment)
+    f.close()
+    pysam.index(output_fp)
+
+def write_blast8(n_queries, output_fp, hits_per_query=5, seed=0):
+    """Write blast8 output with hits_per_query hits for each of n_queries queries"""
+    rng = np.random.RandomState(seed)
+    chrom_ids = rng.randint(0, len(CHROMS), n_queries * hits_per_query)
+    starts = rng.randint(1, CHROM_LENGTH, n_queries * hits_per_query)
+    scores = rng.randint(20, 200, n_queries * hits_per_query)
+
+    f = open(output_fp, 'w')
+    for i in range(n_queries * hits_per_query):
+        start = int(starts[i])
+        f.write(f'q{i // hits_per_query}\t{CHROMS[chrom_ids[i]]}\t98.00\t100\t2\t0\t1\t100\t'
+                f'{start}\t{start + 99}\t1e-20\t{scores[i]}.0\n')
+    f.close()
+
+def get_transvar_output(identifier, n_transcripts=4):
+    """Returns transvar ganno output for identifier with n_transcripts records"""
+    lines = ['input\ttranscript\tgene\tstrand\tcoordinates(gDNA/cDNA/protein)\tregion\tinfo']
+    transcripts = [('NM_007294.3', 'RefSeq'), ('uc002idc.1', 'UCSC'),
+            ('ENST00000357654.3', 'Ensembl'), ('ENST00000471181.7', 'Ensembl')]
+    for i in range(n_transcripts):
+        transcript, source = transcripts[i % len(transcripts)]
+        lines.append(f'{identifier}\t{transcript} (protein_coding)\tBRCA1\t-\t'
+                f'{identifier}/c.{i + 1}A>G/.\tinside_[cds_in_exon_{i + 2}]\tsource={source}')
+    return '\n'.join(lines)
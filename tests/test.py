@@ -1,8 +1,17 @@
 import os
+import socket
 import subprocess
+import sys
+import time
 
 import pytest
 
+# tests are run from the repo root
+sys.path.insert(0, 'annotation-station')
+
+# tests are run from the repo root
+sys.path.insert(0, 'annotation-station')
+
 TEST_DATA_DIR = 'tests/data/'
 
 TEST_GENE_TO_PRIMARY_TRANSCRIPT_FP = os.path.join(TEST_DATA_DIR,
@@ -11,6 +20,8 @@ TEST_REPEATS_TABLE_FP = os.path.join(TEST_DATA_DIR,
         'test.repeats_table.tsv')
 TEST_REPEATS_TABLE_HG19_FP = os.path.join(TEST_DATA_DIR,
         'repeats_table.hg19.tsv')
+TEST_GTF_FP = os.path.join(TEST_DATA_DIR,
+        'test.annotation.gtf')
 
 # mapped files
 TEST_HG19_REFERENCE = os.path.join(TEST_DATA_DIR, 'hg19.fa')
@@ -27,6 +38,9 @@ TEST_OUTPUT_FILE_1 = os.path.join(TEST_DATA_DIR, 'threshold.output.tsv')
 TEST_OUTPUT_FILE_2 = os.path.join(TEST_DATA_DIR, 'test.output.tsv')
 REPEATS_OUTPUT_FILE = os.path.join(TEST_DATA_DIR, 'repeats.output.tsv')
 HG19_OUTPUT_FILE = os.path.join(TEST_DATA_DIR, 'test.hg19.output.tsv')
+REPEATS_INDEX_FILE = os.path.join(TEST_DATA_DIR, 'test.repeats_table.idx')
+REPEATS_CHECKPOINT_DIR = os.path.join(TEST_DATA_DIR, 'checkpoints')
+DAEMON_SOCKET = os.path.join(TEST_DATA_DIR, 'annotation_station.sock')
 
 # def test_transvar_annotation():
 #     tool_args = ['python', 'annotation-station/annotation_station.py',
@@ -86,6 +100,952 @@ HG19_OUTPUT_FILE = os.path.join(TEST_DATA_DIR, 'test.hg19.output.tsv')
 #     l = [x for x in open(REPEATS_OUTPUT_FILE) if 'AluSc' in x][0]
 #     assert '43048295' in l
 # 
+def test_gtf_annotation_hg19():
+    tool_args = ['python', 'annotation-station/annotation_station.py',
+            '--input-header',
+            '--reference-version', 'hg19',
+            '--annotate-transvar',
+            '--gtf', TEST_GTF_FP,
+            '--primary-transcripts', TEST_GENE_TO_PRIMARY_TRANSCRIPT_FP,
+            '--output', HG19_OUTPUT_FILE,
+            '--input-type', 'tsv',
+            HG19_INPUT_FILE]
+
+    results = subprocess.check_output(tool_args).decode('utf-8')
+
+    l = [x for x in open(HG19_OUTPUT_FILE) if '41200312' in x][0]
+    assert 'BRCA1' in l and 'ENST00000471181' in l and 'CODING_EXONIC' in l
+
+def test_repeats_annotation_with_index():
+    tool_args = ['python', 'annotation-station/annotation_station.py',
+            'build-repeat-index',
+            '--repeats-table', TEST_REPEATS_TABLE_FP,
+            '--output', REPEATS_INDEX_FILE]
+
+    results = subprocess.check_output(tool_args).decode('utf-8')
+
+    tool_args = ['python', 'annotation-station/annotation_station.py',
+            '--input-header',
+            '--annotate-repeats',
+            '--repeats-table', REPEATS_INDEX_FILE,
+            '--output', REPEATS_OUTPUT_FILE,
+            '--input-type', 'tsv',
+            REPEATS_INPUT_FILE]
+
+    results = subprocess.check_output(tool_args).decode('utf-8')
+
+    l = [x for x in open(REPEATS_OUTPUT_FILE) if 'AluSc' in x][0]
+    assert '43048295' in l
+
+def test_repeats_annotation_resume():
+    tool_args = ['python', 'annotation-station/annotation_station.py',
+            '--input-header',
+            '--annotate-repeats',
+            '--repeats-table', TEST_REPEATS_TABLE_FP,
+            '--batch-size', '2',
+            '--checkpoint-dir', REPEATS_CHECKPOINT_DIR,
+            '--output', REPEATS_OUTPUT_FILE,
+            '--input-type', 'tsv',
+            REPEATS_INPUT_FILE]
+
+    results = subprocess.check_output(tool_args).decode('utf-8')
+    expected = open(REPEATS_OUTPUT_FILE).read()
+
+    os.remove(os.path.join(REPEATS_CHECKPOINT_DIR, 'batch.00000000.tsv'))
+    results = subprocess.check_output(tool_args + ['--resume']).decode('utf-8')
+
+    assert open(REPEATS_OUTPUT_FILE).read() == expected
+    assert [x for x in open(REPEATS_OUTPUT_FILE) if 'AluSc' in x]
+
+    # the bam reader and blat backend can change which reads are aligned, so they stop a resume
+    for extra_args in [['--bam-reader', 'samtools'], ['--blat-backend', 'gfserver']]:
+        result = subprocess.run(tool_args + ['--resume'] + extra_args, stderr=subprocess.PIPE)
+        assert result.returncode != 0
+        assert b'different input or settings' in result.stderr
+
+def test_repeats_annotation_resume_with_metrics(tmpdir):
+    tool_args = ['python', 'annotation-station/annotation_station.py',
+            '--input-header',
+            '--annotate-repeats',
+            '--repeats-table', TEST_REPEATS_TABLE_FP,
+            '--batch-size', '2',
+            '--checkpoint-dir', REPEATS_CHECKPOINT_DIR,
+            '--output', REPEATS_OUTPUT_FILE,
+            '--input-type', 'tsv',
+            REPEATS_INPUT_FILE]
+
+    results = subprocess.check_output(tool_args).decode('utf-8')
+    expected = open(REPEATS_OUTPUT_FILE).read()
+
+    # instrumentation doesn't change output, so doesn't stop a resume
+    os.remove(os.path.join(REPEATS_CHECKPOINT_DIR, 'batch.00000000.tsv'))
+    metrics_fp = str(tmpdir.join('metrics.json'))
+    results = subprocess.check_output(tool_args + ['--resume', '--metrics-out', metrics_fp,
+            '--profile', str(tmpdir.join('profiles'))]).decode('utf-8')
+
+    assert open(REPEATS_OUTPUT_FILE).read() == expected
+    assert os.path.isfile(metrics_fp)
+
+def test_repeats_annotation_daemon():
+    tool_args = ['python', 'annotation-station/annotation_station.py',
+            '--input-header',
+            '--annotate-repeats',
+            '--repeats-table', TEST_REPEATS_TABLE_FP,
+            '--output', REPEATS_OUTPUT_FILE,
+            '--input-type', 'tsv',
+            REPEATS_INPUT_FILE]
+
+    results = subprocess.check_output(tool_args).decode('utf-8')
+    expected = [x.rstrip('\n').split('\t') for x in open(REPEATS_OUTPUT_FILE)]
+
+    tool_args = ['python', 'annotation-station/annotation_station.py',
+            'serve',
+            '--socket', DAEMON_SOCKET,
+            '--annotate-repeats',
+            '--repeats-table', TEST_REPEATS_TABLE_FP]
+
+    server = subprocess.Popen(tool_args)
+    try:
+        while not os.path.exists(DAEMON_SOCKET):
+            assert server.poll() is None
+            time.sleep(.1)
+
+        from daemon import AnnotationClient
+
+        rows = [x.rstrip('\n').split('\t') for x in open(REPEATS_INPUT_FILE)][1:]
+        with AnnotationClient(DAEMON_SOCKET) as client:
+            assert client.get_headers() == expected[0][len(rows[0]):]
+            assert client.annotate(rows) == expected[1:]
+            # annotators stay set up between batches
+            assert client.annotate(rows[:1]) == expected[1:2]
+    finally:
+        server.terminate()
+        server.wait()
+
+    assert not os.path.exists(DAEMON_SOCKET)
+
+def install_stub(tmpdir, monkeypatch, name, source):
+    """Put an executable python script called name, with the given source, first on PATH.
+
+    Returns the file the script can record its calls in, its own path plus .calls"""
+    stub = tmpdir.join(name)
+    stub.write(f'#!{sys.executable}\n' + source)
+    stub.chmod(0o755)
+    monkeypatch.setenv('PATH', str(tmpdir) + os.pathsep + os.environ['PATH'])
+
+    calls_fp = str(stub) + '.calls'
+    open(calls_fp, 'w').close()
+    return calls_fp
+
+def pop_calls(calls_fp):
+    """Returns what a stub recorded since the last call, one entry per line, and clears it"""
+    calls = open(calls_fp).read().split()
+    open(calls_fp, 'w').close()
+    return calls
+
+# records the identifiers it is asked for, and answers in reverse input order with no records
+# for positions ending in 999
+TRANSVAR_STUB = r"""import sys
+args = sys.argv[1:]
+if args[0] == 'config':
+    sys.exit(0)
+if '-l' in args:
+    ids = [l.strip() for l in open(args[args.index('-l') + 1]) if l.strip()]
+else:
+    ids = [args[args.index('-i') + 1]]
+f = open(sys.argv[0] + '.calls', 'a')
+f.writelines(i + '\n' for i in ids)
+f.close()
+
+print('input\ttranscript\tgene\tstrand\tcoordinates(gDNA/cDNA/protein)\tregion\tinfo')
+for i in reversed(ids):
+    if i.split('g.')[1].rstrip('ACGT>').endswith('999'):
+        continue
+    print(f'{i}\tENST00000471181.7 (protein_coding)\tBRCA1\t-\t{i}/c.1A>G/.\t'
+            'inside_[cds_in_exon_2]\tsource=Ensembl')
+"""
+
+@pytest.fixture
+def transvar_calls_fp(tmpdir, monkeypatch):
+    return install_stub(tmpdir, monkeypatch, 'transvar', TRANSVAR_STUB)
+
+def test_transvar_list_rows_stay_aligned(transvar_calls_fp):
+    from transvar_wrapper import TransvarAnnotator, get_transvar_identifier
+
+    annotator = TransvarAnnotator(TEST_GENE_TO_PRIMARY_TRANSCRIPT_FP)
+    sites = [('chr17', 300, 'A', 'G'), ('chr17', 100), ('chr17', 999), ('chr1', 100),
+            ('chr17', 100), ('chr17', 300, 'a', 'g'), ('chr17', 300), ('chr2', 1999, 'C', 'T')]
+    tups = annotator.get_transcript_gene_strand_region_info_tups(sites,
+            reference_version='hg19', chunk_size=3)
+
+    assert len(tups) == len(sites)
+    for site, tup in zip(sites, tups):
+        if str(site[1]).endswith('999'):
+            assert tup == ('.', '.', '.', '.', '.', '.')
+        else:
+            assert tup[3].startswith(get_transvar_identifier(*site) + '/')
+    # duplicate sites, including bases differing only in case, are sent once
+    assert pop_calls(transvar_calls_fp) == list(dict.fromkeys(get_transvar_identifier(*site)
+            for site in sites))
+
+def test_transvar_cache(tmpdir, transvar_calls_fp):
+    from transvar_cache import TransvarCache
+    from transvar_wrapper import TransvarAnnotator
+
+    cache_fp = str(tmpdir.join('transvar_cache.sqlite'))
+    cache = TransvarCache(cache_fp, max_entries=2)
+    # nothing kept in memory, so every lookup goes to the cache
+    annotator = TransvarAnnotator(TEST_GENE_TO_PRIMARY_TRANSCRIPT_FP, cache=cache,
+            max_memory_entries=0)
+    def annotate(sites):
+        return annotator.get_transcript_gene_strand_region_info_tups(sites,
+                reference_version='hg19')
+
+    tups = annotate([('chr17', 100), ('chr17', 200), ('chr17', 100)])
+    assert pop_calls(transvar_calls_fp) == ['chr17:g.100', 'chr17:g.200']
+    assert tups[0] == tups[2] and tups[0][1] == 'BRCA1'
+
+    # hits skip transvar
+    assert annotate([('chr17', 200), ('chr17', 100)]) == tups[1::-1]
+    assert pop_calls(transvar_calls_fp) == []
+
+    # chr17:100 was used last, so chr17:200 is evicted to make room for chr17:300
+    annotate([('chr17', 100)])
+    annotate([('chr17', 300)])
+    assert pop_calls(transvar_calls_fp) == ['chr17:g.300']
+    annotate([('chr17', 100), ('chr17', 300)])
+    assert pop_calls(transvar_calls_fp) == []
+    annotate([('chr17', 200)])
+    assert pop_calls(transvar_calls_fp) == ['chr17:g.200']
+    cache.close()
+
+    # entries outlive the session that stored them
+    cache = TransvarCache(cache_fp, max_entries=2)
+    annotator = TransvarAnnotator(TEST_GENE_TO_PRIMARY_TRANSCRIPT_FP, cache=cache)
+    assert annotate([('chr17', 200)]) == tups[1:2]
+    assert pop_calls(transvar_calls_fp) == []
+    assert cache.hits == 1 and cache.misses == 0
+    cache.close()
+
+def test_transvar_sites_are_remembered_for_the_run(transvar_calls_fp):
+    from transvar_wrapper import TransvarAnnotator
+
+    annotator = TransvarAnnotator(TEST_GENE_TO_PRIMARY_TRANSCRIPT_FP, max_memory_entries=2)
+    def annotate(sites):
+        return annotator.get_transcript_gene_strand_region_info_tups(sites,
+                reference_version='hg19')
+
+    tups = annotate([('chr17', 100), ('chr17', 200)])
+    assert pop_calls(transvar_calls_fp) == ['chr17:g.100', 'chr17:g.200']
+
+    # sites from earlier batches skip transvar, without a cache
+    assert annotate([('chr17', 200), ('chr17', 100)]) == tups[::-1]
+    assert pop_calls(transvar_calls_fp) == []
+
+    # chr17:100 was used last, so chr17:200 is dropped to make room for chr17:300
+    annotate([('chr17', 300)])
+    annotate([('chr17', 100)])
+    assert pop_calls(transvar_calls_fp) == ['chr17:g.300']
+    annotate([('chr17', 200)])
+    assert pop_calls(transvar_calls_fp) == ['chr17:g.200']
+
+def test_intervals_match_brute_force():
+    import numpy as np
+    from intervals import (get_first_overlapping_indices, get_lowest_ranked_overlapping_indices,
+            get_max_ends, get_overlapping_indices)
+
+    def check(intervals, positions):
+        # ranked by order given, then sorted by start
+        ranks = sorted(range(len(intervals)), key=lambda i: intervals[i])
+        intervals = sorted(intervals)
+        starts = np.asarray([start for start, _ in intervals], dtype=np.int64)
+        ends = np.asarray([end for _, end in intervals], dtype=np.int64)
+        max_ends = get_max_ends(ends)
+        ranks = np.asarray(ranks, dtype=np.int32)
+
+        expected = [[i for i, (start, end) in enumerate(intervals) if start <= pos <= end]
+                for pos in positions]
+        assert get_first_overlapping_indices(starts, ends, max_ends, positions).tolist() == \
+                [indices[0] if indices else -1 for indices in expected]
+        assert [get_overlapping_indices(starts, ends, max_ends, pos) for pos in positions] == \
+                expected
+        assert get_lowest_ranked_overlapping_indices(starts, ends, max_ends, ranks,
+                positions).tolist() == [min(indices, key=lambda i: ranks[i]) if indices else -1
+                for indices in expected]
+
+    # nested intervals, and a long interval hiding later short ones from a plain end search
+    intervals = [(10, 100), (20, 30), (25, 26), (40, 50), (60, 60), (150, 160), (155, 158)]
+    check(intervals, list(range(0, 170)))
+    check([], [0, 5])
+
+    rng = np.random.RandomState(0)
+    for _ in range(200):
+        starts = rng.randint(0, 100, rng.randint(1, 20))
+        lengths = rng.choice([0, 1, 5, 30, 80], len(starts))
+        check(list(zip(starts.tolist(), (starts + lengths).tolist())),
+                rng.randint(-5, 200, 50).tolist())
+
+# records the queries it is asked to align, fails if one is named fail, and otherwise gives
+# every query without an N in its sequence a single hit at chr1:1000-1099
+BLAT_STUB = r"""import sys
+queries, unaligned = [], set()
+for l in open(sys.argv[2]):
+    if l[0] == '>':
+        queries.append(l[1:].strip())
+    elif 'N' in l:
+        unaligned.add(queries[-1])
+f = open(sys.argv[0] + '.calls', 'a')
+f.writelines(q + '\n' for q in queries)
+f.close()
+if 'fail' in queries:
+    sys.exit(1)
+
+f = open(sys.argv[4], 'w')
+f.writelines(f'{q}\tchr1\t100.00\t100\t0\t0\t1\t100\t1000\t1099\t1e-50\t200.0\n'
+        for q in queries if q not in unaligned)
+f.close()
+"""
+
+@pytest.fixture
+def blat_calls_fp(tmpdir, monkeypatch):
+    return install_stub(tmpdir, monkeypatch, 'blat', BLAT_STUB)
+
+def test_blat_shards_round_trip(tmpdir, blat_calls_fp):
+    import glob
+    from blat import execute_blat, execute_blat_sharded, split_fasta
+
+    def write_fasta(records, output_fp):
+        f = open(output_fp, 'w')
+        f.write(''.join(records))
+        f.close()
+
+    records = [f'>q{i}\n' + 'ACGT\n' * (i % 3 + 1) for i in range(7)]
+    fasta_fp = str(tmpdir.join('queries.fa'))
+    write_fasta(records, fasta_fp)
+
+    # every record lands in exactly one shard, in order, and no shard is empty
+    for n_shards in [1, 2, 3, 5, 7, 20]:
+        shard_fps = split_fasta(fasta_fp, n_shards, str(tmpdir.join(f'shard.{n_shards}')))
+        shards = [open(fp).read() for fp in shard_fps]
+        assert 0 < len(shards) <= n_shards
+        assert all(shard.startswith('>') for shard in shards)
+        assert ''.join(shards) == ''.join(records)
+    assert len(split_fasta(fasta_fp, 20, str(tmpdir.join('shard')))) == 7
+
+    empty_fp = str(tmpdir.join('empty.fa'))
+    write_fasta([], empty_fp)
+    assert split_fasta(empty_fp, 3, str(tmpdir.join('shard.empty'))) == []
+
+    temp_fps = set(glob.glob('temp.*'))
+    unsharded_fp = str(tmpdir.join('unsharded.blast8'))
+    execute_blat(fasta_fp, 'ref.fa', output_fp=unsharded_fp)
+    assert pop_calls(blat_calls_fp) == [f'q{i}' for i in range(7)]
+
+    sharded_fp = str(tmpdir.join('sharded.blast8'))
+    execute_blat_sharded(fasta_fp, 'ref.fa', 3, output_fp=sharded_fp)
+    assert open(sharded_fp).read() == open(unsharded_fp).read()
+    assert sorted(pop_calls(blat_calls_fp)) == [f'q{i}' for i in range(7)]
+
+    # a failing shard fails the run, and shard files are still cleaned up
+    write_fasta(records + ['>fail\nACGT\n'], fasta_fp)
+    with pytest.raises(subprocess.CalledProcessError):
+        execute_blat_sharded(fasta_fp, 'ref.fa', 3, output_fp=sharded_fp)
+    assert set(glob.glob('temp.*')) == temp_fps
+
+def test_overlapping_repeats_follow_table_order(tmpdir):
+    from repeats import RepeatCollection, read_repeat_index, write_repeat_index
+
+    # the nested repeat comes first in the table, though the one around it starts earlier
+    rc = RepeatCollection()
+    rc.put_repeat(('chr1', '150', '160', 'inner', 'SINE', 'Alu'))
+    rc.put_repeat(('chr1', '100', '200', 'outer', 'LINE', 'L1'))
+    rc.put_repeat(('chr1', '155', '300', 'late', 'LTR', 'ERV1'))
+    index_fp = str(tmpdir.join('repeats.idx'))
+    write_repeat_index(rc, index_fp)
+
+    positions = [99, 100, 149, 150, 158, 161, 250]
+    expected = [None, 'outer', 'outer', 'inner', 'inner', 'outer', 'late']
+    for collection in [rc, read_repeat_index(index_fp)]:
+        repeats = collection.get_repeats_for_positions(['1'] * len(positions), positions)
+        assert [r[3] if r is not None else None for r in repeats] == expected
+
+def test_read_collection_covered_positions_match_brute_force():
+    import random
+    from bam_utils import ReadCollection, get_covering_reference_coords
+
+    rng = random.Random(0)
+    positions = [(rng.choice(['chr1', 'chr2']), rng.randint(1, 500)) for _ in range(100)]
+    read_tups = [(rng.choice(['chr1', 'chr2', 'chr3']), rng.randint(1, 500),
+            rng.choice(['50M', '10S40M', '20M5D30M', '10M200N40M', '20M2I28M']), 'A' * 50, None)
+            for _ in range(300)]
+
+    expected = {p:[] for p in set(positions)}
+    for chrom, start, cigar, seq, _ in read_tups:
+        start, end = get_covering_reference_coords(start, cigar, seq)
+        for p in expected:
+            # positions strictly inside the read span are covered
+            if p[0] == chrom and start < p[1] < end:
+                expected[p].append(start)
+
+    rc = ReadCollection(positions)
+    for chrom, start, cigar, seq, _ in read_tups:
+        rc.put_read(chrom, start, cigar, seq)
+    assert {p:[start for _, start, _, _, _ in rc.get_reads(*p)] for p in expected} == expected
+
+    rc = ReadCollection(positions)
+    rc.put_reads(read_tups, batch_size=7)
+    assert {p:[start for _, start, _, _, _ in rc.get_reads(*p)] for p in expected} == expected
+
+def test_cigar_lookups():
+    from bam_utils import (count_mismatches, get_base_by_position, get_bases_by_position,
+            get_covering_reference_coords, parse_cigar)
+
+    # read at 100: clip xy, ABC at 100-102, insertion ij, DE at 103-104, deletion at 105, FG at
+    # 106-107, splice over 108-110, HK at 111-112
+    cigar = '2S3M2I2M1D2M3N2M'
+    seq = 'xyABCijDEFGHK'
+
+    parsed_cigar = parse_cigar(cigar)
+    assert parsed_cigar.block_reference_starts.tolist() == [0, 3, 6, 11]
+    assert parsed_cigar.block_read_starts.tolist() == [2, 7, 9, 11]
+    assert parsed_cigar.block_lengths.tolist() == [3, 2, 2, 2]
+    # covering end counts every operation, as it always has, so clips and insertions widen it
+    assert get_covering_reference_coords(100, cigar, seq) == (100, 116)
+
+    expected = dict(zip(range(98, 115), [None, None, 'A', 'B', 'C', 'D', 'E', None, 'F', 'G',
+            None, None, None, 'H', 'K', None, None]))
+    assert {pos:get_base_by_position(100, pos, cigar, seq) for pos in expected} == expected
+    assert get_bases_by_position([100] * len(expected), list(expected), [cigar] * len(expected),
+            [seq] * len(expected)) == list(expected.values())
+    assert get_bases_by_position([100, 99, 90, 98], 100, [cigar, '2M', '5M3N5M', '2M'],
+            [seq, 'ST', 'abcdefghij', 'ST']) == ['A', 'T', 'h', None]
+
+    # reference from alignment start, mismatched at 102 and 112. case is ignored
+    assert count_mismatches(cigar, seq, 'abtdenfgnnnha') == 2
+    assert count_mismatches('4M', 'ACGT', 'ACGT') == 0
+
+def test_read_collection_keeps_only_alternate_base_reads():
+    from bam_utils import ReadCollection
+
+    # base at chr1:105 is G, g, a, deleted and skipped by a splice
+    read_tups = [('chr1', 100, '10M', 'AAAAAGAAAA', None),
+            ('chr1', 101, '10M', 'AAAAgAAAAA', None),
+            ('chr1', 102, '10M', 'CCCaCCCCCC', None),
+            ('chr1', 100, '4M2D4M', 'AAAAAAAA', None),
+            ('chr1', 100, '3M4N3M', 'TTTTTT', None)]
+    positions = [('chr1', 105), ('chr1', 200)]
+
+    for batched in [False, True]:
+        rc = ReadCollection(positions, position_to_reference_base={('chr1', 105): 'g'})
+        if batched:
+            rc.put_reads(read_tups)
+        else:
+            for chrom, start, cigar, seq, _ in read_tups:
+                rc.put_read(chrom, start, cigar, seq)
+
+        assert [seq for _, _, _, seq, _ in rc.get_reads('chr1', 105)] == ['CCCaCCCCCC']
+        # dropped reads still count towards coverage
+        assert rc.position_to_coverage[('chr1', 105)] == 5
+        assert rc.get_covered_positions() == set([('chr1', 105)])
+
+    # positions without a reference base keep no reads
+    rc = ReadCollection([('chr1', 105)], position_to_reference_base={})
+    rc.put_reads(read_tups)
+    assert rc.get_reads('chr1', 105) == []
+
+def test_read_collection_reservoir_sampling(tmpdir):
+    import shutil
+    import pysam
+    from bam_utils import ReadCollection, get_read_collection
+
+    # 50 reads over chr1:1000 and 3 over chr1:2050
+    read_tups = [('chr1', 950 + i, '100M', 'A' * 100, None) for i in range(50)] + \
+            [('chr1', 2000 + i, '100M', 'A' * 100, None) for i in range(3)]
+    def get_starts(rc, pos):
+        return [start for _, start, _, _, _ in rc.get_reads('chr1', pos)]
+
+    samples = []
+    for _ in range(2):
+        rc = ReadCollection([('chr1', 1000), ('chr1', 2050)], max_depth=10, seed=7)
+        rc.put_reads(read_tups, batch_size=8)
+        samples.append(get_starts(rc, 1000))
+
+        assert len(set(samples[-1])) == 10
+        assert get_starts(rc, 2050) == [2000, 2001, 2002]
+    assert samples[0] == samples[1]
+
+    rc = ReadCollection([('chr1', 1000)], max_depth=10, seed=8)
+    rc.put_reads(read_tups)
+    assert get_starts(rc, 1000) != samples[0]
+
+    bam_fp = str(tmpdir.join('test.hg19.bam'))
+    shutil.copy(HG19_BLAT_INPUT_BAM, bam_fp)
+    pysam.index(bam_fp)
+    position = ('chr17', 41200990)
+    depth = len(get_read_collection(bam_fp, [position]).get_reads(*position))
+    assert depth > 5
+    assert len(get_read_collection(bam_fp, [position], max_depth=5,
+            seed=0).get_reads(*position)) == 5
+    assert len(get_read_collection(bam_fp, [position], max_depth=depth,
+            seed=0).get_reads(*position)) == depth
+
+def test_duplicate_queries_map_back_to_every_read(tmpdir, blat_calls_fp):
+    import metrics
+    from bam_utils import ReadCollection, write_read_collection_fasta
+    from blat import BlatAnnotator
+
+    # the same sequence at chr1:1000 and twice at chr2:5000, and another at chr2:5010
+    seq, other_seq = 'ACGT' * 25, 'TTGCA' * 20
+    rc = ReadCollection([('chr1', 1050), ('chr2', 5050)])
+    rc.put_reads([('chr1', 1000, '100M', seq, None), ('chr2', 5000, '100M', seq, None),
+            ('chr2', 5000, '100M', seq, None), ('chr2', 5010, '100M', other_seq, None)])
+
+    fasta_fp = str(tmpdir.join('queries.fa'))
+    annotator = BlatAnnotator(['rna_editing'], str(tmpdir.join('ref.fa')))
+    metrics.metrics.reset()
+    annotator.reads_to_data = write_read_collection_fasta(rc, [('chr1', 1050), ('chr2', 5050),
+            ('chr1', 1050)], fasta_fp)
+    counters = metrics.metrics.get_snapshot()['counters']
+    assert (counters['fasta_reads_written'], counters['fasta_queries_written']) == (4, 2)
+    annotator.position_to_reference_base = {('chr1', '1050'): 'A', ('chr2', '5050'): 'A'}
+
+    assert open(fasta_fp).read() == f'>q0\n{seq}\n>q1\n{other_seq}\n'
+    assert {read_id:data['query'] for read_id, data in annotator.reads_to_data.items()} == {
+            'chr1:1050|0': 'q0', 'chr2:5050|0': 'q0', 'chr2:5050|1': 'q0', 'chr2:5050|2': 'q1'}
+
+    # each read is scored against its own position, not the first read sharing its query
+    assert annotator.blat_and_score_fasta(fasta_fp, list(annotator.reads_to_data)) == {
+            'chr1:1050|0': True, 'chr2:5050|0': False, 'chr2:5050|1': False,
+            'chr2:5050|2': False}
+    assert pop_calls(blat_calls_fp) == ['q0', 'q1']
+
+
+def test_adaptive_rounds_stop_early(tmpdir, blat_calls_fp):
+    import random
+    from bam_utils import ReadCollection, write_read_collection_fasta
+    from blat import BlatAnnotator
+
+    # 100 reads without the reference base A at each position. reads at chr1:1050 span their
+    # stub blat hit and all pass, reads at chr2:5050 all fail
+    rng = random.Random(0)
+    positions = [('chr1', 1050), ('chr2', 5050)]
+    rc = ReadCollection(positions)
+    rc.put_reads([(chrom, pos - 50, '100M', ''.join(rng.choice('CGT')
+            for _ in range(100)), None) for chrom, pos in positions for _ in range(100)])
+
+    fasta_fp = str(tmpdir.join('queries.fa'))
+    annotator = BlatAnnotator(['rna_editing'], str(tmpdir.join('ref.fa')), approximate=True,
+            round_size=10, decision_threshold=.5)
+    annotator.reads_to_data = write_read_collection_fasta(rc, positions, fasta_fp)
+    annotator.position_to_reference_base = {(chrom, str(pos)):'A' for chrom, pos in positions}
+
+    full_depth = annotator.get_rna_editing_annotations(annotator.blat_and_score_fasta(fasta_fp,
+            list(annotator.reads_to_data)))
+    assert full_depth == {('chr1', 1050): 1., ('chr2', 5050): 0.}
+    assert len(pop_calls(blat_calls_fp)) == 200
+
+    position_to_annotation = annotator.get_adaptive_rna_editing_blat_annotations(
+            str(tmpdir.join('rounds')))
+
+    # one round of 10 reads per position settles both
+    assert len(pop_calls(blat_calls_fp)) == 20
+    assert {position:annotation[:2] for position, annotation
+            in position_to_annotation.items()} == {position:(passing, 10)
+            for position, passing in full_depth.items()}
+    assert position_to_annotation[('chr1', 1050)][2] > .5
+    assert position_to_annotation[('chr2', 5050)][3] < .5
+
+
+def test_parallel_annotation_matches_serial(tmpdir, transvar_calls_fp, blat_calls_fp):
+    import shutil
+    import pysam
+
+    # the blat stub never reads the reference, and the .fai keeps it from being indexed
+    reference_fp = str(tmpdir.join('ref.fa'))
+    for fp in [reference_fp, reference_fp + '.fai']:
+        open(fp, 'w').close()
+    bam_fp = str(tmpdir.join('test.hg19.bam'))
+    shutil.copy(HG19_BLAT_INPUT_BAM, bam_fp)
+    pysam.index(bam_fp)
+
+    # repeats input plus positions covered by the bam, with the reference base blat needs
+    input_fp = str(tmpdir.join('input.tsv'))
+    f = open(input_fp, 'w')
+    f.write('CHROM\tPOS\tREF\n')
+    for line in list(open(REPEATS_INPUT_FILE))[1:]:
+        f.write(line.rstrip('\n') + '\tA\n')
+    for pos in [41200312, 41200500, 41200700, 41200990, 41201000]:
+        f.write(f'chr17\t{pos}\tA\n')
+    f.close()
+
+    tool_args = ['python', 'annotation-station/annotation_station.py',
+            '--input-header',
+            '--reference-version', 'hg19',
+            '--reference-fasta', reference_fp,
+            '--annotate-transvar',
+            '--primary-transcripts', TEST_GENE_TO_PRIMARY_TRANSCRIPT_FP,
+            '--annotate-repeats',
+            '--repeats-table', TEST_REPEATS_TABLE_HG19_FP,
+            '--annotate-blat',
+            '--blat-input-bam', bam_fp,
+            '--batch-size', '2',
+            '--input-type', 'tsv']
+
+    outputs = []
+    profile_dir = tmpdir.join('profiles')
+    for extra_args in [['--workers', '1'],
+            ['--workers', '2', '--concurrent-annotators', '--profile', str(profile_dir)]]:
+        output_fp = str(tmpdir.join(f'output.{len(outputs)}.tsv'))
+        subprocess.check_output(tool_args + extra_args + ['--output', output_fp, input_fp])
+        outputs.append(open(output_fp, 'rb').read())
+
+    assert outputs[0] == outputs[1]
+    l = [x for x in outputs[0].decode('utf-8').split('\n') if '41200312' in x][0]
+    assert 'BRCA1' in l and 'AluSc' in l and l.endswith('\t0.0')
+    # workers don't inherit the parent's settings, so profiling has to be passed to them
+    assert [fn for fn in profile_dir.listdir() if fn.basename.count('.') == 2]
+
+
+def test_pipeline_keeps_order_and_bounds_items_in_flight():
+    import time
+    from pipeline import run_pipeline
+
+    pulled = []
+    def get_items():
+        for i in range(20):
+            pulled.append(i)
+            yield i
+
+    def slow_add(i):
+        time.sleep(.002 * (i % 3))
+        return i + 1
+
+    steps, queue_depths = [slow_add, str], [1, 1]
+    results = []
+    for result in run_pipeline(get_items(), steps, queue_depths=queue_depths):
+        results.append(result)
+        # a slow consumer lets every step fill up its queue
+        time.sleep(.01)
+        assert len(pulled) - len(results) <= len(steps) + sum(queue_depths)
+    assert results == [str(i + 1) for i in range(20)]
+
+    with pytest.raises(ValueError):
+        list(run_pipeline(range(3), steps, queue_depths=[1]))
+
+def test_pipeline_reraises_step_failure():
+    import itertools
+    import threading
+    from pipeline import run_pipeline
+
+    def fail_on_third(i):
+        if i == 3:
+            raise KeyError(i)
+        return i
+
+    threads = set(threading.enumerate())
+    results = []
+    with pytest.raises(KeyError):
+        # endless items, so the step before the failing one never runs out by itself
+        for result in run_pipeline(itertools.count(1), [abs, fail_on_third, str]):
+            results.append(result)
+    # items before the failing one still come through, in order
+    assert results == ['1', '2']
+
+    items = run_pipeline(itertools.count(), [abs, str])
+    assert next(items) == '0'
+    items.close()
+
+    # after a failure or stopping early, no step is left blocked on a full queue
+    for thread in set(threading.enumerate()) - threads:
+        thread.join(timeout=5)
+        assert not thread.is_alive()
+
+def test_join_stage_batches():
+    from annotation_station import join_stage_batches
+
+    batches = [[['chr1', '1'], ['chr1', '2']], [['chr2', '3']]]
+    stage_batches = [[[row + ['a' + row[1]] for row in rows] for rows in batches],
+            [[row + ['b', row[0]] for row in rows] for rows in batches]]
+
+    assert list(join_stage_batches(batches, stage_batches)) == [
+            [['chr1', '1', 'a1', 'b', 'chr1'], ['chr1', '2', 'a2', 'b', 'chr1']],
+            [['chr2', '3', 'a3', 'b', 'chr2']]]
+
+def test_concurrent_annotate_tsv(tmpdir):
+    import functools
+    import threading
+    import time
+    from annotation_station import annotate_stage, annotate_tsv
+
+    input_fp = str(tmpdir.join('input.tsv'))
+    f = open(input_fp, 'w')
+    f.write('CHROM\tPOS\n')
+    f.writelines(f'chr1\t{i}\n' for i in range(50))
+    f.close()
+
+    def get_squares(rows):
+        return [[int(row[1]) ** 2] for row in rows]
+
+    def get_slow_negatives(rows):
+        time.sleep(.01)
+        return [[-int(row[1])] for row in rows]
+
+    def get_failure(fail_pos, rows):
+        if any(int(row[1]) == fail_pos for row in rows):
+            raise KeyError(fail_pos)
+        return [['.'] for _ in rows]
+
+    def get_stage(get_columns):
+        return functools.partial(annotate_stage, get_columns)
+
+    # stages running at different speeds still line up row by row
+    stages = [(['SQUARE'], get_stage(get_squares)), (['NEGATIVE'], get_stage(get_slow_negatives))]
+    outputs = []
+    for concurrent in [False, True]:
+        output_fp = str(tmpdir.join(f'output.{concurrent}.tsv'))
+        annotate_tsv(input_fp, output_fp, stages, input_header=True, batch_size=3,
+                concurrent=concurrent, queue_depth=1)
+        outputs.append(open(output_fp).read())
+    assert outputs[0] == outputs[1]
+    assert outputs[1].split('\n')[:3] == ['CHROM\tPOS\tSQUARE\tNEGATIVE', 'chr1\t0\t0\t0',
+            'chr1\t1\t1\t-1']
+    assert outputs[1].split('\n')[-2] == 'chr1\t49\t2401\t-49'
+
+    # a failing stage stops the run, and the stages still going with it
+    threads = set(threading.enumerate())
+    stages.append((['FAILURE'], get_stage(functools.partial(get_failure, 20))))
+    with pytest.raises(KeyError):
+        annotate_tsv(input_fp, str(tmpdir.join('output.failure.tsv')), stages,
+                input_header=True, batch_size=3, concurrent=True, queue_depth=1)
+    for thread in set(threading.enumerate()) - threads:
+        thread.join(timeout=5)
+        assert not thread.is_alive()
+
+
+def test_tool_runner_limits_and_timeouts(monkeypatch):
+    import time
+    import tool_runner
+
+    monkeypatch.setitem(tool_runner.tool_limits, 'sleep', 2)
+    monkeypatch.setitem(tool_runner.tool_timeouts, 'sleep', 1)
+    runner = tool_runner.ToolRunner()
+    n_calls = tool_runner.get_timings().get('sleep', {}).get('calls', 0)
+
+    # 2 at a time, so 4 take at least 2 sleeps
+    start = time.time()
+    runner.run_many([['sleep', '.25']] * 4)
+    assert time.time() - start >= .5
+
+    start = time.time()
+    with pytest.raises(subprocess.TimeoutExpired):
+        runner.check_output(['sleep', '10'])
+    assert time.time() - start < 5
+    assert tool_runner.get_timings()['sleep']['calls'] - n_calls == 5
+
+def write_blast8(hits, output_fp):
+    """Write (qseqid, sseqid, sstart, send, bitscore) hits as blast8"""
+    f = open(output_fp, 'w')
+    for qseqid, sseqid, sstart, send, bitscore in hits:
+        f.write(f'{qseqid}\t{sseqid}\t98.00\t100\t2\t0\t1\t100\t{sstart}\t{send}\t1e-20\t'
+                f'{bitscore}\n')
+    f.close()
+
+
+def test_iter_blat_hits_groups_queries(tmpdir):
+    from blat import iter_blat_hits
+
+    blast8_fp = str(tmpdir.join('hits.blast8'))
+    write_blast8([('q0', 'chr1', 100, 150, 80.0), ('q0', '2', 300, 250, 70.5),
+            ('q1', 'chrX', 5, 50, 60.0), ('q2', 'chr1', 7, 9, 20.0), ('q2', 'chr1', 8, 10, 20.0),
+            ('q2', 'chr3', 1, 2, 19.0)], blast8_fp)
+    f = open(blast8_fp, 'a')
+    f.write('\n')
+    f.close()
+
+    assert [(hits.qseqid, hits.chroms, hits.starts, hits.ends, hits.bitscores)
+            for hits in iter_blat_hits(blast8_fp)] == [
+            ('q0', ['1', '2'], [100, 300], [150, 250], [80.0, 70.5]),
+            ('q1', ['X'], [5], [50], [60.0]),
+            ('q2', ['1', '1', '3'], [7, 8, 1], [9, 10, 2], [20.0, 20.0, 19.0])]
+
+    open(blast8_fp, 'w').close()
+    assert list(iter_blat_hits(blast8_fp)) == []
+
+    # q0 comes back after q1
+    write_blast8([('q0', 'chr1', 100, 150, 80.0), ('q1', 'chr1', 100, 150, 80.0),
+            ('q0', 'chr2', 100, 150, 80.0)], blast8_fp)
+    hits = iter_blat_hits(blast8_fp)
+    assert [next(hits).qseqid, next(hits).qseqid] == ['q0', 'q1']
+    with pytest.raises(ValueError):
+        next(hits)
+
+
+
+# answers status after a second, and fails to start a server
+GFSERVER_STUB = r"""import sys
+import time
+if sys.argv[1] == 'status':
+    time.sleep(1)
+    sys.exit(0)
+sys.exit(1)
+"""
+
+def test_gfserver_port_in_use(tmpdir, monkeypatch):
+    import blat
+
+    two_bit_fp = str(tmpdir.join('ref.2bit'))
+    open(two_bit_fp, 'w').close()
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('localhost', 0))
+    s.listen(1)
+    try:
+        with pytest.raises(ValueError):
+            blat.GfServer(two_bit_fp, port=s.getsockname()[1])
+    finally:
+        s.close()
+
+    # another server answers status, but ours exits without starting
+    install_stub(tmpdir, monkeypatch, 'gfServer', GFSERVER_STUB)
+    with pytest.raises(subprocess.CalledProcessError):
+        blat.GfServer(two_bit_fp)
+
+def get_positive_rna_counts_for_file(blast8_fp, reads, percent_threshold=.95):
+    """get_positive_rna_counts for (qseqid, chrom, read start, read end) reads against hits
+    read with iter_blat_hits"""
+    import numpy as np
+    from blat import get_positive_rna_counts, iter_blat_hits, normalize_chrom
+
+    chrom_to_id = {}
+    query_to_id = {}
+    hit_columns = [[], [], [], [], []]
+    for hits in iter_blat_hits(blast8_fp):
+        query_id = query_to_id.setdefault(hits.qseqid, len(query_to_id))
+        hit_columns[0] += [query_id] * len(hits)
+        hit_columns[1] += [chrom_to_id.setdefault(c, len(chrom_to_id)) for c in hits.chroms]
+        hit_columns[2] += hits.starts
+        hit_columns[3] += hits.ends
+        hit_columns[4] += hits.bitscores
+
+    read_columns = [
+            [query_to_id.get(qseqid, -1) for qseqid, _, _, _ in reads],
+            [chrom_to_id.setdefault(normalize_chrom(chrom), len(chrom_to_id))
+                    for _, chrom, _, _ in reads],
+            [start for _, _, start, _ in reads],
+            [end for _, _, _, end in reads]]
+
+    hit_arrays = [np.asarray(c, dtype=np.int64) for c in hit_columns[:4]]
+    hit_arrays.append(np.asarray(hit_columns[4], dtype=np.float64))
+    read_arrays = [np.asarray(c, dtype=np.int64) for c in read_columns]
+
+    return get_positive_rna_counts(*hit_arrays, *read_arrays,
+            percent_threshold=percent_threshold).tolist()
+
+def test_positive_rna_counts_match_per_read_scoring(tmpdir):
+    import random
+    from blat import is_positive_rna_count, parse_blat_output
+
+    blast8_fp = str(tmpdir.join('hits.blast8'))
+
+    # top hits tied in and out of range, in both orders
+    write_blast8([('q0', 'chr1', 100, 150, 80.0), ('q0', 'chr2', 100, 150, 80.0),
+            ('q1', 'chr2', 100, 150, 80.0), ('q1', 'chr1', 100, 150, 80.0),
+            ('q2', 'chr1', 100, 150, 80.0), ('q2', '1', 99, 151, 80.0),
+            ('q2', 'chr3', 5, 50, 76.0),
+            ('q3', 'chr1', 100, 150, 80.0), ('q3', 'chr3', 5, 50, 76.5)], blast8_fp)
+    reads = [('q0', 'chr1', 100, 150), ('q1', 'chr1', 100, 150), ('q2', 'chr1', 100, 150),
+            ('q3', 'chr1', 100, 150), ('q0', 'chr1', 102, 150), ('q4', 'chr1', 100, 150)]
+    assert get_positive_rna_counts_for_file(blast8_fp, reads) == [False, False, True, False,
+            False, False]
+
+    rng = random.Random(0)
+    for _ in range(200):
+        hits = []
+        for i in range(rng.randint(1, 6)):
+            for _ in range(rng.randint(1, 6)):
+                start = rng.randint(90, 120)
+                hits.append((f'q{i}', rng.choice(['chr1', '1', 'chr2']), start,
+                        start + rng.randint(-5, 40), rng.choice([50.0, 57.0, 60.0, 95.0, 100.0])))
+        write_blast8(hits, blast8_fp)
+
+        query_to_dicts = {}
+        for d in parse_blat_output(blast8_fp):
+            query_to_dicts.setdefault(d['qseqid'], []).append(d)
+
+        reads = [(f'q{rng.randint(0, 6)}', rng.choice(['chr1', '1', 'chr3']), 100,
+                rng.randint(100, 150)) for _ in range(rng.randint(1, 10))]
+        expected = [is_positive_rna_count(chrom, start, end, query_to_dicts.get(qseqid, []))
+                for qseqid, chrom, start, end in reads]
+
+        assert get_positive_rna_counts_for_file(blast8_fp, reads) == expected
+
+def test_blast_prepare_input_files_without_samtools(tmpdir, monkeypatch):
+    import shutil
+    from blast import prepare_input_files
+
+    bam_fp = str(tmpdir.join('test.hg19.bam'))
+    fasta_fp = str(tmpdir.join('reads.fa'))
+    shutil.copy(HG19_BLAT_INPUT_BAM, bam_fp)
+    monkeypatch.setenv('PATH', str(tmpdir))
+
+    prepare_input_files(bam_fp, fasta_fp, [('chr17', 41200990)])
+
+    assert os.path.isfile(bam_fp + '.bai')
+    assert open(fasta_fp).read().startswith('>q0')
+
+def test_tool_runner_iter_lines_early_exit(monkeypatch):
+    import itertools
+    import tool_runner
+
+    # if stopping early left yes running, it would keep its only slot and the second run would
+    # never start
+    monkeypatch.setitem(tool_runner.tool_limits, 'yes', 1)
+    runner = tool_runner.ToolRunner()
+    for _ in range(5):
+        lines = runner.iter_lines(['yes', 'y'], max_pending=1)
+        assert list(itertools.islice(lines, 5)) == ['y'] * 5
+        lines.close()
+
+    assert list(runner.iter_lines(['printf', 'a\\nb\\nc'])) == ['a', 'b', 'c']
+    with pytest.raises(subprocess.CalledProcessError):
+        list(runner.iter_lines(['false']))
+
+
+
+def test_blat_chunk_missing_positions(tmpdir, monkeypatch, blat_calls_fp):
+    import bam_utils
+    from bam_utils import ReadCollection
+    from blat import BlatAnnotator
+
+    # chr1:1050 has a read that passes, chr1:2050 only has a read carrying the reference base
+    # A, chr1:3050 has a read blat finds no hits for, and chr1:4050 has no reads
+    positions = [('chr1', '1050'), ('chr1', '2050'), ('chr1', '3050'), ('chr1', '4050')]
+    read_tups = [('chr1', 1000, '100M', 'C' * 100, None), ('chr1', 2000, '100M', 'A' * 100, None),
+            ('chr1', 3000, '100M', 'N' * 100, None)]
+
+    def get_read_collection(input_bam_fp, position_tups, position_to_reference_base=None,
+            **kwargs):
+        rc = ReadCollection(position_tups, position_to_reference_base=position_to_reference_base)
+        rc.put_reads(read_tups)
+        return rc
+    monkeypatch.setattr(bam_utils, 'get_read_collection', get_read_collection)
+    monkeypatch.setattr(bam_utils, 'index_bam', lambda *args, **kwargs: None)
+
+    for approximate, missing, no_informative_reads in [(False, ['.'], [0.0]),
+            (True, ['.'] * 4, [0.0, 0, '.', '.'])]:
+        annotator = BlatAnnotator(['rna_editing'], str(tmpdir.join('ref.fa')),
+                approximate=approximate)
+        chunk = annotator.fetch_chunk(str(tmpdir.join('reads.bam')), positions,
+                reference_bases=['A'] * len(positions))
+        annotations, headers = chunk.align_chunk().score_chunk()
+
+        assert len(headers) == len(missing)
+        assert annotations[('chr1', '1050')][0] == 1.
+        assert annotations[('chr1', '2050')] == no_informative_reads
+        assert annotations[('chr1', '3050')] == missing
+        assert annotations[('chr1', '4050')] == missing
+
+
 def test_blast_annotation_hg19():
     tool_args = ['python', 'annotation-station/annotation_station.py',
             '--input-header',